@@ -1,5 +1,9 @@
 
 
+import collections
+import copy
+import hashlib
+import time
 import numpy as np
 
 # these values are given in the paper but probably can be changed
@@ -9,7 +13,25 @@ COSZERO = 1.0 - 1.0e-12 # limit used to determine nearly normal incidence
                         # measured from z-axis
 COS90 = 1.0e-6 # limit used to determine nearly parallel incidence
 PARTIAL_REFLECTION = 0 # pick zero for OFF, one for ON
+# the values above are only defaults. each model keeps its own copy so two
+# models in one process (or parallel workers) can use different policies
  
+# tissue classes that can be used as layers of a model, {name: class}.
+# a tissue class needs the attributes name, n, g, z, mua and mus (see
+# medium). it may also define inclusion(photon, model), which is called
+# before each drop in the layer and returns (mua, mut) at the photon's
+# position, e.g. for a bone passing through the layer
+tissues = {}
+
+def registerTissue(cls):
+    """
+    register a tissue class so the models (and tools that describe a model,
+    like the result cache) know it. can be used as a class decorator
+    """
+    tissues[cls.__name__] = cls
+    return cls
+
+@registerTissue
 class medium:
     """
     medium class defining the optical properties of a medium
@@ -21,20 +43,360 @@ class medium:
         z: thickness of layer of medium (along z-axis)
         mua: absorption coefficient [1/cm]
         mus: scattering coefficient [1/cm]
+        phase: tabulated phase function (see scattering_phase) used instead
+                of Henyey-Greenstein, g is then its mean cosine
     """
 
     # creat a list to store media
     media = []
     
-    def __init__(self, name, n, g, z, mua, mus):
+    def __init__(self, name, n, g, z, mua, mus, phase=None):
         self.name = name
         self.n = n
         self.mua = mua
         self.mus = mus
-        self.g = g
+        self.g = g if phase is None else phase.g
+        self.phase = phase
         self.z = z
         medium.media.append(name) # add each medium object to the list
 
+class EventBuffer:
+    """
+    buffer of tally events. an event is (u, v, w): two coordinates of the
+    event (e.g. r**2 and z of an absorption) and the weight to add. while
+    photons are transported the events are only appended to the list
+    events, which is much cheaper than finding the bin and writing into the
+    array for every event. when the buffer is flushed all the events are
+    binned at once with numpy and added to the target with np.bincount, so
+    the cost per event hardly depends on the size of the grid.
+
+        target: array the events are added to (updated in place)
+        binning: function of the arrays u and v returning the flat indices
+                into target (see model.binRZ and model.binRA)
+        size: number of events held before the buffer should be flushed
+                (model.run checks after every photon)
+        unit: weight of one count if target is an integer array (fixed
+                point), None otherwise
+        promote: function called with the buffer when a fixed point target
+                would overflow. it must give the buffer a float target (see
+                model.promoteTally)
+        overflow: float array of the weights beyond the grid, None if the
+                binning puts them in the last bins. the flat indices from
+                target.size on are indices into overflow
+        events: list of the buffered events
+    """
+    def __init__(self, target, binning, size=1 << 16, unit=None,
+                 promote=None, overflow=None):
+        self.target = target
+        self.binning = binning
+        self.size = size
+        self.unit = unit
+        self.promote = promote
+        self.overflow = overflow
+        self.events = []
+    
+    def add(self, u, v, w):
+        self.events.append((u, v, w))
+    
+    def full(self):
+        return len(self.events) >= self.size
+    
+    def addArrays(self, u, v, w):
+        # add many events at once (e.g. from a vectorized transport)
+        self.addBins(self.binning(u, v), w)
+    
+    def addBins(self, index, w):
+        # add the weights w at the flat indices index (with the overflow
+        # indices after the target)
+        length = self.target.size
+        if self.overflow is not None:
+            length += self.overflow.size
+        self.addWeights(np.bincount(index, weights=w, minlength=length))
+    
+    def addWeights(self, weights):
+        # add a flat array of weights with the size of the target (and of
+        # the overflow after it). the sums of a whole flush are added at
+        # once, which keeps the rounding of float32 targets small
+        if len(weights) > self.target.size:
+            self.overflow += weights[self.target.size:]
+            weights = weights[:self.target.size]
+        flat = self.target.reshape(-1) # view of the target
+        if self.unit is None:
+            flat += weights
+            return
+        counts = np.rint(weights/self.unit)
+        if counts.max() + flat.max() > np.iinfo(flat.dtype).max:
+            self.promote(self) # would overflow
+            self.target.reshape(-1)[:] += weights
+            return
+        flat += counts.astype(flat.dtype)
+    
+    def flush(self):
+        if self.events:
+            u, v, w = np.array(self.events).T
+            self.events = []
+            self.addArrays(u, v, w)
+
+class NullBuffer:
+    """
+    buffer of a tally that is not kept. appending to the events (a deque
+    of length zero) throws the event away
+    """
+    def __init__(self):
+        self.events = collections.deque(maxlen=0)
+        self.size = 0
+    
+    def add(self, u, v, w):
+        pass
+    
+    def full(self):
+        return False
+    
+    def addArrays(self, u, v, w):
+        pass
+    
+    def flush(self):
+        pass
+
+class TrackBuffer(EventBuffer):
+    """
+    buffer of the track segments of the track length fluence estimator. an
+    event is (x, y, z, ux, uy, uz, s, w): a hop of length s from (x, y, z)
+    in the direction u, carrying the weight w. when the buffer is flushed
+    every segment is cut where it crosses the z planes and the r cylinders
+    of the grid, all segments at once with numpy, and the weighted length
+    of every piece is added to its (r, z) cell
+
+        dr, dz, nr, nz: grid of the target (the last bins, or the
+                overflow, collect everything beyond the grid, like
+                model.binRZ)
+    """
+    def __init__(self, target, binning, dr, dz, size=1 << 16, unit=None,
+                 promote=None, overflow=None):
+        EventBuffer.__init__(self, target, binning, size, unit, promote,
+                             overflow)
+        self.nr, self.nz = target.shape
+        self.dr = dr
+        self.dz = dz
+    
+    def add(self, x, y, z, ux, uy, uz, s, w):
+        self.events.append((x, y, z, ux, uy, uz, s, w))
+    
+    def crossings(self, count, start, sign, value):
+        """
+        segment index and crossing number of count[i] crossings of every
+        segment i, with the grid line start[i] + sign[i]*crossing. value is
+        called with (segment, line) and returns the parameter t
+        """
+        segment = np.repeat(np.arange(len(count)), count)
+        first = np.repeat(np.cumsum(count) - count, count)
+        k = np.arange(len(segment)) - first
+        line = start[segment] + sign[segment]*k
+        return segment, value(segment, line)
+    
+    def addSegments(self, x, y, z, ux, uy, uz, s, w):
+        # cut the segments at the grid and add the weighted lengths
+        n = len(s)
+        nr, nz, dr, dz = self.nr, self.nz, self.dr, self.dz
+        # z planes, the planes beyond the bottom of the grid are not needed
+        iz0 = np.clip(np.floor(z/dz), 0, nz).astype(np.intp)
+        iz1 = np.clip(np.floor((z + s*uz)/dz), 0, nz).astype(np.intp)
+        up = iz1 >= iz0
+        segZ, tZ = self.crossings(
+            np.abs(iz1 - iz0), np.where(up, iz0 + 1, iz0),
+            np.where(up, 1, -1),
+            lambda i, k: (k*dz - z[i])/uz[i])
+        # r cylinders: rho**2(t) = a*t**2 + b*t + c falls to its minimum
+        # at tMin and rises after it
+        a = ux*ux + uy*uy
+        b = 2.0*(x*ux + y*uy)
+        c = x*x + y*y
+        moves = a > 0.0
+        safeA = np.where(moves, a, 1.0)
+        tMin = np.where(moves, np.clip(-b/(2.0*safeA), 0.0, s), 0.0)
+        ring = lambda t: np.minimum(np.floor(np.sqrt(np.maximum(
+            a*t*t + b*t + c, 0.0))/dr), nr).astype(np.intp)
+        ir0, irMin, ir1 = ring(0.0), ring(tMin), ring(s)
+        def root(sign):
+            def value(i, k):
+                R = k*dr
+                d = np.sqrt(np.maximum(b[i]**2 - 4.0*a[i]*(c[i] - R*R),
+                                       0.0))
+                return (-b[i] + sign*d)/(2.0*safeA[i])
+            return value
+        segIn, tIn = self.crossings(np.where(moves, ir0 - irMin, 0), ir0,
+                                    -np.ones(n, dtype=np.intp), root(-1.0))
+        segOut, tOut = self.crossings(np.where(moves, ir1 - irMin, 0),
+                                      irMin + 1, np.ones(n, dtype=np.intp),
+                                      root(1.0))
+        # all the cuts of every segment, in order
+        index = np.arange(n)
+        segment = np.concatenate((index, index, segZ, segIn, segOut))
+        t = np.concatenate((np.zeros(n), s, tZ, tIn, tOut))
+        t = np.clip(t, 0.0, s[segment])
+        order = np.lexsort((t, segment))
+        segment, t = segment[order], t[order]
+        piece = segment[1:] == segment[:-1]
+        i = segment[1:][piece]
+        length = (t[1:] - t[:-1])[piece]
+        middle = 0.5*(t[1:] + t[:-1])[piece]
+        px = x[i] + middle*ux[i]
+        py = y[i] + middle*uy[i]
+        pz = np.maximum(z[i] + middle*uz[i], 0.0)
+        self.addBins(self.binning(px*px + py*py, pz), w[i]*length)
+    
+    def flush(self):
+        if self.events:
+            events = np.array(self.events).T
+            self.events = []
+            self.addSegments(*events)
+
+class Instrumentation:
+    """
+    event counters and sampled phase timings of the photon transport.
+    made by model.enableInstrumentation(), which swaps the photon class of
+    the model for a subclass that counts (and times) every call of the
+    transport phases. the plain Photon class is not changed, so there is
+    no overhead when the instrumentation is off.
+
+        counts: {phase: list of calls per layer} for every phase, plus
+                the boundary events (see events)
+        calls: {phase: total number of calls}
+        sampled: {phase: number of timed calls}
+        seconds: {phase: time spent in the timed calls [s]}
+        sampleEvery: one call out of every sampleEvery calls of a phase
+                is timed
+        photons: number of photons launched
+    """
+    # methods of Photon that are counted and timed
+    phases = ("hopDropSpinTissue", "hopDropSpinGlass", "stepSizeTissue",
+              "boundaryHit", "hop", "drop", "spin", "newLayerCheck",
+              "recordReduce", "roulette")
+    # outcomes of boundaryHit and newLayerCheck (counted per layer)
+    # (with partial reflection a packet leaving through a surface in part
+    # stays in the tissue, a partial escape, and is not a reflection)
+    events = ("boundary hits", "total internal reflections", "reflections",
+              "transmissions", "escapes", "partial escapes")
+    
+    def __init__(self, numberOfLayers, sampleEvery=100):
+        self.sampleEvery = sampleEvery
+        self.photons = 0
+        self.counts = {}
+        for name in self.phases + self.events:
+            self.counts[name] = [0]*(numberOfLayers+2)
+        self.calls = dict.fromkeys(self.phases, 0)
+        self.sampled = dict.fromkeys(self.phases, 0)
+        self.seconds = dict.fromkeys(self.phases, 0.0)
+    
+    def photonClass(self, base):
+        # subclass of the photon class base with every phase wrapped
+        methods = {}
+        for phase in self.phases:
+            methods[phase] = self.wrap(phase, getattr(base, phase))
+        launch = base.launchPhoton
+        def launchPhoton(photon, model):
+            self.photons += 1
+            launch(photon, model)
+        methods["launchPhoton"] = launchPhoton
+        # counting does not change the transport (see model.describe)
+        methods["instrumented"] = True
+        return type("Instrumented" + base.__name__, (base,), methods)
+    
+    def wrap(self, phase, method):
+        """
+        wrap a photon method so that every call is counted in the layer
+        the photon is in and one call out of every sampleEvery is timed
+        """
+        counts = self.counts[phase]
+        calls = self.calls
+        sampled = self.sampled
+        seconds = self.seconds
+        every = self.sampleEvery
+        clock = time.perf_counter
+        if phase == "boundaryHit":
+            hits = self.counts["boundary hits"]
+        elif phase == "newLayerCheck":
+            tir = self.counts["total internal reflections"]
+            reflections = self.counts["reflections"]
+            transmissions = self.counts["transmissions"]
+            escapes = self.counts["escapes"]
+            partialEscapes = self.counts["partial escapes"]
+            exits = self.calls # calls of recordReduce (an exit)
+        def wrapper(photon, *args):
+            layer = photon.layer
+            counts[layer] += 1
+            calls[phase] += 1
+            if phase == "newLayerCheck": # check for total internal
+                model = args[0]          # reflection before the call
+                uz = photon.uz
+                if abs(uz) <= model.cosCrit[layer][0 if uz < 0.0 else 1]:
+                    tir[layer] += 1
+                exited = exits["recordReduce"]
+            if calls[phase] % every == 0:
+                start = clock()
+                result = method(photon, *args)
+                seconds[phase] += clock() - start
+                sampled[phase] += 1
+            else:
+                result = method(photon, *args)
+            if phase == "boundaryHit" and result:
+                hits[layer] += 1
+            elif phase == "newLayerCheck":
+                if photon.dead:
+                    escapes[layer] += 1
+                elif exits["recordReduce"] != exited:
+                    partialEscapes[layer] += 1
+                elif photon.layer != layer:
+                    transmissions[layer] += 1
+                else:
+                    reflections[layer] += 1
+            return result
+        wrapper.__name__ = phase
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+    
+    def estimatedSeconds(self, phase):
+        # estimated total time of a phase from the timed calls
+        if self.sampled[phase] == 0:
+            return 0.0
+        return self.seconds[phase]/self.sampled[phase]*self.calls[phase]
+    
+    def summary(self):
+        """
+        dictionary with the counts per photon (total and per layer) and the
+        estimated time of every phase
+        """
+        photons = max(self.photons, 1)
+        summary = {"photons": self.photons, "perPhoton": {}, "perLayer": {},
+                   "seconds": {}}
+        for name, counts in self.counts.items():
+            summary["perPhoton"][name] = sum(counts)/photons
+            summary["perLayer"][name] = list(counts)
+        for phase in self.phases:
+            summary["seconds"][phase] = self.estimatedSeconds(phase)
+        return summary
+    
+    def report(self):
+        # text table of the events per photon and the phase timings
+        photons = max(self.photons, 1)
+        lines = ["photons launched: %d" % self.photons,
+                 "%-28s %12s %12s" % ("event", "per photon", "time [s]")]
+        for name in self.phases + self.events:
+            if name in self.seconds:
+                seconds = "%12.4f" % self.estimatedSeconds(name)
+            else:
+                seconds = "%12s" % "-"
+            lines.append("%-28s %12.3f %s" % (name,
+                                              sum(self.counts[name])/photons,
+                                              seconds))
+        lines.append("per layer (1 to %d):" % (len(self.counts["spin"])-2))
+        for name in self.phases + self.events:
+            counts = self.counts[name][1:-1]
+            if sum(counts):
+                lines.append("%-28s %s" % (name, " ".join(
+                    "%.3f" % (count/photons) for count in counts)))
+        return "\n".join(lines)
+
 class model:
     """
     monte carlo multi-layer (MCML) simulation for a given tissue structure.
@@ -56,6 +418,9 @@ class model:
     
     these variables (output) are used for storing the simulation data--
         numberOfPhotons: number of photons
+        scaledTallies: true once computeAndScaleArraySums has scaled the
+                tallies in place. they are not raw any more, so running,
+                merging, rawTallies and scaled refuse them (ValueError)
         Rsp: specular reflectance
         Rd: total diffuse reflectance
         A: total absorption probability
@@ -68,11 +433,97 @@ class model:
         A_l: each layer's absorption probability
         Phi_rz: fluence [1/cm**2]
         Phi_z: 1D probability density over z of fluence [-]
+        L_rz: weighted track length over r & z, raw [cm] (only with the
+                track length fluence estimator)
         Tt_ra: 2D distribution of total transmittance [1/(cm**2 sr)]
         Tt_r: 1D radial distribution of transmittance [1/cm**2]
         Tt_a: 1D angular distribution of transmittance [1/sr]
+        A_over, Rd_over, Tt_over: weight beyond the grid per photon (only
+                with overflow). A_over has one element per z bin beyond
+                the radius of the grid and a last one for everything below
+                the grid, Rd_over and Tt_over one per angle bin beyond the
+                radius of the grid
+        L_over: track length beyond the grid like A_over, raw like L_rz
+        E: weight of the packets terminated outside the domain per photon
+                (only with a domain)
+
+    these keywords (optional) set the roulette and boundary policy of the
+    model. they default to the module level constants--
+        W_th: threshold weight for roulette. either a number, a list with
+                one threshold per layer (index 1 to numberOfLayers, same
+                indexing as layers) or a function of depth z [cm]
+                returning the threshold
+        chance: chance of survival for roulette (M in the paper)
+        cosZero: limit used to determine nearly normal incidence
+        cos90: limit used to determine nearly parallel incidence
+        partialReflection: zero for OFF, one for the top and bottom surfaces,
+                two for the surfaces and the internal interfaces
+
+    these keywords (optional) set which tallies are kept and how they are
+    stored--
+        keep: names of the tallies (see tallies) that are allocated and
+                updated, e.g. ("Rd_ra", "A_rz") for pure reflectance and
+                absorption work. the outputs of the other tallies (and
+                their totals Rd, Tt or A) are None.
+                all tallies are kept by default
+        tallyDtype: dtype of the tallies, or {name: dtype}. float64 by
+                default. float32 halves the memory (the events of a flush
+                are summed in float64 before they are added). an integer
+                dtype stores fixed point weights in units of
+                fixedPointUnit; the sums are exact and do not depend on the
+                order of the events, and a tally about to overflow is
+                promoted to float64
+        fixedPointUnit: weight of one count of an integer tally
+        fluenceEstimator: "absorption" (Phi = A/mua, the default) or
+                "track length": every hop adds its length times the weight
+                of the packet to the (r, z) cells it crosses (tally L_rz)
+                and the fluence is L_rz over the cell volume. it has less
+                variance in weakly absorbing layers and works in layers
+                with mua = 0 (glass)
+        overflow: keep the weight beyond the grid (r >= nr*dr, z >= nz*dz)
+                out of the last bins, in the tallies A_over, Rd_over,
+                Tt_over (and L_over), so the edge bins only hold their own
+                weight. the 1D outputs over z and angle and the totals
+                include the overflow (A_l counts the absorption below the
+                grid in the layer at its bottom, as without overflow)
+        domain: (rMax, zMax) of the simulation domain [cm], either may be
+                None. packets that leave it are terminated and their weight
+                is added to the tally escaped (weight and number of
+                packets, output E), which saves the transport of packets
+                wandering far from the source. None (the default) for no
+                limit
+
+    roulette telemetry (output)--
+        rouletteSurvived: number of roulettes the packets survived
+        rouletteKilled: number of packets killed by roulette
+        belowThreshold: histogram of the number of steps each packet spent
+                below the threshold weight, {steps: packets}
+
+    these variables are used for hooking into the transport--
+        layerN, layerG, layerMua, layerMus, layerMut, layerGlass,
+        layerInclusion, layerPhase: flat property tables of the layers (buildTables)
+        photonClass: class used for the photon packets (Photon or a
+                subclass, see addPhotonMixin)
+        instrumentation: event counters and timings of the transport
+                (None unless enableInstrumentation is called)
     """
-    def __init__(self, structure, numberOfLayers):
+    # accumulated tallies of the transport (before scaling), see
+    # rawTallies. subclasses with more tallies add their names
+    tallies = ("Rd_ra", "Tt_ra", "A_rz")
+    # tallies accumulated from track segments (TrackBuffer) on the (r, z)
+    # grid. add-ons with such tallies extend it (on the model)
+    trackTallies = ("L_rz",)
+    # buffers of the tallies of add-ons with their own binning, {name:
+    # function of the model returning the buffer}. add-ons replace it (on
+    # the model) with an extended copy
+    bufferMakers = {}
+
+    def __init__(self, structure, numberOfLayers, W_th=WEIGHT, chance=M,
+                 cosZero=COSZERO, cos90=COS90,
+                 partialReflection=PARTIAL_REFLECTION, keep=None,
+                 tallyDtype=None, fixedPointUnit=2.0**-32,
+                 fluenceEstimator="absorption", overflow=False,
+                 domain=None):
         self.layers = structure # structure = mediumStructure, i.e. a list
                                 # of medium objects
         self.numberOfLayers = numberOfLayers
@@ -86,7 +537,33 @@ class model:
                                                    # a layer and second
                                                    # coordinate is the bottom
             z+=self.layers[i].z
-        self.W_th = WEIGHT
+        # roulette and boundary policy
+        self.W_th = W_th
+        self.W_thDepth = None # threshold as a function of depth
+        if callable(W_th):
+            self.W_thDepth = W_th
+            self.W_thLayer = None
+        elif np.ndim(W_th) == 0: # same threshold in every layer
+            self.W_thLayer = [W_th]*(self.numberOfLayers+2)
+        else: # one threshold per layer, pad the air layers
+            if len(W_th) != self.numberOfLayers:
+                raise ValueError("W_th needs one threshold per layer")
+            self.W_thLayer = [0.0] + list(W_th) + [0.0]
+        self.chance = chance
+        self.cosZero = cosZero
+        self.cos90 = cos90
+        self.partialReflection = partialReflection
+        # class used for the photon packets. subclasses of Photon can be
+        # used to count or record what happens to the packets
+        self.photonClass = Photon
+        # event counters and timings, see enableInstrumentation
+        self.instrumentation = None
+        # roulette telemetry
+        self.rouletteSurvived = 0
+        self.rouletteKilled = 0
+        self.belowThreshold = {}
+        # flat property tables used during the transport
+        self.buildTables()
         self.cosCrit = []
         self.cosCrit.append([0,0])
         for i in range(1, self.numberOfLayers+1):
@@ -112,6 +589,200 @@ class model:
                                 # no internal reflection exists
             self.cosCrit.append([cosCritTop, cosCritBott])
         # generate grid and step size 
+        self.makeGrid()
+        # settings of the add-ons (enableX functions), {name: settings},
+        # part of the description of the model
+        self.addons = {}
+        # tallies that are kept and their dtypes
+        if keep is not None:
+            unknown = set(keep) - set(self.tallies)
+            if unknown:
+                raise ValueError("unknown tallies: " + ", ".join(unknown))
+            self.tallies = tuple(name for name in self.tallies
+                                 if name in keep)
+        # the track length estimator of the fluence has its own tally
+        if fluenceEstimator not in ("absorption", "track length"):
+            raise ValueError("unknown fluence estimator: " + fluenceEstimator)
+        self.fluenceEstimator = fluenceEstimator
+        self.fluenceTally = "A_rz"
+        if fluenceEstimator == "track length":
+            self.tallies = self.tallies + ("L_rz",)
+            self.fluenceTally = "L_rz"
+            self.addPhotonMixin(TrackLength)
+        # the weight beyond the grid (overflow tallies, see makeBuffers)
+        # and beyond the domain
+        self.overflow = overflow
+        self.domain = domain
+        if domain is not None:
+            rMax, zMax = domain
+            self.domainR2 = np.inf if rMax is None else rMax*rMax
+            self.domainZ = np.inf if zMax is None else zMax
+            self.tallies = self.tallies + ("escaped",)
+        self.tallyDtype = {}
+        for name in type(self).tallies + ("L_rz",):
+            if isinstance(tallyDtype, dict):
+                dtype = tallyDtype.get(name, np.float64)
+            else:
+                dtype = np.float64 if tallyDtype is None else tallyDtype
+            self.tallyDtype[name] = np.dtype(dtype)
+        self.tallyDtype["escaped"] = np.dtype(np.float64)
+        self.fixedPointUnit = fixedPointUnit
+        # initial photons sent through simulation
+        self.numberOfPhotons = 0
+        self.scaledTallies = False
+        # initialize the model grid arrays  
+        self.Rsp = self.calcSpecular()
+        # (tallies that are not kept and their outputs are None, the totals
+        # too, so a missing tally is not read as no light)
+        self.Rd = 0.0 if "Rd_ra" in self.tallies else None
+        self.A = 0.0 if "A_rz" in self.tallies else None
+        self.Tt = 0.0 if "Tt_ra" in self.tallies else None
+        self.Rd_ra = self.makeTally("Rd_ra", (self.nr, self.na))
+        self.Rd_r = self.makeOutput("Rd_ra", self.nr)
+        self.Rd_a = self.makeOutput("Rd_ra", self.na)
+        self.A_rz = self.makeTally("A_rz", (self.nr, self.nz))
+        self.A_z = self.makeOutput("A_rz", self.nz)
+        self.A_l = self.makeOutput("A_rz", numberOfLayers+2)
+        self.L_rz = self.makeTally("L_rz", (self.nr, self.nz))
+        self.Phi_rz = self.makeOutput(self.fluenceTally, (self.nr, self.nz))
+        self.Phi_z = self.makeOutput(self.fluenceTally, self.nz)
+        self.Tt_ra = self.makeTally("Tt_ra", (self.nr, self.na))
+        self.Tt_r = self.makeOutput("Tt_ra", self.nr)
+        self.Tt_a = self.makeOutput("Tt_ra", self.na)
+        self.escaped = self.makeTally("escaped", 2)
+        self.E = None if self.escaped is None else 0.0
+        self.makeBuffers()
+    
+    def makeTally(self, name, shape):
+        # zeroed tally with its dtype, None if the tally is not kept
+        if name not in self.tallies:
+            return None
+        return np.zeros(shape, dtype=self.tallyDtype[name])
+    
+    def makeOutput(self, name, shape):
+        # zeroed output computed from the tally name, None if it is not kept
+        if name not in self.tallies:
+            return None
+        return np.zeros(shape)
+    
+    def tallyUnit(self, name):
+        # weight of one count of a fixed point tally, None for float tallies
+        if self.tallyDtype[name].kind in "iu":
+            return self.fixedPointUnit
+        return None
+    
+    def tallyWeights(self, name):
+        # a tally as weights (fixed point tallies are converted to float64)
+        tally = getattr(self, name)
+        unit = self.tallyUnit(name)
+        if unit is None:
+            return tally
+        return tally*unit
+    
+    def promoteTally(self, buffer):
+        # turn the fixed point tally of the buffer into float64 weights
+        for name in self.tallies:
+            if getattr(self, name) is buffer.target:
+                weights = self.tallyWeights(name)
+                setattr(self, name, weights)
+                self.tallyDtype[name] = weights.dtype
+                buffer.target = weights
+                buffer.unit = None
+                return
+        raise ValueError("the buffer has no tally of the model")
+    
+    def makeBuffers(self):
+        # buffers of the absorption events of A_rz (r**2, z), the exit
+        # events of Rd_ra and Tt_ra (r**2, |uz|) and the track segments of
+        # the track tallies (e.g. L_rz). tallies that are not kept get a
+        # buffer that throws the events away
+        self.buffers = []
+        for name, binning in (("A_rz", self.binRZ), ("Rd_ra", self.binRA),
+                              ("Tt_ra", self.binRA)) + \
+                tuple((name, self.binRZ) for name in self.trackTallies):
+            if name not in self.tallies:
+                buffer = NullBuffer()
+            elif name in self.trackTallies:
+                buffer = TrackBuffer(getattr(self, name), binning, self.dr,
+                                     self.dz, unit=self.tallyUnit(name),
+                                     promote=self.promoteTally,
+                                     overflow=self.makeOverflow(name))
+            else:
+                buffer = EventBuffer(getattr(self, name), binning,
+                                     unit=self.tallyUnit(name),
+                                     promote=self.promoteTally,
+                                     overflow=self.makeOverflow(name))
+            if name in self.tallies:
+                self.buffers.append(buffer)
+            setattr(self, name + "Buffer", buffer)
+        for name, makeBuffer in self.bufferMakers.items():
+            if name in self.tallies:
+                buffer = makeBuffer(self)
+                self.buffers.append(buffer)
+            else:
+                buffer = NullBuffer()
+            setattr(self, name + "Buffer", buffer)
+    
+    def makeOverflow(self, name):
+        # overflow tally of the tally name on the grid (e.g. A_over of
+        # A_rz), made the first time. None without overflow
+        if not self.overflow:
+            return None
+        over = name.split("_")[0] + "_over"
+        if over not in self.tallies:
+            self.tallies = self.tallies + (over,)
+            self.tallyDtype[over] = np.dtype(np.float64)
+            size = self.na if name.endswith("_ra") else self.nz + 1
+            setattr(self, over, np.zeros(size))
+        return getattr(self, over)
+    
+    def binRZ(self, r2, z):
+        # flat indices into A_rz of events at r**2 and z, the last bins
+        # collect everything beyond the grid. with overflow the events
+        # beyond the grid get the indices size + iz (beyond the radius) and
+        # size + nz (below the grid)
+        ir = (np.sqrt(r2)/self.dr).astype(np.intp)
+        iz = (z/self.dz).astype(np.intp)
+        if not self.overflow:
+            return np.minimum(ir, self.nr - 1)*self.nz + \
+                np.minimum(iz, self.nz - 1)
+        size = self.nr*self.nz
+        return np.where(iz >= self.nz, size + self.nz,
+                        np.where(ir >= self.nr, size + iz,
+                                 ir*self.nz + iz))
+    
+    def binRA(self, r2, cosine):
+        # flat indices into Rd_ra and Tt_ra of exits at r**2 with the cosine
+        # |uz| of the exit angle. with overflow the exits beyond the radius
+        # of the grid get the indices size + ia
+        ir = (np.sqrt(r2)/self.dr).astype(np.intp)
+        ia = np.minimum((np.arccos(cosine)/self.da).astype(np.intp),
+                        self.na - 1)
+        if not self.overflow:
+            return np.minimum(ir, self.nr - 1)*self.na + ia
+        return np.where(ir >= self.nr, self.nr*self.na + ia,
+                        ir*self.na + ia)
+    
+    def bindTallies(self, arrays):
+        """
+        accumulate the tallies in the given arrays from now on, e.g. in
+        shared memory. arrays is {name: array} with names from tallies and
+        the shapes of the model's tallies. what was tallied so far is copied
+        into the arrays
+        """
+        self.flush()
+        for name, array in arrays.items():
+            tally = getattr(self, name)
+            if array.shape != tally.shape:
+                raise ValueError("tally %s has shape %s, expected %s"
+                                 % (name, array.shape, tally.shape))
+            array[...] = tally
+            setattr(self, name, array)
+        self.makeBuffers()
+    
+    def makeGrid(self):
+        # set the number of grid elements and the grid separations.
+        # models for other tissue (e.g. pulse oximetry) override this
         self.nz = 10
         self.nr = 30
         self.na = 30
@@ -121,32 +792,197 @@ class model:
         if self.layers[1].name == "fluence":
             self.nz = 200
             self.dz = 0.005
-        # initial photons sent through simulation
-        self.numberOfPhotons = 0
-        # initialize the model grid arrays  
-        self.Rsp = self.calcSpecular()
-        self.Rd = 0.0
-        self.A = 0.0
-        self.Tt = 0.0
-        self.Rd_ra = np.zeros((self.nr, self.na))
-        self.Rd_r = np.zeros(self.nr)
-        self.Rd_a = np.zeros(self.na)
-        self.A_rz = np.zeros((self.nr, self.nz))
-        self.A_z = np.zeros(self.nz)
-        self.A_l = np.zeros(numberOfLayers+2)
-        self.Phi_rz = np.zeros((self.nr, self.nz))
-        self.Phi_z = np.zeros(self.nz)
-        self.Tt_ra = np.zeros((self.nr, self.na))
-        self.Tt_r = np.zeros(self.nr)
-        self.Tt_a = np.zeros(self.na)
+    
+    def buildTables(self):
+        """
+        flatten the optical properties of the layers into lists indexed by
+        layer (including the air layers) for the transport. call again if
+        the layers are changed after the model is made
+        """
+        self.layerN = [layer.n for layer in self.layers]
+        self.layerG = [layer.g for layer in self.layers]
+        self.layerMua = [layer.mua for layer in self.layers]
+        self.layerMus = [layer.mus for layer in self.layers]
+        self.layerMut = [layer.mua + layer.mus for layer in self.layers]
+        # glass (or another clear medium) has no absorption or scattering
+        self.layerGlass = [layer.mua == 0 and layer.mus == 0
+                           for layer in self.layers]
+        # inclusion hooks of the tissue, None if the layer has none
+        self.layerInclusion = [getattr(layer, "inclusion", None)
+                               for layer in self.layers]
+        # tabulated phase functions, None for Henyey-Greenstein with g
+        self.layerPhase = [getattr(layer, "phase", None)
+                           for layer in self.layers]
     
     def run(self, photonsToLaunch):
+        self.checkRaw()
         for i in range(photonsToLaunch):
             self.numberOfPhotons+=1
             # print("new photon sent:", self.numberOfPhotons)
-            photon = Photon(self)
+            photon = self.photonClass(self)
             photon.launchPhoton(self)
+            for buffer in self.buffers:
+                if buffer.full():
+                    buffer.flush()
+        self.flush()
     
+    def addPhotonMixin(self, mixin):
+        """
+        add the methods of the class mixin to the photon class, e.g. to
+        record what happens to the packets. mixin overrides methods of
+        Photon and calls them with super(), so several mixins can be
+        combined. returns the new photon class
+        """
+        base = self.photonClass
+        self.photonClass = type(mixin.__name__ + base.__name__,
+                                (mixin, base),
+                                {"__module__": mixin.__module__,
+                                 "photonMixin": mixin})
+        return self.photonClass
+    
+    def enableInstrumentation(self, sampleEvery=100):
+        """
+        count the transport events per layer (spins, boundary hits, total
+        internal reflections, glass traversals, roulettes...) and time one
+        call out of every sampleEvery calls of each phase. the results are
+        in self.instrumentation, e.g. print(model.instrumentation.report())
+        after run()
+        """
+        self.instrumentation = Instrumentation(self.numberOfLayers,
+                                               sampleEvery)
+        self.photonClass = self.instrumentation.photonClass(self.photonClass)
+        return self.instrumentation
+    
+    def flush(self):
+        # add the buffered tally events to the arrays
+        for buffer in self.buffers:
+            buffer.flush()
+    
+    def threshold(self, layer, z):
+        # threshold weight for roulette in a given layer at depth z
+        if self.W_thDepth is None:
+            return self.W_thLayer[layer]
+        return self.W_thDepth(z)
+
+    def describe(self):
+        """
+        plain description of the model (layers, grid and policy) that can be
+        written as JSON, e.g. as metadata of exported results. each layer is
+        described by its tissue class and its number and string attributes
+        (and objects with a describe method, e.g. phase functions), the
+        add-ons by the settings they record in addons
+        """
+        layers = []
+        for layer in self.layers:
+            description = {"tissue": type(layer).__name__}
+            for key, value in sorted(vars(layer).items()):
+                if isinstance(value, (bool, int, float, str)) or \
+                    value is None:
+                    description[key] = value
+                elif isinstance(value, (list, tuple)) and \
+                    all(isinstance(v, (int, float)) for v in value):
+                    description[key] = list(value)
+                elif hasattr(value, "describe"):
+                    description[key] = value.describe()
+            layers.append(description)
+        # photon class without the instrumentation subclasses, wherever
+        # they are among the mixins (see addPhotonMixin)
+        photonClass = self.photonClass
+        mixins = []
+        while True:
+            if "instrumented" in vars(photonClass):
+                photonClass = photonClass.__bases__[0]
+            elif "photonMixin" in vars(photonClass):
+                mixins.append(photonClass.photonMixin)
+                photonClass = photonClass.__bases__[1]
+            else:
+                break
+        if mixins: # named like the classes made by addPhotonMixin
+            photonClass = mixins[0].__module__ + "." + "".join(
+                mixin.__name__ for mixin in mixins) + photonClass.__name__
+        else:
+            photonClass = photonClass.__module__ + "." + \
+                photonClass.__qualname__
+        if self.W_thDepth is None:
+            W_thDepth = None
+        else:
+            # the name of a function is the same for every lambda, so it
+            # is described by the digest of its values over the grid too
+            depths = np.linspace(0.0, self.nz*self.dz, 1001)
+            values = np.array([self.W_thDepth(z) for z in depths],
+                              dtype=float)
+            W_thDepth = getattr(self.W_thDepth, "__module__", "") + "." + \
+                getattr(self.W_thDepth, "__qualname__",
+                        repr(self.W_thDepth)) + \
+                " sha1=" + hashlib.sha1(values.tobytes()).hexdigest()
+        return {
+            "model": type(self).__module__ + "." + type(self).__name__,
+            "layers": layers,
+            "numberOfLayers": self.numberOfLayers,
+            "grid": {"nr": self.nr, "nz": self.nz, "na": self.na,
+                     "dr": self.dr, "dz": self.dz, "da": self.da},
+            "policy": {"W_th": None if self.W_thDepth is not None
+                                    else self.W_thLayer,
+                       "W_thDepth": W_thDepth,
+                       "chance": self.chance, "cosZero": self.cosZero,
+                       "cos90": self.cos90,
+                       "partialReflection": self.partialReflection,
+                       "overflow": self.overflow,
+                       "domain": None if self.domain is None
+                                 else list(self.domain)},
+            "photonClass": photonClass,
+            "tallies": list(self.tallies),
+            "tallyDtype": {name: self.tallyDtype[name].str
+                           for name in self.tallies},
+            "addons": self.addons,
+        }
+
+    def checkRaw(self):
+        # refuse tallies that computeAndScaleArraySums has scaled
+        if self.scaledTallies:
+            raise ValueError("the tallies of the model have been scaled by "
+                             "computeAndScaleArraySums")
+
+    def rawTallies(self):
+        """
+        copies of the accumulated tallies (see tallies) and counters before
+        scaling, {name: value}. with mergeTallies, results of runs of the
+        same configuration can be stored and added up
+        """
+        self.checkRaw()
+        self.flush()
+        raw = {name: np.array(self.tallyWeights(name), dtype=np.float64)
+               for name in self.tallies}
+        raw["numberOfPhotons"] = self.numberOfPhotons
+        raw["rouletteSurvived"] = self.rouletteSurvived
+        raw["rouletteKilled"] = self.rouletteKilled
+        raw["belowThreshold"] = dict(self.belowThreshold)
+        return raw
+
+    def mergeTallies(self, raw):
+        """
+        add the raw tallies of another run of the same configuration (from
+        rawTallies) to this model. the tallies must not have been scaled
+        """
+        self.checkRaw()
+        self.flush()
+        for name in self.tallies:
+            tally = getattr(self, name)
+            if raw[name].shape != tally.shape:
+                raise ValueError("tally %s has shape %s, expected %s"
+                                 % (name, raw[name].shape, tally.shape))
+            buffer = getattr(self, name + "Buffer", None)
+            if buffer is None:
+                tally += raw[name]
+            else: # handles fixed point tallies
+                buffer.addWeights(raw[name].reshape(-1))
+        self.numberOfPhotons += raw["numberOfPhotons"]
+        self.rouletteSurvived += raw["rouletteSurvived"]
+        self.rouletteKilled += raw["rouletteKilled"]
+        for steps, packets in raw["belowThreshold"].items():
+            self.belowThreshold[steps] = \
+                self.belowThreshold.get(steps, 0) + packets
+
     # calculate specular intial reflection at first tissue layer only
     # assume reflections inside tissue are diffuse
     def calcSpecular(self):
@@ -160,6 +996,87 @@ class model:
             r1 = r1 + ( ((1 - r1)**2) * r2 ) / (1 - r1*r2) 
         return r1
     
+    def scaled(self, name):
+        """
+        the output name (see the outputs above, e.g. "Rd", "Rd_r", "A_rz",
+        "Phi_z", "E") computed from the raw tallies with numpy, like
+        computeAndScaleArraySums but without changing the tallies, so it can
+        be called during a run. None if its tally is not kept. the tallies
+        must not have been scaled already
+        """
+        self.checkRaw()
+        self.flush()
+        N = self.numberOfPhotons
+        dArea = 2.0*np.pi*(np.arange(self.nr) + 0.5)*self.dr**2
+        angle = (np.arange(self.na) + 0.5)*self.da
+        dSolidAngle = 4.0*np.pi*np.sin(angle)*np.sin(0.5*self.da)
+        def overflow(name, size):
+            # overflow tally as weights, zeros without overflow
+            if name in self.tallies:
+                return getattr(self, name)
+            return np.zeros(size)
+        kind = name.split("_")[0]
+        if kind in ("Rd", "Tt") and name != kind + "_over":
+            if kind + "_ra" not in self.tallies:
+                return None
+            ra = self.tallyWeights(kind + "_ra")
+            over = overflow(kind + "_over", self.na)
+            if name == kind:
+                return float((ra.sum() + over.sum())/N)
+            if name == kind + "_ra":
+                return ra/(dArea[:, None]*(np.cos(angle)*dSolidAngle)*N)
+            if name == kind + "_r":
+                return ra.sum(axis=1)/(dArea*N)
+            if name == kind + "_a":
+                return (ra.sum(axis=0) + over)/(dSolidAngle*N)
+        elif name in ("A", "A_rz", "A_z", "A_l") or kind == "Phi":
+            tally = self.fluenceTally if kind == "Phi" else "A_rz"
+            if tally not in self.tallies:
+                return None
+            rz = self.tallyWeights(tally)
+            over = overflow(tally.split("_")[0] + "_over", self.nz + 1)
+            z = (rz.sum(axis=0) + over[:self.nz])/(self.dz*N)
+            if name == "A":
+                return float((rz.sum() + over.sum())/N)
+            if name == "A_l":
+                A_l = np.zeros(self.numberOfLayers + 2)
+                layer = [self.indexLayer(iz) for iz in range(self.nz)]
+                np.add.at(A_l, layer, z*self.dz)
+                A_l[layer[-1]] += over[self.nz]/N
+                return A_l
+            rz = rz/(dArea[:, None]*self.dz*N)
+            if tally == "A_rz" and kind == "Phi": # Phi = A/mua
+                mua = np.array([self.muaIz(iz) for iz in range(self.nz)])
+                rz = rz/mua
+                z = z/mua
+            return rz if name.endswith("_rz") else z
+        elif name in ("A_over", "Rd_over", "Tt_over"):
+            if name not in self.tallies:
+                return None
+            return getattr(self, name)/N
+        elif name == "E":
+            if self.escaped is None:
+                return None
+            return float(self.escaped[0]/N)
+        raise ValueError("unknown output: " + name)
+
+    def iterRun(self, total, batch, copyTallies=False):
+        """
+        run total photons in batches of batch photons and yield a Snapshot
+        after every batch, e.g. for live plots or convergence checks. the
+        snapshots read the tallies of the model when they are used (see
+        Snapshot), copyTallies=True gives every snapshot its own copy of the
+        raw tallies
+        """
+        start = time.perf_counter()
+        done = 0
+        while done < total:
+            photons = min(batch, total - done)
+            self.run(photons)
+            done += photons
+            yield Snapshot(self, time.perf_counter() - start, done,
+                           copyTallies)
+
 # need to sum the transmittance, reflectance, absorption arrays still
 # also scale the arrays
     
@@ -169,53 +1086,72 @@ class model:
         
         also scale reflectance and transmittance arrays
         """
+        self.checkRaw()
+        self.scaledTallies = True
+        # fixed point tallies become weights first
+        for name in self.tallies:
+            if self.tallyUnit(name) is not None:
+                setattr(self, name, self.tallyWeights(name))
         self.sumRT()
         self.scaleRT()
         self.sumA()
         self.scaleA()
         self.Fluence()
+        self.scaleOverflow()
         
         
     def sumRT(self):
-        # sum 2D arrays to get radial and angular probilities
+        # sum 2D arrays to get radial and angular probilities. tallies
+        # that are not kept (None) are skipped
+        if self.Rd_ra is not None:
+            self.Rd = self.sumRA(self.Rd_ra, self.Rd_r, self.Rd_a,
+                                 getattr(self, "Rd_over", None))
+        if self.Tt_ra is not None:
+            self.Tt = self.sumRA(self.Tt_ra, self.Tt_r, self.Tt_a,
+                                 getattr(self, "Tt_over", None))
+    
+    def sumRA(self, ra, r, a, over=None):
+        # sum the 2D array ra into the radial array r and the angular
+        # array a, returns the total. the overflow over (per angle, beyond
+        # the grid) is added to a and the total
         
         # radial arrays
         for ir in range(self.nr):
-            sumR = 0.0
-            sumT = 0.0
+            sum = 0.0
             for ia in range(self.na):
-                sumR += self.Rd_ra[ir, ia]
-                sumT += self.Tt_ra[ir, ia]
-            self.Rd_r[ir] = sumR
-            self.Tt_r[ir] = sumT
+                sum += ra[ir, ia]
+            r[ir] = sum
         
         # angular arrays
         for ia in range(self.na):
-            sumR = 0.0
-            sumT = 0.0
+            sum = 0.0
             for ir in range(self.nr):
-                sumR += self.Rd_ra[ir, ia]
-                sumT += self.Tt_ra[ir, ia]
-            self.Rd_a[ia] = sumR
-            self.Tt_a[ia] = sumT
+                sum += ra[ir, ia]
+            if over is not None:
+                sum += over[ia]
+            a[ia] = sum
         
         # scalars
-        sumR = 0.0
-        sumT = 0.0
+        sum = 0.0
         for ir in range(self.nr):
-            sumR += self.Rd_r[ir]
-            sumT += self.Tt_r[ir]
-        self.Rd = sumR
-        self.Tt = sumT  
+            sum += r[ir]
+        if over is not None:
+            sum += over.sum()
+        return sum
     
     def sumA(self):
         # sum 2D arrays to get radial and angular probilities
+        if self.A_rz is None: # not kept
+            return
         
-        # z array
+        # z array (with the overflow beyond the radius of the grid)
+        over = getattr(self, "A_over", None)
         for iz in range(self.nz):
             sum = 0.0
             for ir in range(self.nr):
                 sum += self.A_rz[ir, iz]
+            if over is not None:
+                sum += over[iz]
             self.A_z[iz] = sum
         
         # layer array
@@ -223,6 +1159,9 @@ class model:
         for iz in range(self.nz):
             sum += self.A_z[iz]
             self.A_l[self.indexLayer(iz)] += self.A_z[iz]
+        if over is not None: # below the grid
+            sum += over[self.nz]
+            self.A_l[self.indexLayer(self.nz - 1)] += over[self.nz]
         self.A = sum
         
     def indexLayer(self, iz):
@@ -236,6 +1175,11 @@ class model:
         return i
     
     def Fluence(self):
+        if self.fluenceEstimator == "track length":
+            self.trackLengthFluence()
+            return
+        if self.A_rz is None: # not kept
+            return
         for iz in range(self.nz):
             for ir in range(self.nr):
                 mua = self.muaIz(iz)
@@ -244,6 +1188,29 @@ class model:
                                                       # scaled, phi arrays
                                                       # should also be scaled
     
+    def trackLengthFluence(self):
+        # fluence from the weighted track length in every cell. L_rz
+        # itself is left raw
+        L_rz = self.L_rz # weights (see computeAndScaleArraySums)
+        over = getattr(self, "L_over", None)
+        for iz in range(self.nz):
+            sum = 0.0 if over is None else over[iz]
+            for ir in range(self.nr):
+                dArea = 2.0*np.pi*(ir+0.5)*(self.dr**2.0)
+                scale = dArea*self.dz*self.numberOfPhotons
+                self.Phi_rz[ir, iz] = L_rz[ir, iz]/scale
+                sum += L_rz[ir, iz]
+            self.Phi_z[iz] = sum/(self.dz*self.numberOfPhotons)
+    
+    def scaleOverflow(self):
+        # overflow tallies and the weight terminated outside the domain
+        # per photon
+        for name in ("A_over", "Rd_over", "Tt_over"):
+            if name in self.tallies:
+                getattr(self, name)[...] /= self.numberOfPhotons
+        if self.escaped is not None:
+            self.E = self.escaped[0]/self.numberOfPhotons
+    
     def muaIz(self, iz):
         # get mua at a given index iz
         i = 1       # index to layer
@@ -256,7 +1223,16 @@ class model:
         return mua
     
     def scaleRT(self):
-        # scale Rd and Tt array
+        # scale Rd and Tt array (the ones that are kept)
+        if self.Rd_ra is not None:
+            self.scaleRA(self.Rd_ra, self.Rd_r, self.Rd_a)
+            self.Rd /= self.numberOfPhotons
+        if self.Tt_ra is not None:
+            self.scaleRA(self.Tt_ra, self.Tt_r, self.Tt_a)
+            self.Tt /= self.numberOfPhotons
+    
+    def scaleRA(self, ra, r, a):
+        # scale a 2D array over r & alpha and its radial and angular arrays
         # more info given in paper.  too complicated to put here
         # dSolidAngle = 4.0*pi*sin[(ia + 0.5)*da]*sin[0.5*da]
         # dArea = 2.0*pi*(ir+0.5)*(dr**2.0)
@@ -271,16 +1247,14 @@ class model:
                                     np.sin(0.5*self.da)
                 scale = dArea*np.cos((ia+0.5)*self.da)*\
                     dSolidAngle*self.numberOfPhotons
-                self.Rd_ra[ir, ia] /= scale
-                self.Tt_ra[ir, ia] /= scale
+                ra[ir, ia] /= scale
         
         # scale radial arrays
         # divide by dArea*numberOfPhotons
         for ir in range(0,self.nr):
             dArea = 2.0*np.pi*(ir+0.5)*(self.dr**2.0)
             scale = (dArea*self.numberOfPhotons)
-            self.Rd_r[ir] /= scale
-            self.Tt_r[ir] /= scale
+            r[ir] /= scale
         
         # scale angular arrays
         # divide by dSolidAngle*numberOfPhoton
@@ -289,16 +1263,11 @@ class model:
                                 np.sin((ia+0.5)*self.da)*\
                                     np.sin(0.5*self.da)
             scale = dSolidAngle*self.numberOfPhotons
-            self.Rd_a[ia] /= scale
-            self.Tt_a[ia] /= scale
-        
-        # scale scalars
-        # divide by number of photons
-        scale = self.numberOfPhotons
-        self.Rd /= scale
-        self.Tt /= scale
+            a[ia] /= scale
     
     def scaleA(self):
+        if self.A_rz is None: # not kept
+            return
         # scale A_rz
         for iz in range(0,self.nz):
             for ir in range(self.nr):
@@ -319,6 +1288,40 @@ class model:
         # scale A
         self.A /=scale  
 
+class Snapshot:
+    """
+    state of a model after a batch of model.iterRun. the outputs (e.g.
+    snapshot.Rd, snapshot.Rd_r, snapshot.A_rz, see model.scaled) are
+    scaled from the raw tallies when they are read, so a snapshot costs
+    nothing until it is used. they are read from the model as it is then:
+    read them before the run goes on (the generator is resumed), or make
+    the snapshot with copyTallies=True to keep them
+
+        numberOfPhotons: photons of the model so far
+        photons: photons of this iterRun so far
+        elapsed: seconds since the start of iterRun
+        photonsPerSecond: photons of this iterRun per second
+    """
+    def __init__(self, model, elapsed, photons, copyTallies=False):
+        if copyTallies: # the raw tallies (as weights) on a shallow copy
+            raw = model.rawTallies()
+            model = copy.copy(model)
+            model.tallyDtype = dict(model.tallyDtype)
+            for name in model.tallies:
+                setattr(model, name, raw[name])
+                model.tallyDtype[name] = raw[name].dtype
+        self.model = model
+        self.numberOfPhotons = model.numberOfPhotons
+        self.photons = photons
+        self.elapsed = elapsed
+        self.photonsPerSecond = photons/elapsed if elapsed > 0.0 else 0.0
+
+    def __getattr__(self, name):
+        # outputs of the model, scaled when they are read
+        if name.startswith("_") or name == "model":
+            raise AttributeError(name)
+        return self.model.scaled(name)
+
 class Photon:
     """
     photon class for monte carlo scattering model. the z-axis is directed
@@ -336,14 +1339,16 @@ class Photon:
         layer: index to layer where the photon packet resides
         s: current step size [cm]
         s_rem: step size remaining after hitting a boundary [-]           
+        stepsBelow: number of steps spent below the threshold weight
+        branches: packets split off at internal interfaces waiting to be
+                    transported (partial reflection)
     """        
     def __init__(self, model):
         self.x = 0.0
         self.y = 0.0
         self.z = 0.0
         # if the first layer is glass
-        if (model.layers[1].mua == 0.0) \
-            and (model.layers[1].mus == 0.0):
+        if model.layerGlass[1]:
                 self.layer = 2      # skip to next layer
                 self.z = model.layerDepth[2][0]  # use z0 from the 
                                                        # next layer
@@ -357,31 +1362,67 @@ class Photon:
         self.layer = 1 # current layer # skip air
         self.s = 0
         self.s_rem = 0
+        self.stepsBelow = 0 # steps spent below the threshold weight
+        self.branches = [] # packets split off this photon, shared by
+                           # all packets of the photon
     
     # launch a photon to begin simulation
     def launchPhoton(self, model):
+        self.propagate(model)
+        # packets split off at internal interfaces (partial reflection)
+        while self.branches:
+            self.branches.pop().propagate(model)
+    
+    def propagate(self, model):
+        # transport the packet until it dies
+        domain = model.domain is not None
         while self.dead == False:
-            if (model.layers[self.layer].mua == 0) \
-                and (model.layers[self.layer].mus == 0): # check for glass layer
+            if model.layerGlass[self.layer]: # check for glass layer
                     self.hopDropSpinGlass(model)
             else:
                 self.hopDropSpinTissue(model)
                 # once photon weight is below the theshold weight,
                 # play roulette to see if photon dies or not
-            if self.dead == False and self.w < model.W_th:
-                self.roulette()
+            if domain and self.dead == False:
+                self.domainCheck(model)
+            if self.dead == False:
+                if self.w < model.threshold(self.layer, self.z):
+                    self.roulette(model)
+        # record how many steps the packet spent below the threshold weight
+        steps = self.stepsBelow
+        model.belowThreshold[steps] = model.belowThreshold.get(steps, 0) + 1
     
-    def roulette(self):
+    def domainCheck(self, model):
+        """
+        terminate the packet if it left the simulation domain (model keyword
+        domain), its weight is added to the tally escaped. called by
+        propagate after every step of any transport (tissue, glass, delta
+        tracking), at its end: an interaction site (after the drop), an
+        interface or a null collision. the domain is convex, so a path
+        whose steps all end inside it stays inside it
+        """
+        if self.x*self.x + self.y*self.y > model.domainR2 or \
+                self.z > model.domainZ:
+            model.escaped[0] += self.w
+            model.escaped[1] += 1
+            self.w = 0.0
+            self.dead = True
+
+    def roulette(self, model):
         """
         once the photon's weight drops below a certain theshold weight W_th,
         play roulette to see if it 'lives' or 'dies'
         """
+        self.stepsBelow += 1
         if self.w == 0.0:	# photon is dead by definition
             self.dead = True
-        elif np.random.random_sample() < M: # photon lives
-            self.w /= M
+            model.rouletteKilled += 1
+        elif np.random.random_sample() < model.chance: # photon lives
+            self.w /= model.chance
+            model.rouletteSurvived += 1
         else: # photon dies
             self.dead = True
+            model.rouletteKilled += 1
    
     def hopDropSpinGlass(self, model):
         # move the photon packet in glass layer.
@@ -413,14 +1454,20 @@ class Photon:
         when a boundary is hit, this function determines whether a photon
         is reflected internally or transmitted to a new layer
         (perhaps partially)
+
+        with partial reflection ON (partialReflection = 1) the photon is
+        split at the top and bottom surfaces: the transmitted weight
+        w*(1-r) is tallied and the reflected weight w*r stays in the tissue.
+        with partialReflection = 2 the photon is also split at internal
+        interfaces. the transmitted part continues as a new packet as long
+        as both parts are above the threshold weight, otherwise all-or-none
+        Fresnel is used
         """
-        
         uz = self.uz
         r = 0.0
         if uz < 0.0: # photon moving up
-                # refractive indices
-            n_i = model.layers[self.layer].n # current layer
-            n_t = model.layers[self.layer-1].n # new layer
+            newLayer = self.layer - 1
+            surface = (self.layer == 1) # leaving the tissue through the top
                 # determine reflectance r
             if (abs(uz) <= model.cosCrit[self.layer][0]): 
                 # it can be shown that uz <= cosCrit is the same
@@ -428,98 +1475,89 @@ class Photon:
                 # efficient than using trig functions
                 r = 1.0 # total internal reflection
             else:
-                r, uzNew = self.calcFresnel(n_i, n_t, abs(uz))
-            # photon may be partially reflected and partially transmitted
-            # instad of pure reflection and transmission at tissue surface
-            if PARTIAL_REFLECTION == 1:
-                if self.layer == 1 and r < 1.0: # if it's the first layer and
-                                                # partial reflection,
-                                                # some of photon can be
-                                                # leave tissue (die)
-                    self.uz = -uzNew # the part that is transmitted (dead)
-                    self.recordReduce(model,r) # record what leaves and update the
-                        # photon's weight. note: transmission through the first
-                        # layer is the same as reflection off of the top layer,
-                        # which is why the function here records reflectance R
-                    self.uz = -uz # the part that is reflected internally (alive)
-                elif np.random.random() > r: # transmitted to layer-1
-                    self.layer-=1
-                    self.ux *= n_i/n_t
-                    self.uy *= n_i/n_t
-                    self.uz = -uzNew
-                else:
-                    self.uz = -uz # internally reflected
-            # can't get partial reflection to work, so use this
-            else:
-                if np.random.random() > r:   # transmitted to layer-1
-                    if self.layer == 1:
-                        self.uz = -uzNew
-                        self.recordReduce(model, 0.0)
-                        self.dead = True
-                    else:
-                        self.layer -= 1
-                        self.ux *= n_i/n_t
-                        self.uy *= n_i/n_t
-                        self.uz = -uzNew
-                else: 						# reflected
-                    self.uz = -uz
-        
+                r, uzNew = self.calcFresnel(model.layerN[self.layer],
+                                            model.layerN[newLayer],
+                                            abs(uz),
+                                            model.cosZero, model.cos90)
+                uzNew = -uzNew # transmitted photon keeps moving up
         else: #photon moving down
-                # refractive indices
-            n_i = model.layers[self.layer].n # current layer
-            n_t = model.layers[self.layer+1].n # new layer
+            newLayer = self.layer + 1
+            surface = (self.layer == model.numberOfLayers) # leaving the
+                                                    # tissue through the bottom
                 # determine reflectance r
             if (abs(uz) <= model.cosCrit[self.layer][1]):
                 r = 1.0 # total internal reflection
             else:
-                r, uzNew = self.calcFresnel(n_i, n_t, uz)
-            # determine if photon is passing through last layer
-            # with partial reflectance/transmittance
-            if PARTIAL_REFLECTION == 1:
-                if self.layer == model.numberOfLayers \
-                    and r < 1.0:
-                        self.uz = uzNew # the part that is transmitted (dead)
-                        self.recordReduce(model,r) # transmission through the
-                            # bottom layer is seen as transmission, so the
-                            # function here records transmission T
-                        self.uz = -uz # the part that is reflected (alive)
-                elif np.random.random() > r: # transmitted to layer+1
-                    self.layer+=1
-                    self.ux *= n_i/n_t
-                    self.uy *= n_i/n_t
-                    self.uz = uzNew
-                else:
-                    self.uz = -uz # internally reflected
-            else:
-                if np.random.random() > r:   
-                    if self.layer == model.numberOfLayers: # transmitted out
-                        self.uz = uzNew
-                        self.recordReduce(model, 0.0)
-                        self.dead = True
-                    else:   # transmitted to layer+1
-                        self.layer += 1
-                        self.ux *= n_i/n_t
-                        self.uy *= n_i/n_t
-                        self.uz = uzNew
-                else: 						# reflected
-                    self.uz = -uz
-    
-    def calcFresnel(self, n1, n2, cosInc):
+                r, uzNew = self.calcFresnel(model.layerN[self.layer],
+                                            model.layerN[newLayer],
+                                            uz,
+                                            model.cosZero, model.cos90)
+        if r >= 1.0: # total internal reflection
+            self.uz = -uz
+        elif model.partialReflection >= 1 and surface:
+            # photon is partially reflected and partially transmitted
+            # instead of pure reflection or transmission at the surface
+            self.uz = uzNew # the part that is transmitted (leaves)
+            self.recordReduce(model, r) # record what leaves and update the
+                # photon's weight. note: transmission through the first
+                # layer is the same as reflection off of the top layer,
+                # which is why the function records reflectance R there
+            self.uz = -uz # the part that is reflected internally (alive)
+            if self.w == 0.0: # nothing reflected (index matched surface)
+                self.dead = True
+        elif model.partialReflection == 2 and r > 0.0 \
+            and r*self.w >= model.threshold(self.layer, self.z) \
+            and (1.0 - r)*self.w >= model.threshold(newLayer, self.z):
+                # split at an internal interface. the transmitted part
+                # becomes a new packet that is transported after this one
+                branch = copy.copy(self)
+                branch.w *= (1.0 - r)
+                branch.transmit(model, newLayer, uzNew)
+                self.branches.append(branch)
+                self.w *= r
+                self.uz = -uz # the part that is reflected (this packet)
+        elif self.uniform() > r:   # transmitted
+            if surface: # transmitted out of the tissue
+                self.uz = uzNew
+                self.recordReduce(model, 0.0)
+                self.dead = True
+            else: # transmitted to the new layer
+                self.transmit(model, newLayer, uzNew)
+        else: 						# reflected
+            self.uz = -uz
+    
+    def transmit(self, model, newLayer, uzNew):
+        """
+        refract the photon into the new layer
+
+            newLayer: index of the layer the photon enters
+            uzNew: directional cosine z after refraction
+        """
+        n_i = model.layerN[self.layer] # current layer
+        n_t = model.layerN[newLayer] # new layer
+        self.layer = newLayer
+        self.ux *= n_i/n_t
+        self.uy *= n_i/n_t
+        self.uz = uzNew
+    
+    def calcFresnel(self, n1, n2, cosInc, cosZero=COSZERO, cos90=COS90):
         """
         calculate fresnel reflectance.
         
             n1: refractive index of initial medium
             n2: refractive index of new medium
             cosInc: cosine of angle of incidence
+            cosZero: limit used to determine nearly normal incidence
+            cos90: limit used to determine nearly parallel incidence
         """
         if n1 == n2:			  	# same refractive indices
             cosTran = cosInc
             r = 0.0
-        elif abs(cosInc) > COSZERO:     # nearly normal incidence 
+        elif abs(cosInc) > cosZero:     # nearly normal incidence 
             cosTran = cosInc
             r = (n2-n1)/(n2+n1)
             r *= r
-        elif abs(cosInc) < COS90:      # nearly parallel incidence
+        elif abs(cosInc) < cos90:      # nearly parallel incidence
             cosTran = 0.0
             r = 1.0
         else:           # general case	
@@ -555,27 +1593,23 @@ class Photon:
         """
         x = self.x
         y = self.y
-        # get indices to store weight in array
-        ir = int( (x**2 + y**2)**0.5 / model.dr )
-        if ir > (model.nr - 1):
-            ir = (model.nr - 1)
-        ia = int(np.arccos(abs(self.uz))/model.da) 
-        if ia > (model.na - 1):
-            ia = model.na - 1
         # function only called when photon passes through tissue surface from
-        # within. if it passes through the first layer = 1, it is reflection.
-        # otherwise, it must be passing through the last layer,
-        # so it is transmission
-        if self.layer == 1: # reflection 
-            # assign dw to the reflection array in the given indices
-            model.Rd_ra[ir, ia] += self.w*(1.0 - reflectance)
-            # update weight
-            self.w *= reflectance
+        # within. if it leaves moving up (through the first layer), it is
+        # reflection. otherwise, it must be passing through the last layer,
+        # so it is transmission. the direction is used rather than the layer
+        # so that a single layer model records both.
+        # the exit events are buffered (r**2, |uz|, dw) and binned and added
+        # to the arrays in bulk
+        if self.uz < 0.0: # reflection 
+            # assign dw to the reflection array
+            model.Rd_raBuffer.events.append((x*x + y*y, abs(self.uz),
+                                             self.w*(1.0 - reflectance)))
         else: # transmission
-            # assign dw to the transmission array in the given indices
-            model.Tt_ra[ir, ia] += self.w*(1.0 - reflectance)
-            # update weight
-            self.w *= reflectance
+            # assign dw to the transmission array
+            model.Tt_raBuffer.events.append((x*x + y*y, abs(self.uz),
+                                             self.w*(1.0 - reflectance)))
+        # update weight
+        self.w *= reflectance
             
 
     def hopDropSpinTissue(self, model):
@@ -594,15 +1628,14 @@ class Photon:
         else:
             self.hop()
             self.drop(model)
-            self.spin(model.layers[self.layer].g)
+            self.spin(model.layerG[self.layer], model.cosZero,
+                      model.layerPhase[self.layer])
    
     def stepSizeTissue(self, model):
-        mua = model.layers[self.layer].mua
-        mus = model.layers[self.layer].mus
-        mut = mua + mus
+        mut = model.layerMut[self.layer]
         # pick a step size for a photon packet in tissue
         if self.s_rem == 0.0: # if no step remaining, make a new step
-          rand = np.random.random_sample()
+          rand = self.uniform()
           self.s = -np.log(rand)/mut
         else: # otherwise, use the remaining
 	        self.s = self.s_rem/mut
@@ -615,9 +1648,7 @@ class Photon:
         layer = self.layer
         z = self.z
         uz = self.uz
-        mua = model.layers[layer].mua
-        mus = model.layers[layer].mus
-        mut = mua + mus
+        mut = model.layerMut[layer]
         if uz != 0:
             if uz > 0.0: # photon moving down
                 d_b = (model.layerDepth[layer][1] - z)/uz
@@ -631,6 +1662,13 @@ class Photon:
                 hit = False
         return hit
     
+    def uniform(self):
+        # uniform random number in [0, 1) for the sampling decisions of the
+        # transport (step sizes, scattering angles, fresnel reflection).
+        # mixins can override it, e.g. with quasi-random numbers
+        # (scattering_qmc)
+        return np.random.random_sample()
+    
 # hop, drop, spin functions # FINALLY!!!!!!!!
     def hop(self):
         # move the photon
@@ -644,29 +1682,29 @@ class Photon:
         x = self.x
         y = self.y
         layer = self.layer
-        mua = model.layers[layer].mua
-        mus = model.layers[layer].mus
-        mut = mua + mus
-        # get indices to store weight in absorption arry A[r,z]
-        iz = int(self.z/model.dz)
-        if iz > (model.nz - 1):
-            iz = model.nz - 1
-        ir = int((x**2 + y**2)**0.5/model.dr)
-        if ir > (model.nr - 1):
-            ir = model.nr - 1
+        inclusion = model.layerInclusion[layer]
+        if inclusion is None:
+            mua = model.layerMua[layer]
+            mut = model.layerMut[layer]
+        else: # the tissue decides (e.g. the photon is in bone)
+            mua, mut = inclusion(self, model)
         # update photon weight.
         dw = self.w * mua/mut
         self.w -= dw
-        # assign dw to the absorption array in the given indices
-        model.A_rz[ir, iz] += dw
+        # assign dw to the absorption array A[r,z]. the event is buffered
+        # (r**2, z, dw) and binned and added to the array in bulk
+        model.A_rzBuffer.events.append((x*x + y*y, self.z, dw))
     
-    def spin(self, g):
+    def spin(self, g, cosZero=COSZERO, phase=None):
         """
         function used for determining the photon's new direction after 
         scattering by means of random sampling
         
             theta is the polar/deflection angle (0,pi)
             psi is the azimuthal angle (0,2pi)
+            cosZero: limit used to determine nearly normal incidence
+            phase: tabulated phase function sampled instead of
+                    Henyey-Greenstein with g (None for HG)
         """
         ux = self.ux
         uy = self.uy
@@ -674,10 +1712,12 @@ class Photon:
         # determine cosine and sine of theta
         # the following formulae for computing cosine with a random
         # variable are given in the paper
-        if g == 0.0: # isotropic medium
-            cosTheta = 2.0*np.random.random() - 1.0
+        if phase is not None: # tabulated phase function (alias table)
+            cosTheta = phase.cosine(self.uniform())
+        elif g == 0.0: # isotropic medium
+            cosTheta = 2.0*self.uniform() - 1.0
         else: # anisotropic medium
-            brack = (1 - g**2)/(1 - g + 2*g*np.random.random_sample()) # brack 
+            brack = (1 - g**2)/(1 - g + 2*g*self.uniform()) # brack 
                                         # is a term in brackets from the paper
                                         # it is just a placeholder to make
                                         # the code easier to read
@@ -689,14 +1729,14 @@ class Photon:
         sinTheta = (1.0 - cosTheta**2)**0.5
         # determine psi from random variable
         # compute cosine and sine
-        psi = 2.0*np.pi*np.random.random()
+        psi = 2.0*np.pi*self.uniform()
         cosPsi = np.cos(psi)
         if psi < np.pi:
             sinPsi = (1.0 - cosPsi**2)**0.5
         else:
             sinPsi = -(1.0 - cosPsi**2)**0.5
         # update photon direction
-        if np.fabs(uz) > COSZERO: # nearly normal incidence
+        if np.fabs(uz) > cosZero: # nearly normal incidence
             self.ux = sinTheta*cosPsi
             self.uy = sinTheta*sinPsi
             self.uz = cosTheta*np.sign(uz)
@@ -717,3 +1757,18 @@ class Photon:
 
 
 
+
+class TrackLength:
+    """
+    photon mixin of the track length fluence estimator (model keyword
+    fluenceEstimator="track length"). every hop is buffered as a track
+    segment of L_rz, carrying the weight of the packet during the hop
+    """
+    def __init__(self, model):
+        super().__init__(model)
+        self.trackBuffer = model.L_rzBuffer
+    
+    def hop(self):
+        self.trackBuffer.events.append((self.x, self.y, self.z, self.ux,
+                                        self.uy, self.uz, self.s, self.w))
+        super().hop()
@@ -0,0 +1,159 @@
+"""
+asyncio runs, for embedding simulations in an event loop (e.g. a web
+service) without blocking it. the photons are run in batches on a worker
+pool and the event loop only merges the results between batches--
+
+    pool = SimulationPool(8)
+    model = await runAsync(paperTest1(), 100000, 5000, pool,
+                           makeModel=paperTest1)
+
+    async for snapshot in iterRunAsync(model, 100000, 5000, pool,
+                                       makeModel=paperTest1):
+        print(snapshot.numberOfPhotons, snapshot.Rd)
+
+with makeModel (a function that can be pickled, like for runParallel) every
+batch runs on its own model in a worker process, on random stream (seed,
+batch), and its raw tallies are merged into the model; a run keeps up to
+concurrency batches in flight. without makeModel the batches run on the
+model itself in a worker thread, one at a time (the transport holds the
+GIL, so threads keep the loop responsive but don't add cores, and the
+batches of concurrent runs share numpy's global generator).
+
+many runs can share one bounded pool: every run waits for its own batches,
+so the workers are shared batch by batch between the runs. a cancelled run
+(task.cancel()) stops between batches and the model keeps the batches
+merged so far. a process batch can't be stopped once a worker has taken
+it: the batches of the run still waiting for a worker are cancelled, but
+those already started run to completion and hold their worker until then,
+and their results are dropped. a run has at most concurrency batches in
+flight, so that is what a cancelled run can leave behind. a thread batch
+runs on the model itself, so the cancelled run waits until it is done (and
+the model keeps it). batches should take at least a fraction of a second,
+since a process batch makes its model again, but not much longer than a
+cancelled run may keep the workers busy.
+"""
+
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from scattering import Snapshot
+from scattering_distributed import seedStream
+
+class SimulationPool:
+    """
+    bounded pool of workers shared by concurrent runs
+
+        workers: number of workers (default: one per CPU)
+        processes: worker processes (runs with makeModel) or threads
+    """
+    def __init__(self, workers=None, processes=True):
+        self.workers = workers or os.cpu_count() or 1
+        self.processes = processes
+        if processes:
+            self.executor = ProcessPoolExecutor(self.workers)
+        else:
+            self.executor = ThreadPoolExecutor(self.workers)
+
+    def close(self, wait=True):
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+# pools used when a run is given none, made on first use
+defaultPools = {}
+
+def defaultPool(processes):
+    # the shared default pool of processes or of threads
+    if processes not in defaultPools:
+        defaultPools[processes] = SimulationPool(processes=processes)
+    return defaultPools[processes]
+
+def runBatch(makeModel, photons, seed, stream):
+    # raw tallies of photons photons of a new model on random stream
+    # (seed, stream), in a worker process
+    seedStream(seed, stream)
+    model = makeModel()
+    model.run(photons)
+    return model.rawTallies()
+
+async def iterRunAsync(model, photons, batch, pool=None, makeModel=None,
+                       seed=0, concurrency=None):
+    """
+    run photons photons of the model in batches of batch photons on the
+    pool and yield a Snapshot (see model.iterRun) after every batch that is
+    merged. the batches of a process pool come from makeModel (see the
+    module) and merge in the order they finish
+
+        pool: SimulationPool (default: a shared pool of processes with
+                makeModel, of threads without)
+        seed: seed of the random streams of the process batches, use
+                another seed for another run of the same model
+        concurrency: batches of this run in flight (process pools,
+                default: the workers of the pool). when the run is
+                cancelled or closed, the batches already started run to
+                completion on their workers and are not merged
+    """
+    if pool is None:
+        pool = defaultPool(makeModel is not None)
+    if pool.processes and makeModel is None:
+        raise ValueError("a process pool needs makeModel")
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    sizes = [min(batch, photons - done) for done in range(0, photons, batch)]
+    done = 0
+    if not pool.processes:
+        for size in sizes:
+            future = loop.run_in_executor(pool.executor, model.run, size)
+            try:
+                await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # a thread can't be stopped: wait until its batch is done
+                # so nothing runs on the model once the run has ended
+                await asyncio.wait([future])
+                raise
+            done += size
+            yield Snapshot(model, time.perf_counter() - start, done)
+        return
+    concurrency = concurrency or pool.workers
+    pending = set()
+    stream = 0
+    try:
+        while stream < len(sizes) or pending:
+            while stream < len(sizes) and len(pending) < concurrency:
+                pending.add(loop.run_in_executor(
+                    pool.executor, runBatch, makeModel, sizes[stream], seed,
+                    stream))
+                stream += 1
+            finished, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in finished:
+                raw = future.result()
+                model.mergeTallies(raw)
+                done += raw["numberOfPhotons"]
+                yield Snapshot(model, time.perf_counter() - start, done)
+    finally: # cancelled, or the caller stopped iterating
+        # only the batches no worker has taken are cancelled, the others
+        # finish and their results are dropped
+        for future in pending:
+            future.cancel()
+
+async def runAsync(model, photons, batch, pool=None, makeModel=None, seed=0,
+                   concurrency=None, progress=None):
+    """
+    run photons photons of the model on the pool (see iterRunAsync) and
+    return the model with the raw tallies. progress, if given, is called
+    with every Snapshot (a coroutine function is awaited)
+    """
+    async for snapshot in iterRunAsync(model, photons, batch, pool,
+                                       makeModel, seed, concurrency):
+        if progress is not None:
+            result = progress(snapshot)
+            if asyncio.iscoroutine(result):
+                await result
+    return model
@@ -0,0 +1,243 @@
+"""
+benchmark of the MCML models. every configuration is run twice: once with
+the plain photon class to time the transport (photons per second) and the
+post-processing (computeAndScaleArraySums), and once with the model's
+instrumentation and tracemalloc switched on to get the number of events
+per photon and the peak memory. the results are printed as JSON so runs can be
+compared over time, e.g.
+
+    python scattering_benchmark.py --scale 0.5 --output bench.json
+
+with --convergence BATCHES every configuration is also run in batches with
+pseudo-random and quasi-random sampling (scattering_qmc) and the spread of
+Rd, Tt and A is reported with the gain (variance ratio, i.e. the factor on
+the photons saved for the same precision).
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import scattering as mcml
+import scattering_pulse_oximetry as pulseOx
+from scattering_hybrid import enableDiffusion
+from scattering_qmc import enableQuasiRandom
+from scattering_woodcock import graded, subdivide, enableDeltaTracking
+
+####### CONFIGURATIONS #######
+
+def paperTest1():
+    # table 1 in the paper (matched boundaries, g = 0.75)
+    air = mcml.medium("air", 1.0, 1.0, None, 0, 0)
+    test1 = mcml.medium("test 1", 1.0, 0.75, 0.01, 10.0, 90.0)
+    return mcml.model([air, test1, test1, air], 2)
+
+def paperTest2():
+    # table 2 in the paper (mismatched boundaries, isotropic scattering)
+    air = mcml.medium("air", 1.0, 1.0, None, 0, 0)
+    test2 = mcml.medium("test 2", 1.5, 0.0, 0.01, 10.0, 90.0)
+    return mcml.model([air, test2, test2, air], 2)
+
+def fluence():
+    # fig 4 in the paper (thick, highly scattering slab)
+    air = mcml.medium("air", 1.0, 1.0, None, 0, 0)
+    tissue = mcml.medium("fluence", 1.37, 0.9, 1.0, 0.1, 100.0)
+    return mcml.model([air, tissue, tissue, air], 2)
+
+def fluenceDomain():
+    # the fluence slab with a lateral domain of 1 cm, the packets beyond it
+    # are terminated (and the weight beyond the grid kept in overflow)
+    air = mcml.medium("air", 1.0, 1.0, None, 0, 0)
+    tissue = mcml.medium("fluence", 1.37, 0.9, 1.0, 0.1, 100.0)
+    return mcml.model([air, tissue, tissue, air], 2, overflow=True,
+                      domain=(1.0, None))
+
+def fluenceHybrid():
+    # the fluence slab with the hybrid monte carlo / diffusion mode
+    return enableDiffusion(fluence(), [1, 2])
+
+def gradedDermis(count, delta=False):
+    # dermis with a graded blood content cut into count sublayers over a
+    # deeper layer, optionally with delta tracking
+    air = mcml.medium("air", 1.0, 1.0, None, 0, 0)
+    dermis = graded("dermis", 1.4, 0.9, 0.1, lambda z: 1.0 + 40.0*z,
+                    ([0.0, 0.05, 0.1], [100.0, 200.0, 150.0]))
+    below = mcml.medium("below", 1.4, 0.9, 0.2, 0.5, 100.0)
+    structure = [air] + subdivide(dermis, count) + [below, air]
+    model = mcml.model(structure, len(structure) - 2)
+    if delta:
+        enableDeltaTracking(model)
+    return model
+
+def glassTop():
+    # glass slide on top of the table 1 slab
+    air = mcml.medium("air", 1.0, 1.0, None, 0, 0)
+    glass = mcml.medium("glass", 1.52, 0.0, 0.1, 0.0, 0.0)
+    test1 = mcml.medium("test 1", 1.37, 0.75, 0.01, 10.0, 90.0)
+    return mcml.model([air, glass, test1, test1, air], 3)
+
+def finger(wavelength):
+    # multi-layer finger of the pulse oximetry model [mm]
+    air = pulseOx.medium("air", 1.0, 1.0, None, 0, 0)
+    sc = pulseOx.skin("stratum corneum", 1.5, 0.86, 0.02, 0.0, 0.05, 0.98,
+                      wavelength, "diastole")
+    epidermis = pulseOx.skin("epidermis", 1.34, 0.8, 0.1, 0.0, 0.2, 0.98,
+                             wavelength, "diastole")
+    dermis = pulseOx.skin("dermis", 1.4, 0.9, 1.5, 0.05, 0.65, 0.98,
+                          wavelength, "diastole")
+    fat = pulseOx.Fat("fat", 1.44, 0.9, 2.0, wavelength)
+    muscle = pulseOx.Muscle("muscle", 1.37, 0.9, 5.0, wavelength)
+    structure = [air, sc, epidermis, dermis, fat, muscle, muscle, air]
+    return pulseOx.model(structure, len(structure)-2)
+
+# name: (function making the model, default number of photons)
+configurations = {
+    "table 1": (paperTest1, 5000),
+    "table 2": (paperTest2, 5000),
+    "fluence": (fluence, 200),
+    "fluence hybrid": (fluenceHybrid, 200),
+    "fluence domain 1 cm": (fluenceDomain, 200),
+    "glass top": (glassTop, 5000),
+    "graded 5 sublayers": (lambda: gradedDermis(5), 500),
+    "graded 100 sublayers": (lambda: gradedDermis(100), 500),
+    "graded 100 sublayers delta": (lambda: gradedDermis(100, True), 500),
+    "finger 660 nm": (lambda: finger(660), 200),
+    "finger 940 nm": (lambda: finger(940), 200),
+}
+
+####### BENCHMARK #######
+
+def benchmark(name, makeModel, photons, countPhotons):
+    """
+    benchmark one configuration and return the results as a dictionary
+
+        name: name of the configuration
+        makeModel: function returning a new model
+        photons: number of photons for the timing run
+        countPhotons: number of photons for the counting/memory run
+    """
+    # timing run
+    model = makeModel()
+    start = time.perf_counter()
+    model.run(photons)
+    transport = time.perf_counter() - start
+    start = time.perf_counter()
+    model.computeAndScaleArraySums()
+    scaling = time.perf_counter() - start
+    Rd, Tt, A = model.Rd, model.Tt, model.A
+
+    # counting and memory run (the model arrays are part of the peak)
+    tracemalloc.start()
+    model = makeModel()
+    events = model.enableInstrumentation().summary
+    model.run(countPhotons)
+    model.computeAndScaleArraySums()
+    peakMemory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    perPhoton = events()["perPhoton"]
+
+    return {
+        "name": name,
+        "photons": photons,
+        "transportSeconds": transport,
+        "photonsPerSecond": photons/transport,
+        "stepsPerPhoton": perPhoton["hopDropSpinTissue"] +
+                          perPhoton["hopDropSpinGlass"],
+        "boundaryHitsPerPhoton": perPhoton["newLayerCheck"],
+        "totalInternalReflectionsPerPhoton":
+            perPhoton["total internal reflections"],
+        "eventsPerPhoton": perPhoton,
+        "computeAndScaleArraySumsSeconds": scaling,
+        "peakMemoryBytes": peakMemory,
+        "Rd": Rd,
+        "Tt": Tt,
+        "A": A,
+    }
+
+def convergence(makeModel, photons, batches=8, methods=("sobol",
+                                                       "stratified")):
+    """
+    spread of Rd, Tt and A over batches of photons photons with
+    pseudo-random sampling and with every quasi-random method (every batch
+    is one randomization of the point set). returns {method: {"Rd": standard
+    deviation, ..., "gain": {"Rd": variance ratio, ...}}}, the gain is the
+    factor on the photons pseudo-random sampling needs for the same
+    precision
+    """
+    results = {}
+    for method in ("pseudo-random",) + tuple(methods):
+        values = []
+        for i in range(batches):
+            model = makeModel()
+            if method != "pseudo-random":
+                enableQuasiRandom(model, method, block=photons)
+            model.run(photons)
+            model.computeAndScaleArraySums()
+            values.append((model.Rd, model.Tt, model.A))
+        spread = np.std(values, axis=0, ddof=1)
+        results[method] = dict(zip(("Rd", "Tt", "A"), spread.tolist()))
+    pseudo = results["pseudo-random"]
+    for method in methods:
+        results[method]["gain"] = {
+            name: pseudo[name]**2/results[method][name]**2
+            if results[method][name] > 0.0 else None
+            for name in ("Rd", "Tt", "A")}
+    return results
+
+def runBenchmarks(names=None, scale=1.0, seed=0, batches=0):
+    """
+    run the benchmark over the configurations and return the JSON report
+
+        names: names of the configurations to run (all if None)
+        scale: factor on the default number of photons of a configuration
+        seed: seed of numpy's random generator
+        batches: batches of the convergence comparison of pseudo-random
+                and quasi-random sampling (none if 0)
+    """
+    if names is None:
+        names = list(configurations)
+    results = []
+    for name in names:
+        np.random.seed(seed)
+        makeModel, photons = configurations[name]
+        photons = max(1, int(photons*scale))
+        countPhotons = max(1, photons//10)
+        results.append(benchmark(name, makeModel, photons, countPhotons))
+        if batches:
+            results[-1]["convergence"] = convergence(makeModel, photons,
+                                                     batches)
+    return {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "seed": seed,
+        "configurations": results,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the MCML models")
+    parser.add_argument("--configs", nargs="*", choices=list(configurations),
+                        help="configurations to run (default: all)")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="factor on the default number of photons")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--convergence", type=int, default=0,
+                        metavar="BATCHES",
+                        help="compare pseudo-random and quasi-random "
+                             "sampling over this many batches")
+    parser.add_argument("--output", help="write the JSON report to a file")
+    args = parser.parse_args()
+    report = runBenchmarks(args.configs, args.scale, args.seed,
+                           args.convergence)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text + "\n")
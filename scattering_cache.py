@@ -0,0 +1,158 @@
+"""
+on-disk cache of raw model results. a result is stored under a hash of the
+model's configuration (model.describe(): layers, grid, roulette and boundary
+policy, photon class and tallies), so a model made again from the same
+layers finds it. asking for more photons than are cached only runs the
+missing photons and merges them in, e.g.
+
+    cache = ResultCache()
+    model = cache.run(makeModel(), 100000) # runs 100000 photons
+    model = cache.run(makeModel(), 150000) # loads them, runs 50000 more
+    model.computeAndScaleArraySums()
+
+the state of numpy's random generator is stored with every result and
+restored before a top-up, so the added photons continue the random stream of
+the cached ones instead of repeating it (and a result topped up in steps is
+the same as one run in one go). the caller's state of the generator is put
+back after a top-up.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+def configHash(model):
+    # sha256 of the canonical JSON description of the model
+    text = json.dumps(model.describe(), sort_keys=True,
+                      separators=(",", ":"))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def saveTallies(path, raw, randomState=None, metadata=None):
+    """
+    write raw tallies (model.rawTallies()) to an npz file. the file is
+    written next to path and renamed, so a reader never sees half a file.
+    metadata is an optional dictionary stored as JSON (see readMetadata)
+    """
+    arrays = {"tally_" + name: value for name, value in raw.items()
+              if isinstance(value, np.ndarray)}
+    steps = sorted(raw["belowThreshold"])
+    arrays["belowThresholdSteps"] = np.array(steps, dtype=np.int64)
+    arrays["belowThresholdPackets"] = np.array(
+        [raw["belowThreshold"][s] for s in steps], dtype=np.int64)
+    for name in ("numberOfPhotons", "rouletteSurvived", "rouletteKilled"):
+        arrays[name] = np.array(raw[name], dtype=np.int64)
+    if randomState is not None:
+        algorithm, keys, position, hasGauss, gauss = randomState
+        arrays["randomKeys"] = keys
+        arrays["randomState"] = np.array([position, hasGauss, gauss])
+    if metadata is not None:
+        arrays["metadata"] = np.array(json.dumps(metadata, sort_keys=True))
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temporary = tempfile.mkstemp(suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(handle, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+def loadTallies(path):
+    """
+    read raw tallies written by saveTallies. returns (raw, randomState),
+    randomState is None if none was stored
+    """
+    with np.load(path) as f:
+        raw = {name[len("tally_"):]: f[name] for name in f.files
+               if name.startswith("tally_")}
+        for name in ("numberOfPhotons", "rouletteSurvived",
+                     "rouletteKilled"):
+            raw[name] = int(f[name])
+        raw["belowThreshold"] = dict(zip(
+            f["belowThresholdSteps"].tolist(),
+            f["belowThresholdPackets"].tolist()))
+        randomState = None
+        if "randomKeys" in f.files:
+            position, hasGauss, gauss = f["randomState"]
+            randomState = ("MT19937", f["randomKeys"], int(position),
+                           int(hasGauss), float(gauss))
+    return raw, randomState
+
+def readMetadata(path):
+    # metadata stored with saveTallies, None if there is none
+    with np.load(path) as f:
+        if "metadata" not in f.files:
+            return None
+        return json.loads(str(f["metadata"]))
+
+class ResultCache:
+    """
+    cache of raw results in a directory, one npz file per configuration
+    (named by configHash) and a JSON file with the description of the
+    configuration next to it
+
+        directory: cache directory (made if needed)
+    """
+    def __init__(self, directory=".mcml_cache"):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, model):
+        return os.path.join(self.directory, configHash(model) + ".npz")
+
+    def cachedPhotons(self, model):
+        # number of photons cached for the configuration of the model
+        path = self.path(model)
+        if not os.path.exists(path):
+            return 0
+        with np.load(path) as f:
+            return int(f["numberOfPhotons"])
+
+    def load(self, model):
+        """
+        merge the cached result of the model's configuration into the model
+        (which should not have run yet). returns the stored random state,
+        None if nothing is cached
+        """
+        path = self.path(model)
+        if not os.path.exists(path):
+            return None
+        raw, randomState = loadTallies(path)
+        model.mergeTallies(raw)
+        return randomState
+
+    def store(self, model):
+        # store the raw tallies of the model (replacing the cached result)
+        path = self.path(model)
+        saveTallies(path, model.rawTallies(), np.random.get_state())
+        description = path[:-len(".npz")] + ".json"
+        if not os.path.exists(description):
+            with open(description, "w") as f:
+                json.dump(model.describe(), f, indent=2, sort_keys=True)
+
+    def run(self, model, photons):
+        """
+        give the model the result of at least photons photons: load what is
+        cached for its configuration and run (and cache) only the missing
+        photons. the tallies are left raw (not scaled)
+        """
+        randomState = self.load(model)
+        missing = photons - model.numberOfPhotons
+        if missing > 0:
+            if randomState is None: # nothing cached, the caller's stream
+                model.run(missing)
+                self.store(model)
+                return model
+            # continue the stream of the cached result and give the caller
+            # its own generator back
+            callerState = np.random.get_state()
+            try:
+                np.random.set_state(randomState)
+                model.run(missing)
+                self.store(model)
+            finally:
+                np.random.set_state(callerState)
+        return model
@@ -0,0 +1,246 @@
+"""
+one job run on many machines that share only a directory. the job is split
+into tasks of a fixed number of photons; every task has its own random
+stream (seed, stream) and writes a partial result file. the partial files
+are self-describing (raw tallies, photons, configuration hash and
+description, seed and stream), so they can be merged into one result by
+anyone, and duplicate streams are detected.
+
+the job directory holds--
+    job.json        the job: configuration hash and description, photons,
+                    photons per task and seed
+    todo/           one empty file per task that is still to be done
+    claimed/        tasks being run. a worker claims a task by renaming its
+                    file from todo/ to claimed/, which only one worker can do
+    partial/        the partial result of every finished task
+
+with a function making the model (e.g. one of the configurations of
+scattering_benchmark), on the first machine--
+    python scattering_distributed.py create job scattering_benchmark:paperTest1
+        --photons 100000 --task 1000
+then on every machine (as often as there are cores)--
+    python scattering_distributed.py work job scattering_benchmark:paperTest1
+and when the work is done--
+    python scattering_distributed.py merge job scattering_benchmark:paperTest1
+"""
+
+import argparse
+import glob
+import importlib
+import json
+import os
+import socket
+import time
+
+import numpy as np
+
+from scattering_cache import configHash, saveTallies, loadTallies, \
+    readMetadata
+
+def seedStream(seed, stream):
+    """
+    seed numpy's random generator for stream number stream of a job seeded
+    with seed. the streams of one seed are statistically independent
+    """
+    state = np.random.SeedSequence((seed, stream)).generate_state(4)
+    np.random.seed(state)
+
+####### PARTIAL RESULTS #######
+
+def writePartial(model, path, seed, stream):
+    """
+    write the raw tallies of the model with everything needed to merge them
+    (configuration hash and description, seed and stream)
+    """
+    metadata = {"configHash": configHash(model),
+                "description": model.describe(),
+                "seed": seed,
+                "stream": stream,
+                "numberOfPhotons": model.numberOfPhotons,
+                "host": socket.gethostname(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    saveTallies(path, model.rawTallies(), metadata=metadata)
+
+def runPartial(makeModel, photons, seed, stream, path):
+    # run photons photons on random stream (seed, stream) and write them
+    seedStream(seed, stream)
+    model = makeModel()
+    model.run(photons)
+    writePartial(model, path, seed, stream)
+    return model
+
+def mergePartials(model, paths, skipDuplicates=False):
+    """
+    add the partial results in paths to the model (made for the same
+    configuration, not run yet). raises ValueError if a partial result has
+    another configuration, or if two partial results come from the same
+    random stream (unless skipDuplicates, which keeps the first). returns
+    the list of (seed, stream) that were merged. the tallies are left raw
+    (not scaled)
+    """
+    expected = configHash(model)
+    merged = []
+    for path in sorted(paths):
+        metadata = readMetadata(path)
+        if metadata is None:
+            raise ValueError("%s is not a partial result" % path)
+        if metadata["configHash"] != expected:
+            raise ValueError("%s has another configuration (%s, expected "
+                             "%s)" % (path, metadata["configHash"], expected))
+        stream = (metadata["seed"], metadata["stream"])
+        if stream in merged:
+            if skipDuplicates:
+                continue
+            raise ValueError("%s repeats the random stream (seed %d, stream "
+                             "%d)" % ((path,) + stream))
+        raw, randomState = loadTallies(path)
+        model.mergeTallies(raw)
+        merged.append(stream)
+    return merged
+
+####### FILE QUEUE #######
+
+def createJob(directory, model, photons, photonsPerTask=1000, seed=0):
+    """
+    make the job directory for photons photons of the model's
+    configuration in tasks of photonsPerTask photons
+    """
+    for name in ("todo", "claimed", "partial"):
+        os.makedirs(os.path.join(directory, name), exist_ok=True)
+    tasks = []
+    for stream in range(0, -(-photons//photonsPerTask)):
+        tasks.append(min(photonsPerTask, photons - stream*photonsPerTask))
+    job = {"configHash": configHash(model), "description": model.describe(),
+           "photons": photons, "tasks": tasks, "seed": seed}
+    with open(os.path.join(directory, "job.json"), "w") as f:
+        json.dump(job, f, indent=2, sort_keys=True)
+    for stream in range(len(tasks)):
+        open(os.path.join(directory, "todo", "%06d" % stream), "w").close()
+    return job
+
+def readJob(directory):
+    with open(os.path.join(directory, "job.json")) as f:
+        return json.load(f)
+
+def claimTask(directory):
+    """
+    claim a task of the job, returns its stream number (None if no task is
+    left). renaming is atomic, so two workers never get the same task
+    """
+    worker = "%s-%d" % (socket.gethostname(), os.getpid())
+    for name in sorted(os.listdir(os.path.join(directory, "todo"))):
+        task = os.path.join(directory, "todo", name)
+        claim = os.path.join(directory, "claimed", name + "." + worker)
+        try:
+            # the time of the claim (see requeue) is stamped before the
+            # rename, which keeps it, so a claim is never seen with the
+            # time the task was put in todo
+            os.utime(task)
+            os.rename(task, claim)
+        except FileNotFoundError: # another worker was faster
+            continue
+        return int(name)
+    return None
+
+def work(directory, makeModel):
+    """
+    run tasks of the job until none is left. returns the number of tasks
+    this worker ran
+    """
+    job = readJob(directory)
+    if configHash(makeModel()) != job["configHash"]:
+        raise ValueError("the model does not have the configuration of the "
+                         "job in " + directory)
+    done = 0
+    while True:
+        stream = claimTask(directory)
+        if stream is None:
+            return done
+        path = os.path.join(directory, "partial", "%06d.npz" % stream)
+        runPartial(makeModel, job["tasks"][stream], job["seed"], stream,
+                   path)
+        for claim in glob.glob(os.path.join(directory, "claimed",
+                                            "%06d.*" % stream)):
+            os.remove(claim)
+        done += 1
+
+def requeue(directory, olderThan=3600.0):
+    """
+    put the tasks claimed more than olderThan seconds ago (e.g. by a
+    machine that went down) back in todo/. returns their stream numbers
+    """
+    streams = []
+    now = time.time()
+    for claim in glob.glob(os.path.join(directory, "claimed", "*")):
+        if now - os.path.getmtime(claim) > olderThan:
+            name = os.path.basename(claim).split(".")[0]
+            try:
+                os.rename(claim, os.path.join(directory, "todo", name))
+            except FileNotFoundError: # finished in the meantime
+                continue
+            streams.append(int(name))
+    return streams
+
+def status(directory):
+    # number of tasks to do, claimed and done
+    count = lambda name: len(os.listdir(os.path.join(directory, name)))
+    return {"todo": count("todo"), "claimed": count("claimed"),
+            "done": count("partial")}
+
+def merge(directory, makeModel):
+    """
+    merge the partial results of the job into a new model and scale it.
+    raises ValueError if tasks are missing or if a partial result is not a
+    task of the job (e.g. of another seed)
+    """
+    job = readJob(directory)
+    paths = glob.glob(os.path.join(directory, "partial", "*.npz"))
+    model = makeModel()
+    merged = set(mergePartials(model, paths))
+    # (seed, stream) of the tasks, a partial result of another seed is not
+    # one of them
+    expected = {(job["seed"], stream) for stream in range(len(job["tasks"]))}
+    if merged - expected:
+        raise ValueError("%d partial results are not tasks of the job"
+                         % len(merged - expected))
+    missing = expected - merged
+    if missing:
+        raise ValueError("%d tasks of the job are not done" % len(missing))
+    model.computeAndScaleArraySums()
+    return model
+
+def factory(text):
+    # function making the model from "module:function"
+    module, function = text.split(":")
+    return getattr(importlib.import_module(module), function)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="run one MCML job on many machines")
+    parser.add_argument("command",
+                        choices=["create", "work", "merge", "requeue",
+                                 "status"])
+    parser.add_argument("directory", help="job directory")
+    parser.add_argument("factory", nargs="?",
+                        help="function making the model, module:function")
+    parser.add_argument("--photons", type=int, default=100000)
+    parser.add_argument("--task", type=int, default=1000,
+                        help="photons per task")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--older", type=float, default=3600.0,
+                        help="requeue claims older than this [s]")
+    args = parser.parse_args()
+    if args.command == "create":
+        createJob(args.directory, factory(args.factory)(), args.photons,
+                  args.task, args.seed)
+    elif args.command == "work":
+        print("tasks done:", work(args.directory, factory(args.factory)))
+    elif args.command == "merge":
+        model = merge(args.directory, factory(args.factory))
+        print("photons:", model.numberOfPhotons)
+        print("Rsp:", model.Rsp, "Rd:", model.Rd, "A:", model.A,
+              "Tt:", model.Tt)
+    elif args.command == "requeue":
+        print("requeued:", requeue(args.directory, args.older))
+    else:
+        print(status(args.directory))
@@ -0,0 +1,303 @@
+"""
+export of the model tallies to chunked, compressed HDF5 (h5py) or Zarr
+(zarr) files, so the results of long runs and parameter sweeps are kept
+instead of living only on the model object. a file holds
+
+    raw/        the accumulated tallies (model.tallies, not scaled)
+    scaled/     every output of computeAndScaleArraySums (2D and 1D arrays
+                and the scalars, and the overflow outputs A_over, Rd_over,
+                Tt_over and E of the options that are used), computed with
+                model.scaled so the model keeps its raw tallies and can go
+                on running
+    snapshots/  optional batch snapshots appended during the run, one entry
+                along the first axis per snapshot
+    attributes  metadata: model.describe() as JSON, photons and Rsp
+
+the arrays are chunked, so a reader can open one slice lazily, e.g.
+
+    with openTally("run.h5", "scaled/A_rz") as A_rz:
+        profile = A_rz[10, :] # reads only the chunks of row 10
+
+h5py and zarr are optional; the one matching the file is imported when it is
+used.
+"""
+
+import copy
+import json
+
+import numpy as np
+
+# outputs of computeAndScaleArraySums
+SCALED_ARRAYS = ("Rd_ra", "Rd_r", "Rd_a", "Tt_ra", "Tt_r", "Tt_a", "A_rz",
+                 "A_z", "A_l", "Phi_rz", "Phi_z")
+SCALARS = ("Rsp", "Rd", "Tt", "A")
+# outputs of the overflow and domain options (only set when they are used)
+OVERFLOW = ("A_over", "Rd_over", "Tt_over", "E")
+
+def fileFormat(path):
+    # "hdf5" or "zarr" from the extension of the path
+    if path.endswith((".h5", ".hdf5")):
+        return "hdf5"
+    if path.endswith(".zarr"):
+        return "zarr"
+    raise ValueError("unknown file format (use .h5, .hdf5 or .zarr): "
+                     + path)
+
+def scaledCopy(model):
+    """
+    copy of the model with the outputs of computeAndScaleArraySums (from
+    model.scaled). the model itself is not changed, so this can be called
+    during a run. the outputs of tallies that are not kept and of overflow
+    and domain options that are not used are None. the tallies must not
+    have been scaled already (ValueError, see model.scaledTallies)
+    """
+    scaled = copy.copy(model)
+    for name in SCALED_ARRAYS + SCALARS + OVERFLOW:
+        if name == "Rsp":
+            continue
+        # None if not kept or if the option is not used (overflow)
+        setattr(scaled, name, model.scaled(name))
+    return scaled
+
+def chunkShape(shape, size=64):
+    # chunks of at most size elements along every axis
+    return tuple(max(1, min(n, size)) for n in shape)
+
+####### STORES #######
+
+class Hdf5Store:
+    """
+    store writing to an HDF5 file with h5py
+    """
+    def __init__(self, path, mode, compression="gzip", level=4):
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError("writing HDF5 files needs h5py "
+                              "(pip install h5py)")
+        self.file = h5py.File(path, mode)
+        self.compression = compression
+        self.level = level
+
+    def write(self, name, data, chunks):
+        if name in self.file:
+            del self.file[name]
+        data = np.asarray(data)
+        if data.ndim == 0:
+            self.file.create_dataset(name, data=data)
+            return
+        self.file.create_dataset(name, data=data, chunks=chunks,
+                                 compression=self.compression,
+                                 compression_opts=self.level)
+
+    def append(self, name, data, chunks):
+        # add data as a new entry along the first axis of the dataset name
+        data = np.asarray(data)
+        if name not in self.file:
+            self.file.create_dataset(name, shape=(0,) + data.shape,
+                                     maxshape=(None,) + data.shape,
+                                     dtype=data.dtype,
+                                     chunks=(1,) + chunks,
+                                     compression=self.compression,
+                                     compression_opts=self.level)
+        dataset = self.file[name]
+        dataset.resize(dataset.shape[0] + 1, axis=0)
+        dataset[-1] = data
+
+    def length(self, name):
+        return self.file[name].shape[0] if name in self.file else 0
+
+    def setAttributes(self, attributes):
+        for key, value in attributes.items():
+            self.file.attrs[key] = value
+
+    def close(self):
+        self.file.close()
+
+class ZarrStore:
+    """
+    store writing to a Zarr directory with zarr (default compressor)
+    """
+    def __init__(self, path, mode):
+        try:
+            import zarr
+        except ImportError:
+            raise ImportError("writing Zarr files needs zarr "
+                              "(pip install zarr)")
+        self.group = zarr.open_group(path, mode=mode)
+
+    def write(self, name, data, chunks):
+        data = np.asarray(data)
+        if data.ndim == 0:
+            chunks = None
+        self.group.create_dataset(name, data=data, chunks=chunks,
+                                  overwrite=True)
+
+    def append(self, name, data, chunks):
+        data = np.asarray(data)
+        if name not in self.group:
+            self.group.create_dataset(name, shape=(0,) + data.shape,
+                                      dtype=data.dtype,
+                                      chunks=(1,) + chunks)
+        self.group[name].append(data[np.newaxis], axis=0)
+
+    def length(self, name):
+        return self.group[name].shape[0] if name in self.group else 0
+
+    def setAttributes(self, attributes):
+        self.group.attrs.update(attributes)
+
+    def close(self):
+        pass # zarr writes every change directly
+
+####### EXPORTER #######
+
+class Exporter:
+    """
+    writes the tallies of a model to a file, see the module docstring.
+    can be used as a context manager--
+
+        with Exporter("run.h5") as exporter:
+            for batch in range(10):
+                model.run(1000)
+                exporter.appendSnapshot(model)
+            exporter.write(model)
+
+        path: file name ending in .h5/.hdf5 (HDF5) or .zarr (Zarr)
+        mode: "w" to start a new file, "a" to add to an existing one
+        chunk: largest chunk size along each axis
+    """
+    def __init__(self, path, mode="w", chunk=64):
+        self.path = path
+        self.format = fileFormat(path)
+        self.chunk = chunk
+        if self.format == "hdf5":
+            self.store = Hdf5Store(path, mode)
+        else:
+            self.store = ZarrStore(path, mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def metadata(self, model):
+        return {"model": json.dumps(model.describe()),
+                "numberOfPhotons": model.numberOfPhotons,
+                "Rsp": model.Rsp}
+
+    def write(self, model, scaled=True):
+        """
+        write the raw tallies, the scaled results (if scaled) and the
+        metadata of the model. a second call replaces the first. a model
+        scaled by computeAndScaleArraySums has no raw tallies left and is
+        refused (ValueError)
+        """
+        raw = model.rawTallies()
+        for name in model.tallies:
+            data = raw[name]
+            self.store.write("raw/" + name, data, chunkShape(data.shape,
+                                                             self.chunk))
+        if scaled:
+            result = scaledCopy(model)
+            for name in SCALED_ARRAYS:
+                data = getattr(result, name)
+                if data is None: # not kept
+                    continue
+                self.store.write("scaled/" + name, data,
+                                 chunkShape(data.shape, self.chunk))
+            for name in SCALARS:
+                data = getattr(result, name)
+                if data is None: # not kept
+                    continue
+                self.store.write("scaled/" + name, data, None)
+            for name in OVERFLOW:
+                data = getattr(result, name, None)
+                if data is None: # option not used
+                    continue
+                data = np.asarray(data)
+                self.store.write("scaled/" + name, data,
+                                 chunkShape(data.shape, self.chunk))
+        self.store.setAttributes(self.metadata(model))
+
+    def appendSnapshot(self, model):
+        """
+        append the current raw tallies and photon count of the model to the
+        snapshots. returns the index of the snapshot
+        """
+        raw = model.rawTallies()
+        for name in model.tallies:
+            data = raw[name]
+            self.store.append("snapshots/" + name, data,
+                              chunkShape(data.shape, self.chunk))
+        self.store.append("snapshots/numberOfPhotons",
+                          np.array(model.numberOfPhotons), ())
+        self.store.setAttributes(self.metadata(model))
+        return self.store.length("snapshots/numberOfPhotons") - 1
+
+    def close(self):
+        self.store.close()
+
+def exportModel(model, path, scaled=True):
+    # write the tallies and metadata of a model to a new file
+    with Exporter(path) as exporter:
+        exporter.write(model, scaled)
+
+def runWithSnapshots(model, photons, batch, path):
+    """
+    run photons photons in batches of batch photons, appending a snapshot to
+    the file after every batch and writing the final results at the end
+    """
+    with Exporter(path) as exporter:
+        for snapshot in model.iterRun(photons, batch):
+            exporter.appendSnapshot(model)
+        exporter.write(model)
+
+####### READING #######
+
+class openTally:
+    """
+    open one array of an exported file lazily. the h5py dataset or zarr
+    array is returned by the context manager; indexing it reads only the
+    chunks that are needed--
+
+        path: exported file
+        name: array in the file, e.g. "scaled/A_rz" or "snapshots/Rd_ra"
+    """
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        self.file = None
+
+    def __enter__(self):
+        if fileFormat(self.path) == "hdf5":
+            try:
+                import h5py
+            except ImportError:
+                raise ImportError("reading HDF5 files needs h5py "
+                                  "(pip install h5py)")
+            self.file = h5py.File(self.path, "r")
+            return self.file[self.name]
+        try:
+            import zarr
+        except ImportError:
+            raise ImportError("reading Zarr files needs zarr "
+                              "(pip install zarr)")
+        return zarr.open_group(self.path, mode="r")[self.name]
+
+    def __exit__(self, *exception):
+        if self.file is not None:
+            self.file.close()
+
+def readMetadata(path):
+    # metadata of an exported file, with the model description decoded
+    if fileFormat(path) == "hdf5":
+        import h5py
+        with h5py.File(path, "r") as f:
+            attributes = dict(f.attrs)
+    else:
+        import zarr
+        attributes = dict(zarr.open_group(path, mode="r").attrs)
+    attributes["model"] = json.loads(attributes["model"])
+    return attributes
@@ -0,0 +1,144 @@
+"""
+frequency-domain (modulated source) tallies. a source modulated at the
+frequency f gives a reflectance modulated at f with an amplitude and a
+phase lag, the fourier transform of the temporal point spread function
+(TPSF) at omega = 2*pi*f. instead of tallying a fine TPSF and transforming
+it after the run, with
+
+    enableFrequencyDomain(model, [100e6, 200e6, 400e6])
+
+every packet adds up its optical path (n times the length of every hop)
+and every exit adds w*exp(-i*omega*t), t = optical path/c, to the tallies
+Rd_fr and Tt_fr over frequency and r. the exits are buffered as (r**2,
+optical path, w) and the phasors of all the frequencies are computed and
+binned at once when the buffer is flushed, so more frequencies cost little
+more than a steady-state run. the tallies hold the real and the imaginary
+parts, shape (2, frequencies, nr), so they merge like the others
+(rawTallies, runParallel). frequencyDomain scales them and gives the
+amplitude and phase per radial bin.
+
+the path of a packet handed off to diffusion (scattering_hybrid) misses the
+time spent in the diffusion region.
+"""
+
+import numpy as np
+
+SPEED_OF_LIGHT = 2.99792458e10 # in vacuum [cm/s]
+
+class PhasorBuffer:
+    """
+    buffer of exit events (r**2, optical path, w) of a frequency-domain
+    tally, shape (2, frequencies, nr)
+
+        target: the tally (real and imaginary parts, updated in place)
+        omega: angular modulation frequencies over the speed of light
+                [rad/length unit of the model]
+        dr, nr: radial grid of the model
+        size: number of events held before the buffer should be flushed
+    """
+    def __init__(self, target, omega, dr, nr, size=1 << 16):
+        self.target = target
+        self.omega = omega
+        self.dr = dr
+        self.nr = nr
+        self.size = size
+        self.events = []
+
+    def full(self):
+        return len(self.events) >= self.size
+
+    def addArrays(self, r2, path, w):
+        # the phasors of every frequency, binned with one bincount. the
+        # last bin collects everything beyond the grid
+        ir = np.minimum((np.sqrt(r2)/self.dr).astype(np.intp), self.nr - 1)
+        phase = self.omega[:, None]*path[None, :]
+        frequencies = len(self.omega)
+        index = np.arange(frequencies)[:, None]*self.nr + ir[None, :]
+        offset = frequencies*self.nr # imaginary parts
+        weights = np.bincount(
+            np.concatenate((index.ravel(), offset + index.ravel())),
+            weights=np.concatenate(((w*np.cos(phase)).ravel(),
+                                    (-w*np.sin(phase)).ravel())),
+            minlength=self.target.size)
+        self.addWeights(weights)
+
+    def addWeights(self, weights):
+        # add a flat array of weights with the size of the target
+        self.target.reshape(-1)[:] += weights
+
+    def flush(self):
+        if self.events:
+            r2, path, w = np.array(self.events).T
+            self.events = []
+            self.addArrays(r2, path, w)
+
+class FrequencyDomain:
+    """
+    photon mixin (see model.addPhotonMixin) adding up the optical path of
+    the packet and buffering its exits for Rd_fr and Tt_fr
+    """
+    def __init__(self, model):
+        super().__init__(model)
+        self.opticalPath = 0.0 # [length unit of the model]
+        self.layerN = model.layerN
+
+    def hop(self):
+        self.opticalPath += self.layerN[self.layer]*self.s
+        super().hop()
+
+    def recordReduce(self, model, reflectance):
+        event = (self.x*self.x + self.y*self.y, self.opticalPath,
+                 self.w*(1.0 - reflectance))
+        if self.uz < 0.0: # reflection
+            model.Rd_frBuffer.events.append(event)
+        else: # transmission
+            model.Tt_frBuffer.events.append(event)
+        super().recordReduce(model, reflectance)
+
+def enableFrequencyDomain(model, frequencies, c=SPEED_OF_LIGHT):
+    """
+    accumulate the complex reflectance and transmittance at the modulation
+    frequencies [Hz] in the tallies Rd_fr and Tt_fr. c is the speed of
+    light in vacuum in the length unit of the model per second (e.g.
+    2.99792458e11 for a model in mm). call it before the run
+    """
+    if model.numberOfPhotons:
+        raise ValueError("the model has already run")
+    model.frequencies = np.asarray(frequencies, dtype=float).reshape(-1)
+    model.speedOfLight = c
+    model.addons["frequencyDomain"] = {
+        "frequencies": model.frequencies.tolist(), "speedOfLight": c}
+    omega = 2.0*np.pi*model.frequencies/c
+    makers = dict(model.bufferMakers)
+    for name in ("Rd_fr", "Tt_fr"):
+        model.tallyDtype[name] = np.dtype(np.float64)
+        setattr(model, name, np.zeros((2, len(omega), model.nr)))
+        makers[name] = lambda m, name=name: PhasorBuffer(
+            getattr(m, name), omega, m.dr, m.nr)
+    model.bufferMakers = makers
+    model.tallies = model.tallies + ("Rd_fr", "Tt_fr")
+    model.makeBuffers()
+    model.addPhotonMixin(FrequencyDomain)
+    return model
+
+def frequencyDomain(model, name="Rd_fr"):
+    """
+    scaled frequency-domain tally name ("Rd_fr" or "Tt_fr"), {name: value}--
+        frequencies: modulation frequencies [Hz]
+        complex: complex reflectance (transmittance) per frequency and
+                radial bin [1/cm**2], the DC term is Rd_r (Tt_r)
+        amplitude: its magnitude [1/cm**2]
+        phase: its phase lag [rad], in (-pi, pi]
+        total: complex value over all r, per frequency
+    the tallies of the model are left raw
+    """
+    model.flush()
+    tally = getattr(model, name)
+    value = tally[0] + 1j*tally[1]
+    N = model.numberOfPhotons
+    dArea = 2.0*np.pi*(np.arange(model.nr) + 0.5)*model.dr**2
+    complexValue = value/(dArea*N)
+    return {"frequencies": model.frequencies, "complex": complexValue,
+            "amplitude": np.abs(complexValue),
+            "phase": -np.angle(complexValue),
+            "total": value.sum(axis=1)/N}
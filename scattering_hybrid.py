@@ -0,0 +1,263 @@
+"""
+hybrid monte carlo / diffusion mode. in thick, highly scattering layers a
+packet takes many steps before it is absorbed or leaves the layer, while
+diffusion theory is accurate there. with
+
+    enableDiffusion(model, layers=[1, 2])
+
+a packet that has scattered minScatterings times in one of the layers
+(default five transport mean free paths, 5/(1-g), so its direction is
+randomized) and is more than margin (default two transport mean free
+paths) away from the layer's boundaries is handed off to the diffusion
+solution of that layer. the layer is a slab with extrapolated boundaries
+zb = 2AD, A from the refractive index step to the layers above and below
+(Groenhuis). the handoff
+
+    1. adds the weight absorbed in the layer, w*(1 - R - T), to A_rz at a
+       distance from the packet drawn from Gamma(2, 1/mueff) (the absorption
+       around a point source in an infinite medium) in a random direction
+    2. moves the packet, with weight w*(R + T), across the top (probability
+       R/(R + T)) or the bottom of the layer, at a lateral distance drawn
+       from the Farrell dipole profile of the flux through that plane, with
+       a Lambertian direction times the Fresnel transmission, refracted. out
+       of the tissue it is recorded in Rd/Tt, otherwise the transport
+       carries on in the next layer
+
+R and T are the fluxes through the top and bottom of the slab for an
+isotropic point source one transport mean free path ahead of the packet
+(exact for the 1D diffusion equation).
+
+error bound: the handoff is accurate when mua << mus' and the layer is a
+few 1/mueff thick. the validation script checks the fluence problem against
+the pure monte carlo result: Rd and A within 0.02 (absolute, fractions of
+the incident weight). the "fluence hybrid" configuration of the benchmark
+takes about 1/8 of the steps per photon of "fluence". layers with an
+inclusion (the bone in the muscle of the pulse oximetry model decides the
+properties at every drop) can't be handed off.
+"""
+
+import numpy as np
+
+def effectiveReflection(n):
+    # internal reflection of diffuse light at a relative index n (Groenhuis)
+    if n <= 1.0:
+        return 0.0
+    return -1.440/n**2 + 0.710/n + 0.668 + 0.0636*n
+
+class DiffusionRegion:
+    """
+    diffusion solution of one layer (or of neighbouring layers with the
+    same properties, first to last)
+
+        top, bottom: depth of the top and bottom of the region [cm]
+        mueff: effective attenuation coefficient [1/cm]
+        transportLength: transport mean free path 1/(mua + mus') [cm]
+        zb: extrapolation distances of the top and bottom [cm]
+        margin: smallest distance from the boundaries for a handoff [cm]
+        minScatterings: scatterings in the layer before a handoff
+    """
+    def __init__(self, layer, top, bottom, nAbove, nBelow,
+                 minScatterings=None, margin=None, rows=32, points=256):
+        musPrime = layer.mus*(1.0 - layer.g)
+        if layer.mua <= 0.0 or musPrime <= 0.0:
+            raise ValueError("diffusion needs an absorbing, scattering layer")
+        D = 1.0/(3.0*(layer.mua + musPrime))
+        self.transportLength = 1.0/(layer.mua + musPrime)
+        self.mueff = np.sqrt(layer.mua/D)
+        self.zb = []
+        for n in (nAbove, nBelow):
+            R_eff = effectiveReflection(layer.n/n)
+            self.zb.append(2.0*D*(1.0 + R_eff)/(1.0 - R_eff))
+        self.top = top
+        self.bottom = bottom
+        self.margin = 2.0/musPrime if margin is None else margin
+        if minScatterings is None:
+            minScatterings = int(np.ceil(5.0/(1.0 - layer.g)))
+        self.minScatterings = minScatterings
+        # radial profiles of the flux through the top (side 0) and the
+        # bottom (side 1) for a source at distance h, one row per h,
+        # sampled by inverse cdf
+        self.h = np.linspace(self.margin, max(bottom - top - self.margin,
+                                              self.margin), rows)
+        self.rho = []
+        self.cdf = []
+        for zb in self.zb:
+            rhos = []
+            cdfs = []
+            for h in self.h:
+                rhoMax = h + 10.0/self.mueff
+                rho = rhoMax*np.linspace(0.0, 1.0, points)**2
+                pdf = 2.0*np.pi*rho*self.farrell(rho, h, zb)
+                cdf = np.concatenate(([0.0], np.cumsum(
+                    0.5*(pdf[1:] + pdf[:-1])*np.diff(rho))))
+                rhos.append(rho)
+                cdfs.append(cdf/cdf[-1])
+            self.rho.append(rhos)
+            self.cdf.append(cdfs)
+
+    def farrell(self, rho, h, zb):
+        # flux through the plane at lateral distance rho from a point
+        # source at distance h (dipole with extrapolated boundary)
+        mu = self.mueff
+        z1 = h
+        z2 = h + 2.0*zb
+        r1 = np.sqrt(z1**2 + rho**2)
+        r2 = np.sqrt(z2**2 + rho**2)
+        return (z1*(mu + 1.0/r1)*np.exp(-mu*r1)/r1**2 +
+                z2*(mu + 1.0/r2)*np.exp(-mu*r2)/r2**2)/(4.0*np.pi)
+
+    def escape(self, z0):
+        """
+        fractions (R, T) of the weight of a point source at depth z0 below
+        the top that leave through the top and the bottom of the layer
+        """
+        mu = self.mueff
+        zbTop, zbBottom = self.zb
+        d = self.bottom - self.top
+        L = d + zbTop + zbBottom
+        # cosh(mu*zb)*sinh(mu*a)/sinh(mu*L) without overflow
+        def ratio(zb, a):
+            return np.cosh(mu*zb)*(np.exp(mu*(a - L)) -
+                                   np.exp(-mu*(a + L)))/(1.0 -
+                                                         np.exp(-2.0*mu*L))
+        R = ratio(zbTop, d + zbBottom - z0)
+        T = ratio(zbBottom, z0 + zbTop)
+        return R, T
+
+    def sampleRho(self, side, h):
+        # lateral distance of the exit through side for a source h from it
+        row = min(int(np.searchsorted(self.h, h)), len(self.h) - 1)
+        return float(np.interp(np.random.random_sample(),
+                               self.cdf[side][row], self.rho[side][row]))
+
+class DiffusionHandoff:
+    """
+    photon mixin (see model.addPhotonMixin) handing packets off to the
+    diffusion solution of model.diffusionRegions
+    """
+    def __init__(self, model):
+        super().__init__(model)
+        self.region = None
+        self.regionScatterings = 0
+
+    def hopDropSpinTissue(self, model):
+        super().hopDropSpinTissue(model)
+        region = model.diffusionRegions[self.layer]
+        if region is None or self.dead:
+            return
+        if region is not self.region: # new region, count again
+            self.region = region
+            self.regionScatterings = 0
+        if self.s_rem != 0.0: # on a boundary
+            return
+        self.regionScatterings += 1
+        if self.regionScatterings < region.minScatterings:
+            return
+        # the depth is only checked every minScatterings scatterings.
+        # handing off the first time the packet is deep enough would pick
+        # packets moving away from the boundary, which leave less often
+        # than the isotropic source of the diffusion solution
+        self.regionScatterings = 0
+        z0 = self.z - region.top
+        if z0 < region.margin or region.bottom - self.z < region.margin:
+            return
+        self.handoff(model, region)
+
+    def handoff(self, model, region):
+        model.handoffs += 1
+        # a packet moving in the direction u is, to first order, an
+        # isotropic source one transport mean free path further along u
+        length = region.transportLength
+        self.x += length*self.ux
+        self.y += length*self.uy
+        self.z = min(max(self.z + length*self.uz, region.top), region.bottom)
+        z0 = self.z - region.top
+        R, T = region.escape(z0)
+        # absorbed weight, at a Gamma(2, 1/mueff) distance
+        absorbed = self.w*max(0.0, 1.0 - R - T)
+        r = np.random.gamma(2.0, 1.0/region.mueff)
+        cosTheta = 2.0*np.random.random_sample() - 1.0
+        sinTheta = np.sqrt(1.0 - cosTheta**2)
+        phi = 2.0*np.pi*np.random.random_sample()
+        x = self.x + r*sinTheta*np.cos(phi)
+        y = self.y + r*sinTheta*np.sin(phi)
+        z = min(max(self.z + r*cosTheta, region.top), region.bottom)
+        model.A_rzBuffer.events.append((x*x + y*y, z, absorbed))
+        # the escaping weight leaves through the top or the bottom
+        self.w *= R + T
+        up = np.random.random_sample()*(R + T) < R
+        side = 0 if up else 1
+        h = z0 if up else region.bottom - region.top - z0
+        rho = region.sampleRho(side, h)
+        phi = 2.0*np.pi*np.random.random_sample()
+        self.x += rho*np.cos(phi)
+        self.y += rho*np.sin(phi)
+        self.z = region.top if up else region.bottom
+        self.regionScatterings = 0
+        # lambertian direction times the fresnel transmission (internal
+        # reflection is in zb), by rejection
+        self.layer = region.first if up else region.last
+        newLayer = self.layer - 1 if up else self.layer + 1
+        while True:
+            cosInc = np.sqrt(np.random.random_sample())
+            if cosInc <= model.cosCrit[self.layer][side]:
+                continue
+            r, cosTran = self.calcFresnel(model.layerN[self.layer],
+                                          model.layerN[newLayer], cosInc,
+                                          model.cosZero, model.cos90)
+            if np.random.random_sample() >= r:
+                break
+        sinInc = np.sqrt(1.0 - cosInc**2)
+        phi = 2.0*np.pi*np.random.random_sample()
+        self.ux = sinInc*np.cos(phi)
+        self.uy = sinInc*np.sin(phi)
+        self.uz = -cosInc if up else cosInc
+        uzNew = -cosTran if up else cosTran
+        if newLayer == 0 or newLayer == model.numberOfLayers + 1:
+            # out of the tissue
+            self.uz = uzNew
+            self.recordReduce(model, 0.0)
+            self.dead = True
+        else:
+            self.transmit(model, newLayer, uzNew)
+
+def enableDiffusion(model, layers, minScatterings=None, margin=None):
+    """
+    hand packets off to diffusion in the given layers (indices into
+    model.layers, 1 to numberOfLayers). neighbouring layers with the same
+    optical properties are one region. the number of handoffs is counted in
+    model.handoffs
+    """
+    model.diffusionRegions = [None]*len(model.layers)
+    layers = sorted(set(layers))
+    for i in layers:
+        if not 1 <= i <= model.numberOfLayers:
+            raise ValueError("layer %d is not a tissue layer" % i)
+        if model.layerInclusion[i] is not None:
+            # the tissue decides the properties at every drop (e.g. bone in
+            # the muscle of the pulse oximetry model), not the layer's
+            raise ValueError("layer %d has an inclusion" % i)
+    properties = lambda i: (model.layers[i].n, model.layers[i].g,
+                            model.layers[i].mua, model.layers[i].mus)
+    k = 0
+    while k < len(layers):
+        first = last = layers[k]
+        while k + 1 < len(layers) and layers[k+1] == last + 1 and \
+                properties(layers[k+1]) == properties(first):
+            k += 1
+            last = layers[k]
+        region = DiffusionRegion(model.layers[first],
+                                 model.layerDepth[first][0],
+                                 model.layerDepth[last][1],
+                                 model.layerN[first-1], model.layerN[last+1],
+                                 minScatterings, margin)
+        region.first, region.last = first, last
+        for i in range(first, last + 1):
+            model.diffusionRegions[i] = region
+        k += 1
+    model.addons["diffusion"] = {"layers": layers,
+                                 "minScatterings": minScatterings,
+                                 "margin": margin}
+    model.handoffs = 0
+    model.addPhotonMixin(DiffusionHandoff)
+    return model
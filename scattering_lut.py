@@ -0,0 +1,258 @@
+"""
+reflectance lookup tables (LUT) and fitting of optical properties. a LUT is
+built by running the model on every point of a grid of (mua, mus, g,
+thickness) in a process pool and stored as .npy files with a JSON index in
+a directory. the LUT is opened with memory mapping, so a session only reads
+the pages it uses, and is interpolated (multilinear, with gradients) in
+microseconds instead of running the model--
+
+    buildLut("lut", slab, {"mua": [0.1, 0.5, 1, 2, 5],
+                           "mus": [50, 100, 150, 200],
+                           "g": [0.8, 0.9], "thickness": [0.5, 1.0]}, 10000)
+    lut = Lut("lut")
+    Rd_r, gradient = lut.interpolate((0.7, 120.0, 0.9, 1.0))
+    fit = lut.fit(measured, {"g": 0.9, "thickness": 1.0})
+
+the directory holds Rd_r.npy (one radial profile per grid point, the last
+axis is r), Rd.npy, done.npy (points that are finished, so an interrupted
+build can be continued) and index.json (axes, radii and settings).
+"""
+
+import argparse
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import scattering as mcml
+from scattering_distributed import seedStream
+
+AXES = ("mua", "mus", "g", "thickness")
+
+def slab(mua, mus, g, thickness, n=1.4):
+    # single layer of tissue under air (default model of a LUT)
+    air = mcml.medium("air", 1.0, 1.0, None, 0, 0)
+    tissue = mcml.medium("tissue", n, g, thickness, mua, mus)
+    return mcml.model([air, tissue, air], 1)
+
+def runPoint(makeModel, point, photons, seed, stream):
+    # scaled Rd_r and Rd of one grid point on random stream (seed, stream)
+    seedStream(seed, stream)
+    model = makeModel(*point)
+    model.run(photons)
+    model.computeAndScaleArraySums()
+    return model.Rd_r.copy(), model.Rd
+
+def buildLut(path, makeModel, axes, photons, processes=None, seed=0):
+    """
+    run the model on every point of the grid and store the LUT in the
+    directory path. points already done (done.npy) are skipped; a LUT in
+    path with other axes, radii, photons, seed or model is refused
+    (ValueError)
+
+        makeModel: function of (mua, mus, g, thickness) returning a model
+                with tissue thickness thick (layerDepth), it must be
+                picklable (defined at module level)
+        axes: {name: grid values} for every name in AXES, increasing
+        photons: photons per grid point
+        processes: number of worker processes (default: one per CPU)
+    """
+    values = [np.asarray(axes[name], dtype=float) for name in AXES]
+    for name, axis in zip(AXES, values):
+        if np.any(np.diff(axis) <= 0.0):
+            raise ValueError("the values of %s must increase" % name)
+    shape = tuple(len(axis) for axis in values)
+    # the tissue of the models must be as thick as their point says, at
+    # both ends of the grid
+    for point in ([axis[0] for axis in values],
+                  [axis[-1] for axis in values]):
+        model = makeModel(*point)
+        depth = model.layerDepth[-1][1]
+        if not np.isclose(depth, point[-1]):
+            raise ValueError("the model of thickness %g is %g thick"
+                             % (point[-1], depth))
+    model = makeModel(*[axis[0] for axis in values])
+    r = (np.arange(model.nr) + 0.5)*model.dr
+    os.makedirs(path, exist_ok=True)
+    index = {"axes": {name: axis.tolist() for name, axis
+                      in zip(AXES, values)},
+             "r": r.tolist(), "photons": photons, "seed": seed,
+             "model": model.describe()}
+    # a build is only continued with the same grid and settings
+    indexFile = os.path.join(path, "index.json")
+    if os.path.exists(indexFile):
+        with open(indexFile) as f:
+            stored = json.load(f)
+        for key in index:
+            # (through JSON, so tuples compare as the lists stored)
+            if json.loads(json.dumps(index[key])) != stored.get(key):
+                raise ValueError("the LUT in %s was built with other "
+                                 "settings (%s differ)" % (path, key))
+    files = {"Rd_r": shape + (model.nr,), "Rd": shape, "done": shape}
+    arrays = {}
+    for name, fileShape in files.items():
+        file = os.path.join(path, name + ".npy")
+        if os.path.exists(file):
+            arrays[name] = np.load(file, mmap_mode="r+")
+            if arrays[name].shape != fileShape:
+                raise ValueError("%s has another grid" % file)
+        else:
+            arrays[name] = np.lib.format.open_memmap(
+                file, mode="w+", shape=fileShape,
+                dtype=bool if name == "done" else np.float64)
+    with open(indexFile, "w") as f:
+        json.dump(index, f, indent=2)
+    todo = [i for i in np.ndindex(*shape) if not arrays["done"][i]]
+    with ProcessPoolExecutor(processes) as pool:
+        futures = {}
+        for i in todo:
+            point = tuple(axis[k] for axis, k in zip(values, i))
+            stream = int(np.ravel_multi_index(i, shape))
+            futures[i] = pool.submit(runPoint, makeModel, point, photons,
+                                     seed, stream)
+        for i, future in futures.items():
+            arrays["Rd_r"][i], arrays["Rd"][i] = future.result()
+            arrays["done"][i] = True
+    for array in arrays.values():
+        array.flush()
+
+class Lut:
+    """
+    a LUT written by buildLut, opened with memory mapping
+
+        axes: list of the grid values of every axis (see AXES)
+        r: radii of the Rd_r bins
+        Rd_r, Rd: the tables
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, "index.json")) as f:
+            self.index = json.load(f)
+        self.axes = [np.array(self.index["axes"][name]) for name in AXES]
+        self.r = np.array(self.index["r"])
+        self.Rd_r = np.load(os.path.join(path, "Rd_r.npy"), mmap_mode="r")
+        self.Rd = np.load(os.path.join(path, "Rd.npy"), mmap_mode="r")
+        done = np.load(os.path.join(path, "done.npy"), mmap_mode="r")
+        if not np.all(done):
+            raise ValueError("the LUT in %s is not finished" % path)
+        # every corner of a grid cell, as offsets along the axes. axes with
+        # one value have no second corner
+        self.single = np.array([len(axis) == 1 for axis in self.axes])
+        corners = np.array(list(itertools.product((0, 1),
+                                                  repeat=len(AXES))))
+        self.corners = np.unique(np.where(self.single, 0, corners), axis=0)
+
+    def cell(self, point):
+        """
+        lower corner of the cell holding point and the fractions along
+        every axis. points outside the grid are clamped to it
+        """
+        lower = []
+        fraction = []
+        for axis, value in zip(self.axes, point):
+            if len(axis) == 1:
+                lower.append(0)
+                fraction.append(0.0)
+                continue
+            value = min(max(value, axis[0]), axis[-1])
+            i = min(np.searchsorted(axis, value, side="right") - 1,
+                    len(axis) - 2)
+            lower.append(i)
+            fraction.append((value - axis[i])/(axis[i+1] - axis[i]))
+        return np.array(lower), np.array(fraction)
+
+    def interpolate(self, point, quantity="Rd_r"):
+        """
+        multilinear interpolation of quantity ("Rd_r" or "Rd") at point
+        (mua, mus, g, thickness). returns the value and the gradient with
+        respect to the point, shape (4,) + value shape
+        """
+        table = getattr(self, quantity)
+        lower, t = self.cell(point)
+        single = self.single
+        corners = self.corners
+        values = table[tuple((lower + corners).T)]
+        # weight of every corner and its derivative along every axis
+        factors = np.where(corners == 1, t, 1.0 - t) # (corners, axes)
+        weight = np.prod(factors, axis=1)
+        value = np.tensordot(weight, values, axes=1)
+        gradient = []
+        for k, axis in enumerate(self.axes):
+            if single[k]:
+                gradient.append(np.zeros_like(value))
+                continue
+            others = np.prod(np.delete(factors, k, axis=1), axis=1)
+            sign = np.where(corners[:, k] == 1, 1.0, -1.0)
+            width = axis[lower[k]+1] - axis[lower[k]]
+            gradient.append(np.tensordot(sign*others/width, values, axes=1))
+        return value, np.array(gradient)
+
+    def fit(self, measured, fixed, initial=None, sigma=None,
+            iterations=100, tolerance=1e-10):
+        """
+        fit the free optical properties to a measured Rd_r (at the radii
+        r) by Levenberg-Marquardt on the interpolated LUT. returns
+        {"point": (mua, mus, g, thickness), "covariance", "chiSquare",
+        "iterations"}
+
+            measured: measured Rd_r
+            fixed: {name: value} of the properties that are not fitted
+            initial: {name: value} starting values of the free properties
+                    (default: middle of the grid)
+            sigma: standard deviation of the measurement (default: 5% of
+                    the measured values plus 0.1% of the largest one, so
+                    the noisy tail does not dominate)
+        """
+        measured = np.asarray(measured, dtype=float)
+        if sigma is None:
+            sigma = 0.05*np.abs(measured) + 1e-3*np.max(np.abs(measured))
+        free = [k for k, name in enumerate(AXES) if name not in fixed]
+        point = np.array([fixed[name] if name in fixed else
+                          (initial or {}).get(name,
+                              0.5*(axis[0] + axis[-1]))
+                          for name, axis in zip(AXES, self.axes)])
+        low = np.array([axis[0] for axis in self.axes])
+        high = np.array([axis[-1] for axis in self.axes])
+        damping = 1e-3
+        def residuals(point):
+            value, gradient = self.interpolate(point)
+            return (value - measured)/sigma, (gradient[free]/sigma).T
+        res, J = residuals(point)
+        chi2 = np.sum(res**2)
+        iteration = 0
+        for iteration in range(1, iterations + 1):
+            A = J.T @ J
+            step = np.linalg.solve(A + damping*np.diag(np.diag(A) + 1e-30),
+                                   -J.T @ res)
+            trial = point.copy()
+            trial[free] = np.clip(point[free] + step, low[free], high[free])
+            trialRes, trialJ = residuals(trial)
+            trialChi2 = np.sum(trialRes**2)
+            if trialChi2 < chi2:
+                converged = chi2 - trialChi2 <= tolerance*max(chi2, 1.0)
+                point, res, J, chi2 = trial, trialRes, trialJ, trialChi2
+                damping = max(damping/10.0, 1e-12)
+                if converged:
+                    break
+            else:
+                damping *= 10.0
+                if damping > 1e12:
+                    break
+        covariance = np.linalg.pinv(J.T @ J)
+        return {"point": tuple(point), "covariance": covariance,
+                "chiSquare": chi2, "iterations": iteration}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="build a reflectance LUT of a tissue slab")
+    parser.add_argument("path", help="LUT directory")
+    for name in AXES:
+        parser.add_argument("--" + name, type=float, nargs="+",
+                            required=True)
+    parser.add_argument("--photons", type=int, default=10000)
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    buildLut(args.path, slab, {name: getattr(args, name) for name in AXES},
+             args.photons, args.processes, args.seed)
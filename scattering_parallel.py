@@ -0,0 +1,176 @@
+"""
+process-parallel runs with the tallies in shared memory. every worker
+process accumulates into its own slab of a shared segment (one copy of the
+tallies per worker), so nothing large is pickled and no locks are needed;
+after the workers are done the parent adds the slabs up in place. large
+read-only tables (e.g. label volumes or phase function tables) can be put in
+a second segment that the workers attach to instead of copying--
+
+    model = runParallel(paperTest1, 100000, processes=8)
+    model.computeAndScaleArraySums()
+
+makeModel must be a function that can be pickled (defined at module level,
+not a lambda), it is called once in every worker. the small layer tables of
+the model are rebuilt by makeModel in every worker, indexing python lists is
+faster in the transport than indexing shared arrays.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from scattering_distributed import seedStream
+
+ALIGNMENT = 64 # bytes, start of every array in a segment
+
+class SharedArrays:
+    """
+    named numpy arrays in one shared memory segment. made with create() in
+    the parent and opened with attach(handle()) in the workers
+
+        arrays: {name: array} views into the segment
+        spec: [(name, shape, dtype, offset)] layout of the segment
+    """
+    def __init__(self, memory, spec, owner):
+        self.memory = memory
+        self.spec = spec
+        self.owner = owner
+        self.arrays = {}
+        for name, shape, dtype, offset in spec:
+            self.arrays[name] = np.ndarray(shape, dtype=dtype,
+                                           buffer=memory.buf, offset=offset)
+
+    @classmethod
+    def create(cls, shapes):
+        """
+        new segment with zeroed arrays, shapes is {name: (shape, dtype)}
+        """
+        spec = []
+        offset = 0
+        for name, (shape, dtype) in shapes.items():
+            dtype = np.dtype(dtype).str
+            spec.append((name, tuple(shape), dtype, offset))
+            size = int(np.prod(shape))*np.dtype(dtype).itemsize
+            offset += -(-size//ALIGNMENT)*ALIGNMENT
+        memory = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        shared = cls(memory, spec, True)
+        for array in shared.arrays.values():
+            array[...] = 0
+        return shared
+
+    @classmethod
+    def attach(cls, handle):
+        # open the segment of handle() made in another process
+        name, spec = handle
+        # the workers share the resource tracker of the parent, so the
+        # segment is removed once (by the parent, see close)
+        memory = shared_memory.SharedMemory(name=name)
+        return cls(memory, spec, False)
+
+    def handle(self):
+        # what a worker needs to attach (can be pickled)
+        return self.memory.name, self.spec
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def close(self):
+        self.arrays = {}
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+def runWorker(makeModel, photons, seed, stream, slot, talliesHandle,
+              tablesHandle=None):
+    """
+    run photons photons on random stream (seed, stream), accumulating into
+    slab slot of the shared tallies. tables are set as (read-only)
+    attributes of the model. returns the counters of the run
+    """
+    seedStream(seed, stream)
+    tallies = SharedArrays.attach(talliesHandle)
+    tables = None
+    model = makeModel()
+    if tablesHandle is not None:
+        tables = SharedArrays.attach(tablesHandle)
+        for name, array in tables.arrays.items():
+            array.flags.writeable = False
+            setattr(model, name, array)
+    slabs = {name: tallies[name][slot] for name in model.tallies}
+    model.bindTallies(slabs)
+    model.run(photons)
+    for name in model.tallies:
+        if getattr(model, name) is not slabs[name]: # promoted
+            raise OverflowError("the fixed point tally %s overflowed, use a "
+                                "larger fixedPointUnit" % name)
+    # the counters only, rawTallies would copy every tally (run flushed
+    # the buffers into the slabs)
+    counters = {"numberOfPhotons": model.numberOfPhotons,
+                "rouletteSurvived": model.rouletteSurvived,
+                "rouletteKilled": model.rouletteKilled,
+                "belowThreshold": dict(model.belowThreshold)}
+    del model, slabs # drop the views before closing the segments
+    tallies.close()
+    if tables is not None:
+        tables.close()
+    return counters
+
+def runParallel(makeModel, photons, processes=None, seed=0, tables=None):
+    """
+    run photons photons of the model made by makeModel on processes worker
+    processes (default: one per CPU) and return the model with the summed
+    raw tallies (not scaled). worker k uses random stream (seed, k)
+
+        tables: {name: array} of read-only tables shared with the workers
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    model = makeModel()
+    slabs = SharedArrays.create({
+        name: ((processes,) + getattr(model, name).shape,
+               getattr(model, name).dtype) for name in model.tallies})
+    shared = None
+    if tables:
+        shared = SharedArrays.create({name: (array.shape, array.dtype)
+                                      for name, array in tables.items()})
+        for name, array in tables.items():
+            shared[name][...] = array
+    try:
+        counts = [photons//processes + (k < photons % processes)
+                  for k in range(processes)]
+        with ProcessPoolExecutor(processes) as pool:
+            futures = [pool.submit(runWorker, makeModel, counts[k], seed, k,
+                                   k, slabs.handle(),
+                                   shared.handle() if shared else None)
+                       for k in range(processes) if counts[k] > 0]
+            results = [future.result() for future in futures]
+        raw = {}
+        for name in model.tallies:
+            slab = slabs[name]
+            unit = model.tallyUnit(name)
+            if unit is None: # add the slabs up in place in slab 0
+                for k in range(1, processes):
+                    slab[0] += slab[k]
+                raw[name] = slab[0]
+            else:
+                # fixed point slabs hold counts, every one below the limit
+                # of its dtype but not their sum. mergeTallies takes
+                # weights, so they are added up as float64 weights
+                raw[name] = slab.sum(axis=0, dtype=np.float64)*unit
+        raw["numberOfPhotons"] = sum(c["numberOfPhotons"] for c in results)
+        raw["rouletteSurvived"] = sum(c["rouletteSurvived"]
+                                      for c in results)
+        raw["rouletteKilled"] = sum(c["rouletteKilled"] for c in results)
+        raw["belowThreshold"] = {}
+        for counters in results:
+            for steps, packets in counters["belowThreshold"].items():
+                raw["belowThreshold"][steps] = \
+                    raw["belowThreshold"].get(steps, 0) + packets
+        model.mergeTallies(raw)
+    finally:
+        slabs.close()
+        if shared is not None:
+            shared.close()
+    return model
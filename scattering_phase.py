@@ -0,0 +1,155 @@
+"""
+tabulated scattering phase functions. Photon.spin samples the deflection
+angle from Henyey-Greenstein with the layer's g, unless the layer has a
+phase function (attribute phase, e.g. medium(..., phase=...)). a phase
+function is a table of p(cos theta) (Mie calculations, measurements or the
+builders below), piecewise linear between its points. it is turned into an
+alias table once, when it is made, so every sample takes one uniform draw
+and constant time whatever the size of the table:
+
+    1. u*bins gives a bin i and a fraction f; if f is above the alias
+       probability of i the bin is the alias of i instead
+    2. f, rescaled to [0, 1), places the sample in the bin by inverting the
+       linear density of the bin (one square root)
+
+the tables are plain lists made at setup and only read by the transport,
+so processes forked for a parallel run share them.
+
+    phase = twoTermHG(0.9, -0.3, 0.95)
+    dermis = medium("dermis", 1.4, None, 0.1, 2.0, 200.0, phase=phase)
+
+the g of a layer with a phase function is the mean cosine of the phase
+function (used by reduced scattering based tools, e.g. the diffusion
+handoff).
+"""
+
+import hashlib
+
+import numpy as np
+
+class PhaseFunction:
+    """
+    phase function tabulated over the cosine of the deflection angle, with
+    an alias table for sampling
+
+        cosTheta: increasing cosines from -1 to 1
+        p: phase function at cosTheta (any normalization), piecewise linear
+                between the points
+        name: description of where the table comes from
+        g: mean cosine
+    """
+    def __init__(self, cosTheta, p, name="tabulated"):
+        cosTheta = np.asarray(cosTheta, dtype=float)
+        p = np.asarray(p, dtype=float)
+        if cosTheta.shape != p.shape or len(cosTheta) < 2:
+            raise ValueError("cosTheta and p need the same length (> 1)")
+        if np.any(np.diff(cosTheta) <= 0.0) or cosTheta[0] != -1.0 or \
+                cosTheta[-1] != 1.0:
+            raise ValueError("cosTheta must increase from -1 to 1")
+        if np.any(p < 0.0) or not np.any(p > 0.0):
+            raise ValueError("p must be non-negative and not all zero")
+        self.name = name
+        self.cosTheta = cosTheta
+        self.p = p
+        width = np.diff(cosTheta)
+        area = 0.5*(p[1:] + p[:-1])*width
+        total = area.sum()
+        # mean cosine (the integrand of every bin is quadratic, Simpson)
+        middle = 0.5*(cosTheta[1:] + cosTheta[:-1])
+        moment = width*(cosTheta[:-1]*p[:-1] + 4.0*middle*0.5*(p[1:] +
+                        p[:-1]) + cosTheta[1:]*p[1:])/6.0
+        self.g = float(moment.sum()/total)
+        self.makeAlias(area/total)
+        # bins as a list of tuples (fast to index from the transport):
+        # lower edge, width and the linear density p0 + dp*t of the bin
+        # (dp is 0 for flat bins, sampled uniformly)
+        dp = p[1:] - p[:-1]
+        dp[np.abs(dp) <= 1e-9*p[:-1]] = 0.0
+        self.table = list(zip(cosTheta[:-1].tolist(), width.tolist(),
+                              p[:-1].tolist(), (p[:-1]**2).tolist(),
+                              dp.tolist(),
+                              (2.0*p[:-1]*dp + dp*dp).tolist()))
+
+    def makeAlias(self, probability):
+        # alias table of the bin probabilities (Vose)
+        bins = len(probability)
+        scaled = (probability*bins).tolist()
+        alias = list(range(bins))
+        small = [i for i in range(bins) if scaled[i] < 1.0]
+        large = [i for i in range(bins) if scaled[i] >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        for i in small + large: # rounding leftovers
+            scaled[i] = 1.0
+        self.bins = bins
+        self.aliasTable = list(zip(scaled, alias))
+
+    def cosine(self, u):
+        """
+        cosine of the deflection angle from one uniform number u in [0, 1)
+        """
+        u *= self.bins
+        i = int(u)
+        f = u - i
+        accept, alias = self.aliasTable[i]
+        if f < accept:
+            f /= accept
+        else:
+            f = (f - accept)/(1.0 - accept)
+            i = alias
+        lower, width, p0, p0Squared, dp, dpSquared = self.table[i]
+        if dp: # invert the linear density of the bin
+            f = ((p0Squared + dpSquared*f)**0.5 - p0)/dp
+        return lower + width*f
+
+    def describe(self):
+        # plain description, for model.describe (the table by its digest)
+        digest = hashlib.sha1(self.cosTheta.tobytes() +
+                              self.p.tobytes()).hexdigest()
+        return {"name": self.name, "g": self.g, "points": len(self.p),
+                "sha1": digest}
+
+def cosineGrid(points):
+    # cosines from -1 to 1, dense at both ends (forward and backward peaks)
+    cosTheta = -np.cos(np.linspace(0.0, np.pi, points))
+    cosTheta[0], cosTheta[-1] = -1.0, 1.0
+    return cosTheta
+
+def henyeyGreensteinDensity(g, cosTheta):
+    # Henyey-Greenstein phase function over cos theta (normalized to 1)
+    return 0.5*(1.0 - g*g)/(1.0 + g*g - 2.0*g*cosTheta)**1.5
+
+def henyeyGreenstein(g, points=4097):
+    """
+    tabulated Henyey-Greenstein phase function
+    """
+    cosTheta = cosineGrid(points)
+    return PhaseFunction(cosTheta, henyeyGreensteinDensity(g, cosTheta),
+                         "henyey-greenstein g=%g" % g)
+
+def twoTermHG(gForward, gBackward, alpha, points=4097):
+    """
+    two-term Henyey-Greenstein phase function, alpha*HG(gForward) +
+    (1 - alpha)*HG(gBackward)
+    """
+    cosTheta = cosineGrid(points)
+    p = alpha*henyeyGreensteinDensity(gForward, cosTheta) + \
+        (1.0 - alpha)*henyeyGreensteinDensity(gBackward, cosTheta)
+    return PhaseFunction(cosTheta, p, "two-term henyey-greenstein "
+                         "gForward=%g gBackward=%g alpha=%g"
+                         % (gForward, gBackward, alpha))
+
+def modifiedHG(g, beta, points=4097):
+    """
+    modified Henyey-Greenstein phase function (Bevilacqua), beta*HG(g) +
+    (1 - beta)*3/2*cos(theta)**2 (normalized over cos theta)
+    """
+    cosTheta = cosineGrid(points)
+    p = beta*henyeyGreensteinDensity(g, cosTheta) + \
+        (1.0 - beta)*1.5*cosTheta**2
+    return PhaseFunction(cosTheta, p, "modified henyey-greenstein g=%g "
+                         "beta=%g" % (g, beta))
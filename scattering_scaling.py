@@ -0,0 +1,193 @@
+"""
+scaling monte carlo. one baseline run of a homogeneous medium records every
+photon exit (position, exit cosine, number of scatterings, path length and
+weight). the reflectance for other absorption and scattering coefficients
+(same g and n) is then found by rescaling the recorded exits instead of
+running a new simulation--
+
+    baseline = Baseline.run(model, 100000) # single-layer model
+    result = baseline.query(mua=0.5, mus=80.0)
+    result["Rd"], result["Rd_r"], result["Rd_a"]
+
+every step in the tissue ends with a drop (weight times the albedo
+a = mus/mut) and a spin, so a photon's path is a walk whose steps are
+exponential with mean 1/mut. for another (mua, mus) the same walk is
+stretched by mut0/mut and the exit weight changes by (a/a0)**k after k
+scatterings ("albedo" scaling). with the "path length" scaling the walk is
+seen as scattering only (rate mut0), stretched by mut0/mus and absorbed
+continuously, exp(-mua*L). both give the expected reflectance exactly for a
+semi-infinite medium. for a slab the result belongs to the stretched
+thickness (returned as "thickness"). queries with an albedo above the
+baseline albedo have a larger variance, so the baseline should have the
+highest albedo of the table.
+"""
+
+import numpy as np
+
+class RecordExits:
+    """
+    photon mixin (see model.addPhotonMixin) recording every exit in
+    model.exits as (x, y, uz, scatterings, path length, exit weight)
+    """
+    def __init__(self, model):
+        super().__init__(model)
+        self.scatterings = 0
+        self.pathLength = 0.0
+
+    def hop(self):
+        self.pathLength += self.s
+        super().hop()
+
+    def drop(self, model):
+        self.scatterings += 1
+        super().drop(model)
+
+    def recordReduce(self, model, reflectance):
+        model.exits.append((self.x, self.y, self.uz, self.scatterings,
+                            self.pathLength, self.w*(1.0 - reflectance)))
+        super().recordReduce(model, reflectance)
+
+class Baseline:
+    """
+    exits of a baseline run of a homogeneous medium
+
+        r: exit radius [cm]
+        cosine: |uz| at the exit
+        reflected: True for reflection, False for transmission
+        scatterings: number of scatterings (drops) before the exit
+        pathLength: geometrical path length [cm]
+        w: exit weight
+        mua, mus, g, n: optical properties of the baseline medium
+        thickness: thickness of the baseline medium [cm]
+        photons, Rsp: number of photons, specular reflectance
+        nr, dr, na, da: grid of the queried arrays
+    """
+    def __init__(self, exits, mua, mus, g, n, thickness, photons, Rsp, nr,
+                 dr, na, da):
+        exits = np.asarray(exits, dtype=float).reshape(-1, 6)
+        x, y, uz, k, L, w = exits.T
+        self.r = np.sqrt(x*x + y*y)
+        self.cosine = np.abs(uz)
+        self.reflected = uz < 0.0
+        self.scatterings = k.astype(np.int32)
+        self.pathLength = L
+        self.w = w
+        self.mua = mua
+        self.mus = mus
+        self.g = g
+        self.n = n
+        self.thickness = thickness
+        self.photons = photons
+        self.Rsp = Rsp
+        self.nr, self.dr, self.na, self.da = nr, dr, na, da
+
+    @classmethod
+    def run(cls, model, photons):
+        """
+        run a baseline of photons photons with the model (one homogeneous
+        layer, i.e. every tissue layer has the same properties) and record
+        the exits
+        """
+        tissue = model.layers[1:model.numberOfLayers+1]
+        first = tissue[0]
+        for layer in tissue:
+            if (layer.n, layer.g, layer.mua, layer.mus) != \
+                (first.n, first.g, first.mua, first.mus):
+                raise ValueError("scaling needs a homogeneous medium")
+        if first.mua + first.mus == 0.0:
+            raise ValueError("scaling needs a scattering medium")
+        model.addPhotonMixin(RecordExits)
+        model.exits = []
+        model.run(photons)
+        return cls(model.exits, first.mua, first.mus, first.g, first.n,
+                   model.layerDepth[model.numberOfLayers][1],
+                   model.numberOfPhotons, model.Rsp, model.nr, model.dr,
+                   model.na, model.da)
+
+    def weights(self, mua, mus, method="albedo"):
+        """
+        stretch factor of the baseline walk and the exit weights for the
+        medium (mua, mus)
+        """
+        mut0 = self.mua + self.mus
+        k = self.scatterings
+        if method == "albedo":
+            a0 = self.mus/mut0
+            a = mus/(mua + mus)
+            stretch = mut0/(mua + mus)
+            return stretch, self.w*(a/a0)**k
+        if method == "path length":
+            stretch = mut0/mus
+            # divide out the albedo weighting of the baseline
+            a0 = self.mus/mut0
+            return stretch, self.w/a0**k*np.exp(-mua*stretch*self.pathLength)
+        raise ValueError("unknown scaling method: " + method)
+
+    def query(self, mua, mus, method="albedo"):
+        """
+        reflectance of the medium (mua, mus) scaled like
+        model.computeAndScaleArraySums: Rd, Rd_r [1/cm**2], Rd_a [1/sr],
+        Rd_ra [1/(cm**2 sr)], plus the mean path length of the reflected
+        light and the thickness the result belongs to
+        """
+        stretch, w = self.weights(mua, mus, method)
+        use = self.reflected
+        w = w[use]
+        ir = np.minimum((self.r[use]*stretch/self.dr).astype(np.intp),
+                        self.nr - 1)
+        ia = np.minimum((np.arccos(self.cosine[use])/self.da)
+                        .astype(np.intp), self.na - 1)
+        Rd_ra = np.bincount(ir*self.na + ia, weights=w,
+                            minlength=self.nr*self.na)
+        Rd_ra = Rd_ra.reshape(self.nr, self.na)
+        dArea = 2.0*np.pi*(np.arange(self.nr) + 0.5)*self.dr**2
+        angle = (np.arange(self.na) + 0.5)*self.da
+        dSolidAngle = 4.0*np.pi*np.sin(angle)*np.sin(0.5*self.da)
+        Rd = w.sum()
+        pathLength = np.sum(w*self.pathLength[use])*stretch/Rd if Rd > 0 \
+            else 0.0
+        return {"Rd": Rd/self.photons,
+                "Rd_r": Rd_ra.sum(axis=1)/(dArea*self.photons),
+                "Rd_a": Rd_ra.sum(axis=0)/(dSolidAngle*self.photons),
+                "Rd_ra": Rd_ra/(dArea[:, None]*np.cos(angle)*dSolidAngle*
+                                self.photons),
+                "Rsp": self.Rsp,
+                "pathLength": pathLength,
+                "thickness": self.thickness*stretch}
+
+    def reflectanceTable(self, mua, musPrime, method="albedo"):
+        """
+        total diffuse reflectance on the grid mua x musPrime (reduced
+        scattering coefficients mus*(1-g)), shape (len(mua), len(musPrime))
+        """
+        table = np.zeros((len(mua), len(musPrime)))
+        for i, a in enumerate(mua):
+            for j, s in enumerate(musPrime):
+                stretch, w = self.weights(a, s/(1.0 - self.g), method)
+                table[i, j] = w[self.reflected].sum()/self.photons
+        return table
+
+    def save(self, path):
+        # write the baseline to an npz file
+        np.savez_compressed(
+            path, r=self.r, cosine=self.cosine, reflected=self.reflected,
+            scatterings=self.scatterings, pathLength=self.pathLength,
+            w=self.w, properties=np.array([self.mua, self.mus, self.g,
+                                           self.n, self.thickness,
+                                           self.photons, self.Rsp, self.nr,
+                                           self.dr, self.na, self.da]))
+
+    @classmethod
+    def load(cls, path):
+        # read a baseline written by save
+        with np.load(path) as f:
+            baseline = cls.__new__(cls)
+            for name in ("r", "cosine", "reflected", "scatterings",
+                         "pathLength", "w"):
+                setattr(baseline, name, f[name])
+            (baseline.mua, baseline.mus, baseline.g, baseline.n,
+             baseline.thickness, photons, baseline.Rsp, nr, baseline.dr, na,
+             baseline.da) = f["properties"].tolist()
+        baseline.photons, baseline.nr, baseline.na = int(photons), int(nr), \
+            int(na)
+        return baseline
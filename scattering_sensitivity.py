@@ -0,0 +1,152 @@
+"""
+spatial sensitivity (photon measurement density) maps of a source-detector
+pair. A_rz tells where light is absorbed, not which absorption belongs to
+the light a detector sees. with
+
+    enableSensitivity(model, Detector(0.2, 0.4))
+
+every packet keeps the segments of its path (the hops), and when it leaves
+the tissue into the detector the segments are added, with the weight that
+is detected, to the tally S_rz on the (r, z) grid of the model (the same
+traversal as the track length fluence, see TrackBuffer). the packets that
+are not detected drop their path, so only the paths of the packets in
+flight are in memory, and the detected segments are binned in bulk when
+the buffer of S_rz is full.
+
+S_rz[cell] is the sum over the detected packets of their weight W times the
+length L of their path in the cell. with implicit absorption (drop) the
+detected weight is W = W0*exp(-sum of mua*L over the cells) times factors
+that do not depend on mua, so
+
+    dM/dmua[cell] = -S_rz[cell]/numberOfPhotons
+
+exactly, where M is the detected weight per photon (the jacobian of the
+signal, see sensitivityMaps). the source is the pencil beam of the model
+at the origin and the detector a ring around it (the grid is cylindrical),
+so the maps are those of a source and a detector at distance rho averaged
+over the azimuth of the detector.
+
+the detected weight and number of packets are in the tally M_d, both
+tallies merge like the others (rawTallies, runParallel). parts of a path
+handed off to diffusion (scattering_hybrid) are not in the maps.
+"""
+
+import numpy as np
+
+class Detector:
+    """
+    ring detector on the top (reflection) or bottom (transmission) surface
+    of the tissue, centered on the source
+
+        rMin, rMax: inner and outer radius of the ring [grid units of the
+                model, cm]
+        side: "reflection" or "transmission"
+        maxAngle: largest angle of the exit direction to the normal of the
+                surface [rad] (numerical aperture), None for all
+    """
+    def __init__(self, rMin, rMax, side="reflection", maxAngle=None):
+        if side not in ("reflection", "transmission"):
+            raise ValueError("unknown detector side: " + side)
+        if not 0.0 <= rMin < rMax:
+            raise ValueError("the detector needs 0 <= rMin < rMax")
+        self.rMin = rMin
+        self.rMax = rMax
+        self.side = side
+        self.maxAngle = maxAngle
+        self.cosMin = 0.0 if maxAngle is None else np.cos(maxAngle)
+
+    def detects(self, photon):
+        # true if the packet leaving the tissue (uz after refraction) hits
+        # the detector
+        if (photon.uz < 0.0) != (self.side == "reflection"):
+            return False
+        if abs(photon.uz) < self.cosMin:
+            return False
+        r2 = photon.x*photon.x + photon.y*photon.y
+        return self.rMin*self.rMin <= r2 < self.rMax*self.rMax
+
+    def describe(self):
+        # plain description, for metadata of results
+        return {"rMin": self.rMin, "rMax": self.rMax, "side": self.side,
+                "maxAngle": self.maxAngle}
+
+class Sensitivity:
+    """
+    photon mixin (see model.addPhotonMixin) keeping the path of the packet
+    and adding it to S_rz when the packet is detected by model.detector
+    """
+    def __init__(self, model):
+        super().__init__(model)
+        self.path = [] # segments (x, y, z, ux, uy, uz, s) of the hops
+
+    def hop(self):
+        self.path.append((self.x, self.y, self.z, self.ux, self.uy, self.uz,
+                          self.s))
+        super().hop()
+
+    def newLayerCheck(self, model):
+        branches = len(self.branches)
+        super().newLayerCheck(model)
+        # a packet split off at an interface has the same path so far and
+        # continues it on its own
+        for branch in self.branches[branches:]:
+            branch.path = list(branch.path)
+
+    def recordReduce(self, model, reflectance):
+        if model.detector.detects(self):
+            w = self.w*(1.0 - reflectance)
+            model.S_rzBuffer.events.extend(segment + (w,)
+                                           for segment in self.path)
+            model.M_d[0] += w
+            model.M_d[1] += 1
+        super().recordReduce(model, reflectance)
+
+def enableSensitivity(model, detector):
+    """
+    accumulate the sensitivity map of the detector (a Detector) in the
+    tally S_rz, shape (nr, nz), and the detected weight and number of
+    packets in the tally M_d. call it before the run
+    """
+    if model.numberOfPhotons:
+        raise ValueError("the model has already run")
+    model.detector = detector
+    model.addons["sensitivity"] = {"detector": detector.describe()}
+    model.trackTallies = model.trackTallies + ("S_rz",)
+    model.tallies = model.tallies + ("S_rz", "M_d")
+    model.tallyDtype["S_rz"] = np.dtype(np.float64)
+    model.tallyDtype["M_d"] = np.dtype(np.float64)
+    model.S_rz = model.makeTally("S_rz", (model.nr, model.nz))
+    model.M_d = model.makeTally("M_d", 2)
+    model.makeBuffers()
+    model.addPhotonMixin(Sensitivity)
+    return model
+
+def sensitivityMaps(model):
+    """
+    scaled maps of a run with sensitivity, {name: value}--
+        M: detected weight per photon
+        detected: number of detected packets
+        J_rz: jacobian dM/dmua of every (r, z) cell [cm]
+        PMDF_rz: photon measurement density, -J_rz/M over the cell volume
+                [1/cm**2]. its integral over the volume is the mean path
+                length
+        meanPathLength: mean path length of the detected light [cm]
+    the tallies of the model are left raw
+    """
+    model.flush()
+    S_rz = np.asarray(model.tallyWeights("S_rz"), dtype=np.float64)
+    weight, packets = model.M_d
+    N = model.numberOfPhotons
+    ir = np.arange(model.nr)
+    volume = 2.0*np.pi*(ir + 0.5)*model.dr**2*model.dz
+    maps = {"M": weight/N, "detected": int(packets),
+            "J_rz": -S_rz/N}
+    if weight > 0.0:
+        maps["PMDF_rz"] = S_rz/(weight*volume[:, None])
+        # with overflow, the path beyond the grid is in S_over
+        beyond = np.sum(model.S_over) if "S_over" in model.tallies else 0.0
+        maps["meanPathLength"] = float((np.sum(S_rz) + beyond)/weight)
+    else:
+        maps["PMDF_rz"] = np.zeros_like(S_rz)
+        maps["meanPathLength"] = 0.0
+    return maps
@@ -0,0 +1,134 @@
+"""
+spectral optical properties of the pulse oximetry tissue. the properties
+are kept in one compact table (below) that is parsed once, and evaluated at
+any wavelength in the table's range by interpolating linearly in
+log(value) against log(wavelength). between two rows this is a power law,
+which is also how a property with only two rows (e.g. the scattering of
+fat) is extended to the rest of the range. every function accepts a single
+wavelength or an array of wavelengths.
+
+the 660 and 940 nm rows are the values the pulse oximetry model has always
+used [1/mm]. the other hemoglobin rows are Prahl's molar extinction
+coefficients converted for 150 g/L of hemoglobin, the other water rows are
+from Hale and Querry.
+"""
+
+import functools
+
+import numpy as np
+
+# wavelength [nm] followed by one column per property, '-' = not known
+TABLE = """
+lambda muaHbO2 muaHb  musHbO2 musHb muaw    musSkin muaFat musFat muaMuscle musMuscle muaBone musBone
+600    1.714   7.861  -       -     0.00224 -       -      -      -         -         -       -
+620    0.505   3.487  -       -     0.00289 -       -      -      -         -         -       -
+640    0.237   2.327  -       -     0.00319 -       -      -      -         -         -       -
+660    0.15    1.64   87.61   81.45 0.0036  25.62   0.0104 6.20   0.0816    8.61      0.0351  34.45
+680    0.157   1.290  -       -     0.00454 -       -      -      -         -         -       -
+700    0.155   0.961  -       -     0.0060  -       -      -      -         -         -       -
+730    0.209   0.590  -       -     0.0150  -       -      -      -         -         -       -
+760    0.314   0.829  -       -     0.0259  -       -      -      -         -         -       -
+800    0.437   0.408  -       -     0.0196  -       -      -      -         -         -       -
+850    0.567   0.370  -       -     0.0433  -       -      -      -         -         -       -
+900    0.642   0.408  -       -     0.0678  -       -      -      -         -         -       -
+940    0.65    0.43   66.08   49.66 0.2674  15.68   0.017  5.42   0.0401    5.81      0.0457  24.70
+"""
+
+@functools.lru_cache(maxsize=None)
+def table():
+    """
+    parse the table once. returns {property: (wavelengths, values)} with
+    only the rows where the property is known
+    """
+    rows = [line.split() for line in TABLE.strip().splitlines()]
+    names = rows[0][1:]
+    columns = {}
+    for j, name in enumerate(names):
+        known = [(float(row[0]), float(row[j+1])) for row in rows[1:]
+                 if row[j+1] != "-"]
+        wavelengths, values = np.array(known).T
+        columns[name] = (wavelengths, values)
+    return columns
+
+def wavelengthRange():
+    # range of wavelengths covered by the table [nm]
+    wavelengths = table()["muaHbO2"][0]
+    return wavelengths[0], wavelengths[-1]
+
+def interpolate(name, wavelength):
+    """
+    value of a property at the wavelength(s) [nm], power law interpolation
+    between the rows of the table (and from the end rows of a property up
+    to the edges of the table)
+
+        name: column of the table, e.g. "muaHbO2"
+    """
+    wavelengths, values = table()[name]
+    lam = np.asarray(wavelength, dtype=float)
+    low, high = wavelengthRange()
+    if np.any(lam < low) or np.any(lam > high):
+        raise ValueError("wavelength outside the table (%g to %g nm)"
+                         % (low, high))
+    x = np.log(wavelengths)
+    y = np.log(values)
+    logLam = np.log(lam)
+    logValue = np.interp(logLam, x, y)
+    # power law from the end rows outside the rows of the property
+    first = (y[1] - y[0])/(x[1] - x[0])
+    last = (y[-1] - y[-2])/(x[-1] - x[-2])
+    logValue = np.where(logLam < x[0], y[0] + first*(logLam - x[0]),
+                        logValue)
+    logValue = np.where(logLam > x[-1], y[-1] + last*(logLam - x[-1]),
+                        logValue)
+    value = np.exp(logValue)
+    # give back the table values exactly at the rows
+    for lamRow, valueRow in zip(wavelengths, values):
+        value = np.where(lam == lamRow, valueRow, value)
+    if np.ndim(value) == 0:
+        return float(value)
+    return value
+
+def melanin(wavelength):
+    # absorption of melanin [1/mm]
+    lam = np.asarray(wavelength, dtype=float)
+    return (6.6e10)*lam**(-3.33)
+
+def baseline(wavelength):
+    # baseline absorption of bloodless tissue [1/mm]
+    lam = np.asarray(wavelength, dtype=float)
+    return (7.84e7)*lam**(-3.255)
+
+def skinMua(wavelength, SaO2, vArt, vVen, Vw, epidermis, vMel=0.1):
+    """
+    absorption coefficient of a skin layer [1/mm]. the arguments broadcast
+    against each other, so a whole (wavelength, SaO2) sweep is evaluated
+    in one call
+
+        wavelength: wavelength [nm]
+        SaO2: arterial oxygen saturation, the venous saturation is taken
+                10% lower
+        vArt: volume fraction of arterial blood
+        vVen: volume fraction of venous blood
+        Vw: volume fraction of water
+        epidermis: True for layers without blood but with melanin
+                (epidermis, stratum corneum)
+        vMel: volume fraction of melanin
+    """
+    lam = np.asarray(wavelength, dtype=float)
+    SaO2 = np.asarray(SaO2, dtype=float)
+    SvO2 = np.where(SaO2 == 0.0, 0.0, SaO2 - 0.1)
+    muab = baseline(lam)
+    watMua = interpolate("muaw", lam)
+    if epidermis:
+        mua = vMel*melanin(lam) + Vw*watMua + (1.0 - (vMel + Vw))*muab
+        mua = mua + 0.0*SaO2 # same shape as the other case
+    else:
+        muaHbO2 = interpolate("muaHbO2", lam)
+        muaHb = interpolate("muaHb", lam)
+        artMua = SaO2*muaHbO2 + (1.0-SaO2)*muaHb # arterial absorption
+        venMua = SvO2*muaHbO2 + (1.0-SvO2)*muaHb # venous absorption
+        mua = vArt*artMua + vVen*venMua + Vw*watMua + \
+            (1.0 - (vArt + vVen + Vw))*muab
+    if np.ndim(mua) == 0:
+        return float(mua)
+    return mua
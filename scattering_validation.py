@@ -0,0 +1,401 @@
+"""
+statistical regression checks of the MCML models. the reference problems
+are run in batches with a fixed seed and compared with published values
+(van de Hurst, Prahl, Giovanelli and the exact solution of a semi-infinite
+isotropic medium with Chandrasekhar's H-function). the tolerance of every
+check comes from the spread of the batch means, so it shrinks like
+1/sqrt(N) as more photons are sent.
+
+every engine (a way of running the transport, e.g. with partial reflection)
+is also compared with every other engine with a chi-square test on the
+tallies they share.
+
+the script exits with a non-zero status if a check fails
+
+    python scattering_validation.py --scale 2
+"""
+
+import argparse
+import sys
+
+import numpy as np
+
+import scattering as mcml
+import scattering_pulse_oximetry as pulseOx
+from scattering_hybrid import enableDiffusion
+from scattering_phase import henyeyGreenstein
+from scattering_qmc import enableQuasiRandom
+from scattering_scaling import Baseline
+from scattering_woodcock import enableDeltaTracking
+
+Z = 4.0 # number of standard errors allowed for a pass
+HYBRID = 0.02 # error bound of the hybrid diffusion mode (Rd and A)
+
+####### REFERENCE PROBLEMS #######
+
+def table1(module, **policy):
+    # table 1 in the paper. slab with matched boundaries, optical depth 2
+    air = module.medium("air", 1.0, 1.0, None, 0, 0)
+    test1 = module.medium("test 1", 1.0, 0.75, 0.01, 10.0, 90.0)
+    return module.model([air, test1, test1, air], 2, **policy)
+
+def table2(module, **policy):
+    # table 2 in the paper. semi-infinite medium with n = 1.5
+    air = module.medium("air", 1.0, 1.0, None, 0, 0)
+    test2 = module.medium("test 2", 1.5, 0.0, 1.0, 10.0, 90.0)
+    return module.model([air, test2, test2, air], 2, **policy)
+
+def isotropic(module, **policy):
+    # semi-infinite isotropic medium with matched boundary, albedo 0.9
+    air = module.medium("air", 1.0, 1.0, None, 0, 0)
+    tissue = module.medium("isotropic", 1.0, 0.0, 1.0, 10.0, 90.0)
+    return module.model([air, tissue, tissue, air], 2, **policy)
+
+def fluence(module, **policy):
+    # thick slab for the fluence depth profile. mus' = 10/cm, with g = 0.5
+    # rather than 0.9 a photon takes a fifth of the steps, so enough photons
+    # for tight checks run in a minute
+    air = module.medium("air", 1.0, 1.0, None, 0, 0)
+    tissue = module.medium("fluence", 1.37, 0.5, 1.0, 0.5, 20.0)
+    return module.model([air, tissue, tissue, air], 2, **policy)
+
+def bilayer(module, **policy):
+    # two layers with mismatched refractive indices
+    air = module.medium("air", 1.0, 1.0, None, 0, 0)
+    top = module.medium("top", 1.37, 0.9, 0.01, 1.0, 100.0)
+    bottom = module.medium("bottom", 1.6, 0.8, 0.02, 2.0, 50.0)
+    return module.model([air, top, bottom, bottom, air], 3, **policy)
+
+def domainSlab(module, **policy):
+    # table 1 as one layer in a narrow lateral domain, a large part of the
+    # light is terminated at its side
+    air = module.medium("air", 1.0, 1.0, None, 0, 0)
+    slab = module.medium("domain", 1.0, 0.75, 0.02, 10.0, 90.0)
+    return module.model([air, slab, air], 1, domain=(0.01, None), **policy)
+
+####### ENGINES #######
+
+# name: function making the model of a reference problem
+def tabulatedPhase(model):
+    # the model with the Henyey-Greenstein phase functions of its tissue
+    # layers sampled from tables (alias method)
+    for layer in model.layers[1:-1]:
+        layer.phase = henyeyGreenstein(layer.g)
+    model.buildTables()
+    return model
+
+engines = {
+    "stochastic": lambda problem: problem(mcml),
+    "partial reflection": lambda problem: problem(mcml, partialReflection=1),
+    "interface splitting": lambda problem: problem(mcml,
+                                                   partialReflection=2),
+    "pulse oximetry": lambda problem: problem(pulseOx),
+    "quasi-random": lambda problem: enableQuasiRandom(problem(mcml)),
+    "track length": lambda problem: problem(
+        mcml, fluenceEstimator="track length"),
+    "delta tracking": lambda problem: enableDeltaTracking(problem(mcml)),
+    "tabulated phase": lambda problem: tabulatedPhase(problem(mcml)),
+}
+
+####### STATISTICS #######
+
+def batchRun(makeModel, batches, photons, seed):
+    """
+    run a model in batches and return the scaled model of every batch
+
+        makeModel: function returning a new model
+        batches: number of batches
+        photons: number of photons per batch
+        seed: seed of numpy's random generator
+    """
+    np.random.seed(seed)
+    models = []
+    for i in range(batches):
+        model = makeModel()
+        model.run(photons)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            model.computeAndScaleArraySums()
+        models.append(model)
+    return models
+
+def meanAndError(models, quantity):
+    # mean and standard error of a quantity over the batches
+    values = np.array([quantity(model) for model in models], dtype=float)
+    mean = values.mean(axis=0)
+    error = values.std(axis=0, ddof=1)/np.sqrt(len(values))
+    return mean, error, values
+
+def chiSquare(meanA, errorA, meanB, errorB, nu, use=True):
+    """
+    chi-square statistic of the difference of two binned tallies. returns
+    the statistic expressed as a number of standard deviations from its
+    expected value. the standard errors are estimated from the batches, so
+    each term follows Student's t squared with nu degrees of freedom
+    rather than chi-square with one.
+
+        nu: degrees of freedom of the variance estimate (B-1 for one set
+            of B batches, 2*(B-1) for two)
+        use: mask of the bins to include
+    """
+    var = errorA**2 + errorB**2
+    use = use & (var > 0.0)
+    k = np.count_nonzero(use)
+    if k == 0:
+        return 0.0
+    X = np.sum((meanA[use] - meanB[use])**2/var[use])
+    mean = nu/(nu - 2.0) # mean and variance of t**2
+    variance = 2.0*nu**2*(nu - 1.0)/((nu - 2.0)**2*(nu - 4.0))
+    return (X - k*mean)/np.sqrt(k*variance)
+
+####### EXACT SOLUTION #######
+
+def hFunction(omega, mu, nodes=200):
+    """
+    Chandrasekhar's H-function for isotropic scattering with albedo omega,
+    solved by iteration on Gauss-Legendre nodes
+
+        mu: cosines to evaluate the H-function at
+    """
+    x, w = np.polynomial.legendre.leggauss(nodes)
+    x = 0.5*(x + 1.0)
+    w = 0.5*w
+    H = np.ones(nodes)
+    for i in range(1000):
+        Hnew = 1.0/(1.0 - 0.5*omega*x*np.sum(w*H/(x[:,None] + x[None,:]),
+                                              axis=1))
+        if np.max(abs(Hnew - H)) < 1e-13:
+            break
+        H = Hnew
+    mu = np.asarray(mu, dtype=float)
+    return 1.0/(1.0 - 0.5*omega*mu*np.sum(w*H/(mu[...,None] + x), axis=-1))
+
+def isotropicRd(omega):
+    # total diffuse reflectance at normal incidence
+    return 1.0 - hFunction(omega, 1.0)*np.sqrt(1.0 - omega)
+
+def isotropicRd_a(omega, na):
+    """
+    angular distribution of diffuse reflectance at normal incidence [1/sr]
+    averaged over the alpha bins of the model
+    """
+    da = 0.5*np.pi/na
+    H1 = hFunction(omega, 1.0)
+    x, w = np.polynomial.legendre.leggauss(20)
+    Rd_a = np.zeros(na)
+    for ia in range(na):
+        # integrate over the bin in mu = cos(alpha)
+        muTop, muBott = np.cos(ia*da), np.cos((ia+1)*da)
+        mu = 0.5*(muTop - muBott)*x + 0.5*(muTop + muBott)
+        f = omega*mu*hFunction(omega, mu)*H1/(4.0*np.pi*(mu + 1.0))
+        dSolidAngle = 2.0*np.pi*(muTop - muBott)
+        Rd_a[ia] = 2.0*np.pi*0.5*(muTop - muBott)*np.sum(w*f)/dSolidAngle
+    return Rd_a
+
+####### CHECKS #######
+
+def fluenceSlope(model):
+    # decay constant of the fluence between 0.1 and 0.5 cm
+    z = (np.arange(model.nz) + 0.5)*model.dz
+    use = (z > 0.1) & (z < 0.5) & (model.Phi_z > 0.0)
+    return -np.polyfit(z[use], np.log(model.Phi_z[use]), 1)[0]
+
+def referenceChecks():
+    """
+    list of (name, problem, quantity, reference, uncertainty of reference)
+    """
+    muEff = np.sqrt(3.0*0.5*(0.5 + 20.0*(1.0 - 0.5)))
+    return [
+        ("table 1 Rd (van de Hurst)", table1, lambda m: m.Rd,
+            0.09739, 0.0),
+        ("table 1 Rd (Prahl)", table1, lambda m: m.Rd, 0.09711, 0.00033),
+        ("table 1 Tt (van de Hurst)", table1, lambda m: m.Tt,
+            0.66096, 0.0),
+        ("table 1 Tt (Prahl)", table1, lambda m: m.Tt, 0.66159, 0.00049),
+        ("table 1 A", table1, lambda m: m.A,
+            1.0 - 0.09739 - 0.66096, 0.0),
+        # the published reflectance includes the specular reflection
+        ("table 2 Rsp + Rd (Giovanelli)", table2, lambda m: m.Rsp + m.Rd,
+            0.2600, 0.0),
+        ("table 2 Rsp + Rd (Prahl)", table2, lambda m: m.Rsp + m.Rd,
+            0.26079, 0.00079),
+        ("isotropic Rd (H-function)", isotropic, lambda m: m.Rd,
+            isotropicRd(0.9), 0.0),
+        ("isotropic Rd_a (H-function)", isotropic, lambda m: m.Rd_a,
+            isotropicRd_a(0.9, 30), 0.0),
+        # diffusion theory, good to a few percent for mua << mus'
+        ("fluence Phi_z decay (diffusion)", fluence, fluenceSlope,
+            muEff, 0.05*muEff),
+        ("energy conservation", bilayer,
+            lambda m: m.Rsp + m.Rd + m.Tt + m.A, 1.0, 1e-9),
+    ]
+
+def checkReference(name, problem, quantity, reference, uncertainty,
+                   batches, photons, seed):
+    # compare a quantity with its reference value. arrays are compared
+    # with a chi-square test, scalars with a z-test
+    models = batchRun(lambda: engines["stochastic"](problem),
+                      batches, photons, seed)
+    mean, error, values = meanAndError(models, quantity)
+    if np.ndim(mean) == 0:
+        limit = Z*error + uncertainty
+        passed = bool(abs(mean - reference) <= limit)
+        detail = "%.5f (reference %.5f, limit %.5f)" % (mean, reference,
+                                                         limit)
+    else:
+        z = chiSquare(mean, error, reference, 0.0, len(values) - 1)
+        passed = bool(z <= Z)
+        detail = "chi-square %.2f standard deviations" % z
+    return passed, detail
+
+def checkEngines(problem, batches, photons, seed):
+    """
+    compare every pair of engines on a problem with a chi-square test on
+    the tallies they share. 2D tallies are only compared if both engines
+    use the same grid
+    """
+    results = {}
+    for i, (name, engine) in enumerate(engines.items()):
+        # every engine gets its own seed so the batches are independent
+        results[name] = batchRun(lambda: engine(problem), batches, photons,
+                                 seed + 1000*(i+1))
+    checks = []
+    names = list(engines)
+    for i in range(len(names)):
+        for j in range(i+1, len(names)):
+            a, b = results[names[i]][0], results[names[j]][0]
+            tallies = ["Rd_a", "Tt_a"]
+            if (a.nr, a.nz, a.na, a.dr, a.dz) == (b.nr, b.nz, b.na, b.dr,
+                                                    b.dz):
+                tallies += ["Rd_ra", "Tt_ra", "A_rz", "Phi_z"]
+            for tally in tallies:
+                meanA, errorA, valuesA = meanAndError(
+                    results[names[i]], lambda m: getattr(m, tally))
+                meanB, errorB, valuesB = meanAndError(
+                    results[names[j]], lambda m: getattr(m, tally))
+                # like the expected counts of a chi-square test, skip the
+                # sparse bins whose variance can't be estimated from the
+                # batches (scored in less than half the batches)
+                use = (np.count_nonzero(valuesA, axis=0) >= batches/2) & \
+                      (np.count_nonzero(valuesB, axis=0) >= batches/2)
+                z = chiSquare(meanA, errorA, meanB, errorB,
+                              2*(batches - 1), use)
+                checks.append(("%s vs %s %s" % (names[i], names[j], tally),
+                               bool(z <= Z),
+                               "chi-square %.2f standard deviations"
+                               % z))
+    return checks
+
+def checkScaling(batches, photons, seed):
+    """
+    scale baselines of the isotropic problem (albedo 0.9) to other media
+    and compare the reflectance with the H-function. mut changes too, the
+    result of a semi-infinite medium only depends on the albedo
+    """
+    np.random.seed(seed)
+    baselines = [Baseline.run(isotropic(mcml), photons)
+                 for i in range(batches)]
+    checks = []
+    for mua, mus in ((10.0, 40.0), (60.0, 140.0)):
+        omega = mus/(mua + mus)
+        for method in ("albedo", "path length"):
+            values = [b.query(mua, mus, method)["Rd"] for b in baselines]
+            mean = np.mean(values)
+            limit = Z*np.std(values, ddof=1)/np.sqrt(batches)
+            checks.append(("scaling (%s) Rd at albedo %.2f (H-function)"
+                           % (method, omega),
+                           bool(abs(mean - isotropicRd(omega)) <= limit),
+                           "%.5f (reference %.5f, limit %.5f)"
+                           % (mean, isotropicRd(omega), limit)))
+    return checks
+
+def checkHybrid(batches, photons, seed):
+    """
+    compare the hybrid monte carlo / diffusion mode with the pure monte
+    carlo result of the fluence problem. the difference may be up to the
+    stated error bound HYBRID plus the statistical error, which is reported
+    and should be well below it
+    """
+    pure = batchRun(lambda: fluence(mcml), batches, photons, seed)
+    hybrid = batchRun(lambda: enableDiffusion(fluence(mcml), [1, 2]),
+                      batches, photons, seed + 1)
+    checks = []
+    for quantity in ("Rd", "A"):
+        meanA, errorA, valuesA = meanAndError(
+            pure, lambda m: getattr(m, quantity))
+        meanB, errorB, valuesB = meanAndError(
+            hybrid, lambda m: getattr(m, quantity))
+        statistical = Z*np.hypot(errorA, errorB)
+        limit = statistical + HYBRID
+        handoffs = sum(m.handoffs for m in hybrid)/(batches*photons)
+        checks.append(("hybrid diffusion %s of fluence" % quantity,
+                       bool(abs(meanB - meanA) <= limit),
+                       "%.5f (monte carlo %.5f, limit %.5f of which %.5f "
+                       "statistical, %.2f handoffs per photon)"
+                       % (meanB, meanA, limit, statistical, handoffs)))
+    return checks
+
+def checkDomain(batches, photons, seed):
+    """
+    compare delta tracking with the standard transport in a simulation
+    domain (the escaped weight E, Rd, Tt and A). every step of both ends in
+    the same places, so the domain terminates the same packets
+    """
+    standard = batchRun(lambda: domainSlab(mcml), batches, photons, seed)
+    delta = batchRun(lambda: enableDeltaTracking(domainSlab(mcml)),
+                     batches, photons, seed + 1)
+    checks = []
+    for quantity in ("E", "Rd", "Tt", "A"):
+        meanA, errorA, valuesA = meanAndError(
+            standard, lambda m: getattr(m, quantity))
+        meanB, errorB, valuesB = meanAndError(
+            delta, lambda m: getattr(m, quantity))
+        limit = Z*np.hypot(errorA, errorB)
+        checks.append(("domain delta tracking %s" % quantity,
+                       bool(abs(meanB - meanA) <= limit),
+                       "%.5f (standard transport %.5f, limit %.5f)"
+                       % (meanB, meanA, limit)))
+    return checks
+
+def validate(scale=1.0, seed=0, batches=16):
+    """
+    run every check and return a list of (name, passed, detail)
+
+        scale: factor on the number of photons per batch
+        seed: seed of numpy's random generator
+        batches: number of batches per check
+    """
+    # the checks against an error bound (fluence decay, hybrid) get enough
+    # photons for their statistical error to be well below the bound
+    photons = {table1: 1000, table2: 300, isotropic: 1000, fluence: 5000,
+               bilayer: 200}
+    checks = []
+    for name, problem, quantity, reference, uncertainty in \
+            referenceChecks():
+        n = max(2, int(photons[problem]*scale))
+        passed, detail = checkReference(name, problem, quantity, reference,
+                                        uncertainty, batches, n, seed)
+        checks.append((name, passed, detail))
+    for problem in (table1, bilayer):
+        n = max(2, int(photons[problem]*scale))
+        checks += checkEngines(problem, batches, n, seed)
+    checks += checkScaling(batches, max(2, int(photons[isotropic]*scale)),
+                           seed)
+    checks += checkDomain(batches, max(2, int(photons[table1]*scale)),
+                          seed)
+    checks += checkHybrid(batches, max(2, int(photons[fluence]*scale/2)),
+                          seed)
+    return checks
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="validate the MCML models")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="factor on the number of photons per batch")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batches", type=int, default=16)
+    args = parser.parse_args()
+    failed = 0
+    for name, passed, detail in validate(args.scale, args.seed,
+                                         args.batches):
+        print("%s  %s: %s" % ("PASS" if passed else "FAIL", name, detail))
+        failed += not passed
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,240 @@
+"""
+woodcock (delta) tracking through groups of index-matched layers, and
+layers with depth-dependent properties. the transport stops every step at
+every interface of layerDepth, so a stack of many thin sublayers (e.g.
+graded blood content through the dermis) spends its time on boundary
+handling. with
+
+    enableDeltaTracking(model)
+
+neighbouring tissue layers with the same refractive index are one group.
+in a group the packet flies with the majorant mutMax of the group (the
+largest mut of its layers) and only stops at the top and bottom of the
+group. at the end of a flight the packet takes the layer at its depth; it
+scatters there (real collision, drop and spin) with probability
+mut/mutMax, otherwise nothing happens (null collision). the tallies are
+the same as with the standard transport, the number of steps no longer
+depends on the number of sublayers (model.nullCollisions counts the null
+collisions).
+
+a graded layer has mua and mus that depend on the depth below its top,
+given as functions or as sampled profiles (depths, values):
+
+    dermis = graded("dermis", 1.4, 0.9, 0.15, lambda z: 2.0 + 10.0*z, 200.0)
+
+its local properties are used at every drop (inclusion hook) and by the
+delta tracking, which is exact for any profile below the majorant. the
+standard transport flies with the mean mut of a graded layer, so graded
+layers should be used with delta tracking, or cut into plain sublayers
+with subdivide.
+"""
+
+import bisect
+import hashlib
+
+import numpy as np
+
+import scattering as mcml
+from scattering import registerTissue
+
+def profile(value):
+    # function of the depth below the top of the layer from a number, a
+    # function or a sampled profile (depths, values)
+    if callable(value):
+        return value
+    if np.ndim(value) == 0:
+        return lambda z: value
+    depths, values = (np.asarray(a, dtype=float) for a in value)
+    return lambda z: float(np.interp(z, depths, values))
+
+def describeProfile(value, samples):
+    # text describing a profile, for model.describe. a function is named by
+    # its qualified name (the same for every lambda) and the digest of its
+    # samples, so different functions are told apart
+    if callable(value):
+        digest = hashlib.sha1(np.asarray(samples, dtype=float).tobytes())
+        return getattr(value, "__module__", "") + "." + \
+            getattr(value, "__qualname__", repr(value)) + \
+            " sha1=" + digest.hexdigest()
+    return repr(np.asarray(value, dtype=float).tolist())
+
+@registerTissue
+class graded:
+    """
+    layer with depth-dependent absorption and scattering
+
+        name, n, g, z: like medium (n and g are constant)
+        mua, mus: numbers, functions of the depth below the top of the
+                layer [cm] or sampled profiles (depths, values), linearly
+                interpolated
+        samples: number of depths at which the profiles are sampled for
+                the mean properties and the majorant
+        mutMax: largest mua + mus in the layer (the majorant of delta
+                tracking). found from the samples (exact for sampled
+                profiles) unless given
+        phase: tabulated phase function (like medium)
+    """
+    def __init__(self, name, n, g, z, mua, mus, samples=1001, mutMax=None,
+                 phase=None):
+        self.name = name
+        self.n = n
+        self.g = g if phase is None else phase.g
+        self.phase = phase
+        self.z = z
+        self.muaAt = profile(mua)
+        self.musAt = profile(mus)
+        depths = np.linspace(0.0, z, samples)
+        for value in (mua, mus): # the corners of sampled profiles
+            if not callable(value) and np.ndim(value) != 0:
+                depths = np.union1d(depths, np.clip(value[0], 0.0, z))
+        muas = np.array([self.muaAt(d) for d in depths])
+        muss = np.array([self.musAt(d) for d in depths])
+        self.profile = "mua: %s, mus: %s" % (describeProfile(mua, muas),
+                                             describeProfile(mus, muss))
+        # the mean properties are used by the tables of the model
+        self.mua = float(np.mean(muas))
+        self.mus = float(np.mean(muss))
+        self.mutMax = float(np.max(muas + muss)) if mutMax is None \
+            else mutMax
+
+    def properties(self, depth):
+        # (mua, mut) at the depth below the top of the layer
+        mua = self.muaAt(depth)
+        return mua, mua + self.musAt(depth)
+
+    def inclusion(self, photon, model):
+        # local properties at every drop
+        return self.properties(photon.z - model.layerDepth[photon.layer][0])
+
+def subdivide(layer, count):
+    """
+    cut a layer (e.g. a graded one) into count plain sublayers of the same
+    thickness with the properties at their middles
+    """
+    dz = layer.z/count
+    layers = []
+    for i in range(count):
+        if isinstance(layer, graded):
+            mua, mut = layer.properties((i + 0.5)*dz)
+            mus = mut - mua
+        else:
+            mua, mus = layer.mua, layer.mus
+        layers.append(mcml.medium(layer.name, layer.n, layer.g, dz, mua,
+                                  mus, getattr(layer, "phase", None)))
+    return layers
+
+class DeltaGroup:
+    """
+    neighbouring index-matched layers first to last tracked together
+
+        top, bottom: depth of the top and bottom of the group [cm]
+        bottoms: bottom of every layer of the group [cm]
+        mutMax: majorant of the group [1/cm]
+    """
+    def __init__(self, model, first, last):
+        self.first = first
+        self.last = last
+        self.top = model.layerDepth[first][0]
+        self.bottom = model.layerDepth[last][1]
+        self.bottoms = [model.layerDepth[i][1] for i in range(first, last)]
+        self.graded = [isinstance(model.layers[i], graded)
+                       for i in range(len(model.layers))]
+        self.mutMax = max(model.layers[i].mutMax if self.graded[i]
+                          else model.layerMut[i]
+                          for i in range(first, last + 1))
+
+    def layerAt(self, z):
+        # layer of the group at depth z
+        return self.first + bisect.bisect_right(self.bottoms, z)
+
+    def mut(self, photon, model):
+        # local mut of the packet's layer at its depth
+        layer = photon.layer
+        if self.graded[layer]:
+            mut = model.layers[layer].properties(
+                photon.z - model.layerDepth[layer][0])[1]
+        else:
+            mut = model.layerMut[layer]
+        if mut > self.mutMax*(1.0 + 1e-12):
+            raise ValueError("mut %g in layer %d is above the majorant %g"
+                             % (mut, layer, self.mutMax))
+        return mut
+
+class DeltaTracking:
+    """
+    photon mixin (see model.addPhotonMixin) flying through the groups of
+    model.deltaGroups with their majorant
+    """
+    def hopDropSpinTissue(self, model):
+        group = model.deltaGroups[self.layer]
+        if group is None:
+            super().hopDropSpinTissue(model)
+            return
+        mutMax = group.mutMax
+        if self.s_rem == 0.0: # new step
+            self.s = -np.log(self.uniform())/mutMax
+        else: # the rest of a step that crossed a boundary
+            self.s = self.s_rem/mutMax
+            self.s_rem = 0.0
+        uz = self.uz
+        if uz > 0.0: # photon moving down
+            d_b = (group.bottom - self.z)/uz
+        elif uz < 0.0: # photon moving up
+            d_b = (group.top - self.z)/uz
+        else:
+            d_b = np.inf
+        if self.s > d_b: # leaves the group (or is reflected)
+            self.s_rem = (self.s - d_b)*mutMax
+            self.s = d_b
+            self.layer = group.last if uz > 0.0 else group.first
+            self.hop()
+            self.newLayerCheck(model)
+            return
+        self.hop()
+        self.layer = group.layerAt(self.z)
+        if self.uniform()*mutMax < group.mut(self, model): # real
+            self.drop(model)
+            self.spin(model.layerG[self.layer], model.cosZero,
+                      model.layerPhase[self.layer])
+        else:
+            model.nullCollisions += 1
+
+def enableDeltaTracking(model, layers=None):
+    """
+    track the groups of neighbouring layers with the same refractive index
+    (among layers, default all tissue layers) with delta tracking. glass
+    layers and layers with an inclusion (other than graded ones) are left
+    to the standard transport. the group of every layer (None if it has
+    none) is in model.deltaGroups
+    """
+    if layers is None:
+        layers = range(1, model.numberOfLayers + 1)
+    layers = sorted(set(layers))
+    for i in layers:
+        if not 1 <= i <= model.numberOfLayers:
+            raise ValueError("layer %d is not a tissue layer" % i)
+    usable = lambda i: not model.layerGlass[i] and (
+        model.layerInclusion[i] is None or
+        isinstance(model.layers[i], graded))
+    model.deltaGroups = [None]*len(model.layers)
+    groups = [] # first and last layer of every group
+    k = 0
+    while k < len(layers):
+        first = last = layers[k]
+        if not usable(first):
+            k += 1
+            continue
+        while k + 1 < len(layers) and layers[k+1] == last + 1 and \
+                usable(layers[k+1]) and \
+                model.layerN[layers[k+1]] == model.layerN[first]:
+            k += 1
+            last = layers[k]
+        group = DeltaGroup(model, first, last)
+        for i in range(first, last + 1):
+            model.deltaGroups[i] = group
+        groups.append([first, last])
+        k += 1
+    model.addons["deltaTracking"] = {"groups": groups}
+    model.nullCollisions = 0
+    model.addPhotonMixin(DeltaTracking)
+    return model
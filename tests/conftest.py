@@ -0,0 +1,7 @@
+# the modules are at the top of the repository, put it on the path so the
+# tests run from any directory
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
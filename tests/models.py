@@ -0,0 +1,29 @@
+"""
+small models of the tests, defined at module level so worker processes
+can make them (runParallel, runAsync, buildLut)
+"""
+
+import numpy as np
+
+import scattering as mcml
+
+def thinSlab(**policy):
+    # table 1 slab, every packet leaves or is absorbed after a few steps
+    air = mcml.medium("air", 1.0, 1.0, None, 0, 0)
+    tissue = mcml.medium("test 1", 1.0, 0.75, 0.01, 10.0, 90.0)
+    return mcml.model([air, tissue, tissue, air], 2, **policy)
+
+def mismatchedSlab(**policy):
+    # the thin slab with a refractive index mismatch (internal reflection)
+    air = mcml.medium("air", 1.0, 1.0, None, 0, 0)
+    tissue = mcml.medium("test 2", 1.4, 0.75, 0.01, 10.0, 90.0)
+    return mcml.model([air, tissue, tissue, air], 2, **policy)
+
+def fixedPointSlab():
+    # int32 tallies with a unit small enough for about a thousand photons
+    # to come close to the limit of the dtype (the unscattered bin of Tt_ra)
+    return thinSlab(tallyDtype=np.int32, fixedPointUnit=8e-8)
+
+def energy(model):
+    # Rsp + Rd + Tt + A (+ E with a domain) of a scaled model
+    return model.Rsp + model.Rd + model.Tt + model.A + (model.E or 0.0)
@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+
+from models import energy, thinSlab
+from scattering_async import SimulationPool, iterRunAsync, runAsync
+
+def test_thread_batches_run_on_the_model():
+    with SimulationPool(1, processes=False) as pool:
+        model = asyncio.run(runAsync(thinSlab(), 250, 100, pool))
+    assert model.numberOfPhotons == 250
+    model.computeAndScaleArraySums()
+    assert energy(model) == pytest.approx(1.0, abs=1e-3)
+
+def test_process_batches_are_merged():
+    snapshots = []
+    with SimulationPool(2) as pool:
+        model = asyncio.run(runAsync(thinSlab(), 300, 100, pool,
+                                     makeModel=thinSlab,
+                                     progress=snapshots.append))
+    assert model.numberOfPhotons == 300
+    assert [s.numberOfPhotons for s in snapshots] == [100, 200, 300]
+    model.computeAndScaleArraySums()
+    assert energy(model) == pytest.approx(1.0, abs=1e-3)
+
+def test_process_pool_needs_makeModel():
+    async def first():
+        async for snapshot in iterRunAsync(thinSlab(), 100, 100, pool):
+            return snapshot
+    with SimulationPool(1) as pool:
+        with pytest.raises(ValueError, match="makeModel"):
+            asyncio.run(first())
+
+def test_stopped_run_keeps_the_merged_batches():
+    async def firstBatch(model, pool):
+        batches = iterRunAsync(model, 500, 100, pool, makeModel=thinSlab)
+        async for snapshot in batches:
+            break
+        await batches.aclose()
+        return model
+    with SimulationPool(2) as pool:
+        model = asyncio.run(firstBatch(thinSlab(), pool))
+        assert model.numberOfPhotons == 100
+        # the started batches finish, the pool is free again
+        again = asyncio.run(runAsync(thinSlab(), 200, 100, pool,
+                                     makeModel=thinSlab))
+    assert again.numberOfPhotons == 200
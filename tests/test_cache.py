@@ -0,0 +1,60 @@
+import numpy as np
+
+from models import thinSlab
+from scattering_cache import ResultCache, configHash, loadTallies, saveTallies
+
+def test_hash_is_stable():
+    assert configHash(thinSlab()) == configHash(thinSlab())
+    assert configHash(thinSlab()) != configHash(thinSlab(chance=0.2))
+
+def test_hash_covers_the_addons():
+    from scattering_frequency import enableFrequencyDomain
+    low = enableFrequencyDomain(thinSlab(), [1e8])
+    high = enableFrequencyDomain(thinSlab(), [5e8])
+    assert configHash(low) != configHash(high)
+    assert configHash(low) != configHash(thinSlab())
+
+def test_tallies_round_trip(tmp_path):
+    np.random.seed(0)
+    model = thinSlab()
+    model.run(100)
+    path = str(tmp_path / "raw.npz")
+    saveTallies(path, model.rawTallies(), np.random.get_state())
+    raw, randomState = loadTallies(path)
+    for name, value in model.rawTallies().items():
+        if isinstance(value, np.ndarray):
+            np.testing.assert_array_equal(raw[name], value)
+        else:
+            assert raw[name] == value
+    assert randomState[0] == "MT19937"
+
+def test_top_up_continues_the_random_stream(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    np.random.seed(1)
+    cache.run(thinSlab(), 200)
+    assert cache.cachedPhotons(thinSlab()) == 200
+    topped = cache.run(thinSlab(), 400)
+    np.random.seed(1)
+    once = thinSlab()
+    once.run(400)
+    assert topped.numberOfPhotons == 400
+    for name in once.tallies:
+        np.testing.assert_allclose(getattr(topped, name),
+                                   getattr(once, name), rtol=1e-12,
+                                   atol=1e-12)
+
+def test_top_up_gives_the_random_state_back(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    cache.run(thinSlab(), 100)
+    np.random.seed(5)
+    expected = np.random.random_sample()
+    np.random.seed(5)
+    cache.run(thinSlab(), 200)
+    assert np.random.random_sample() == expected
+
+def test_cached_result_is_not_run_again(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    first = cache.run(thinSlab(), 100)
+    again = cache.run(thinSlab(), 50)
+    assert again.numberOfPhotons == 100
+    np.testing.assert_allclose(again.A_rz, first.A_rz)
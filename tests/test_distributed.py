@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+import scattering_distributed as distributed
+from models import mismatchedSlab, thinSlab
+
+def partial(tmp_path, name, seed, stream, makeModel=thinSlab):
+    path = str(tmp_path / name)
+    distributed.runPartial(makeModel, 50, seed, stream, path)
+    return path
+
+def test_merge_adds_the_partials(tmp_path):
+    paths = [partial(tmp_path, "%d.npz" % k, 0, k) for k in range(3)]
+    model = thinSlab()
+    merged = distributed.mergePartials(model, paths)
+    assert sorted(merged) == [(0, 0), (0, 1), (0, 2)]
+    assert model.numberOfPhotons == 150
+
+def test_merge_rejects_a_repeated_stream(tmp_path):
+    paths = [partial(tmp_path, "a.npz", 0, 1), partial(tmp_path, "b.npz", 0, 1)]
+    with pytest.raises(ValueError, match="repeats the random stream"):
+        distributed.mergePartials(thinSlab(), paths)
+    model = thinSlab()
+    assert distributed.mergePartials(model, paths, skipDuplicates=True) == \
+        [(0, 1)]
+    assert model.numberOfPhotons == 50
+
+def test_merge_rejects_another_configuration(tmp_path):
+    paths = [partial(tmp_path, "a.npz", 0, 0, mismatchedSlab)]
+    with pytest.raises(ValueError, match="another configuration"):
+        distributed.mergePartials(thinSlab(), paths)
+
+def test_queue_runs_and_merges_a_job(tmp_path):
+    directory = str(tmp_path / "job")
+    distributed.createJob(directory, thinSlab(), 250, 100, seed=7)
+    assert distributed.status(directory) == {"todo": 3, "claimed": 0,
+                                             "done": 0}
+    assert distributed.work(directory, thinSlab) == 3
+    model = distributed.merge(directory, thinSlab)
+    assert model.numberOfPhotons == 250
+
+def test_merge_checks_tasks_by_seed(tmp_path):
+    directory = str(tmp_path / "job")
+    distributed.createJob(directory, thinSlab(), 200, 100, seed=7)
+    distributed.work(directory, thinSlab)
+    os.remove(os.path.join(directory, "partial", "000000.npz"))
+    with pytest.raises(ValueError, match="not done"):
+        distributed.merge(directory, thinSlab)
+    # stream 0 of another seed is not the missing task
+    distributed.runPartial(thinSlab, 100, 8, 0, os.path.join(
+        directory, "partial", "000000.npz"))
+    with pytest.raises(ValueError, match="not tasks of the job"):
+        distributed.merge(directory, thinSlab)
+
+def test_work_refuses_another_configuration(tmp_path):
+    directory = str(tmp_path / "job")
+    distributed.createJob(directory, thinSlab(), 100, 100)
+    with pytest.raises(ValueError):
+        distributed.work(directory, mismatchedSlab)
+
+def test_claims_are_fresh_and_old_ones_are_requeued(tmp_path):
+    directory = str(tmp_path / "job")
+    distributed.createJob(directory, thinSlab(), 200, 100)
+    old = os.path.join(directory, "todo", "000000")
+    os.utime(old, (0, 0)) # put in todo long ago
+    stream = distributed.claimTask(directory)
+    assert stream == 0
+    # the claim has the time it was made, not the time of the task
+    assert distributed.requeue(directory, olderThan=60.0) == []
+    for claim in os.listdir(os.path.join(directory, "claimed")):
+        os.utime(os.path.join(directory, "claimed", claim), (0, 0))
+    assert distributed.requeue(directory, olderThan=60.0) == [0]
+    assert distributed.status(directory)["todo"] == 2
@@ -0,0 +1,108 @@
+import json
+
+import numpy as np
+import pytest
+
+from models import thinSlab
+from scattering_export import Exporter, exportModel, openTally, \
+    readMetadata, runWithSnapshots, scaledCopy
+
+class MemoryStore:
+    # store keeping the arrays in a dict, for the exporter without h5py
+    # or zarr
+    def __init__(self):
+        self.arrays = {}
+        self.attributes = {}
+
+    def write(self, name, data, chunks):
+        self.arrays[name] = np.asarray(data)
+
+    def append(self, name, data, chunks):
+        self.arrays.setdefault(name, []).append(np.asarray(data))
+
+    def length(self, name):
+        return len(self.arrays.get(name, []))
+
+    def setAttributes(self, attributes):
+        self.attributes.update(attributes)
+
+    def close(self):
+        pass
+
+def memoryExporter():
+    exporter = Exporter.__new__(Exporter)
+    exporter.store = MemoryStore()
+    exporter.chunk = 64
+    return exporter
+
+def run(photons=200, **policy):
+    np.random.seed(0)
+    model = thinSlab(**policy)
+    model.run(photons)
+    return model
+
+def test_write_skips_the_outputs_that_are_not_kept():
+    model = run(keep=("Rd_ra",))
+    exporter = memoryExporter()
+    exporter.write(model)
+    arrays = exporter.store.arrays
+    assert "raw/Rd_ra" in arrays and "scaled/Rd" in arrays
+    for name in ("Tt", "A", "A_rz", "Tt_r", "E", "A_over"):
+        assert "scaled/" + name not in arrays, name
+    assert arrays["scaled/Rd"] == pytest.approx(model.scaled("Rd"))
+
+def test_scaled_tallies_are_refused():
+    model = run()
+    model.computeAndScaleArraySums()
+    assert model.scaledTallies
+    with pytest.raises(ValueError, match="scaled"):
+        scaledCopy(model)
+    exporter = memoryExporter()
+    with pytest.raises(ValueError, match="scaled"):
+        exporter.write(model)
+    assert exporter.store.arrays == {}
+    for refused in (model.rawTallies, model.computeAndScaleArraySums,
+                    lambda: model.run(1),
+                    lambda: model.mergeTallies(run().rawTallies())):
+        with pytest.raises(ValueError, match="scaled"):
+            refused()
+
+def test_scaled_copy_leaves_the_model_raw():
+    model = run()
+    raw = model.rawTallies()
+    scaled = scaledCopy(model)
+    assert not model.scaledTallies
+    np.testing.assert_array_equal(model.A_rz, raw["A_rz"])
+    assert scaled.A == pytest.approx(model.scaled("A"))
+    model.run(10) # and can go on running
+    assert model.numberOfPhotons == 210
+
+@pytest.mark.parametrize("extension, module", [(".h5", "h5py"),
+                                               (".zarr", "zarr")])
+def test_round_trip(tmp_path, extension, module):
+    pytest.importorskip(module)
+    model = run(overflow=True)
+    path = str(tmp_path / ("run" + extension))
+    exportModel(model, path)
+    metadata = readMetadata(path)
+    assert metadata["numberOfPhotons"] == 200
+    assert metadata["model"] == json.loads(json.dumps(model.describe()))
+    with openTally(path, "raw/A_rz") as A_rz:
+        np.testing.assert_array_equal(A_rz[...], model.A_rz)
+    with openTally(path, "scaled/A_rz") as A_rz:
+        np.testing.assert_allclose(A_rz[3, :], model.scaled("A_rz")[3, :])
+    with openTally(path, "scaled/A_over") as A_over:
+        np.testing.assert_allclose(A_over[...], model.scaled("A_over"))
+
+@pytest.mark.parametrize("extension, module", [(".h5", "h5py"),
+                                               (".zarr", "zarr")])
+def test_snapshots_are_appended(tmp_path, extension, module):
+    pytest.importorskip(module)
+    model = thinSlab()
+    path = str(tmp_path / ("run" + extension))
+    runWithSnapshots(model, 300, 100, path)
+    with openTally(path, "snapshots/numberOfPhotons") as photons:
+        assert list(photons[...]) == [100, 200, 300]
+    with openTally(path, "snapshots/Rd_ra") as Rd_ra:
+        assert Rd_ra.shape == (3,) + model.Rd_ra.shape
+        np.testing.assert_array_equal(Rd_ra[-1], model.Rd_ra)
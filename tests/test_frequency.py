@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from models import thinSlab
+from scattering_frequency import enableFrequencyDomain, frequencyDomain
+
+def test_zero_frequency_is_the_steady_state():
+    np.random.seed(0)
+    model = enableFrequencyDomain(thinSlab(), [0.0, 200e6])
+    model.run(300)
+    reflectance = frequencyDomain(model)
+    Rd = model.tallyWeights("Rd_ra").sum()/model.numberOfPhotons
+    assert reflectance["total"][0] == pytest.approx(Rd)
+    assert reflectance["phase"][0] == pytest.approx(0.0)
+    np.testing.assert_allclose(model.scaled("Rd_r"),
+                               reflectance["amplitude"][0], rtol=1e-9,
+                               atol=1e-12)
+
+def test_phase_grows_with_the_frequency():
+    np.random.seed(0)
+    model = enableFrequencyDomain(thinSlab(), [100e6, 400e6])
+    model.run(300)
+    phase = np.angle(frequencyDomain(model, "Tt_fr")["total"])
+    assert 0.0 > phase[0] > phase[1]
+
+def test_run_model_is_refused():
+    model = thinSlab()
+    model.run(10)
+    with pytest.raises(ValueError, match="already run"):
+        enableFrequencyDomain(model, [100e6])
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+import scattering as mcml
+from scattering_lut import Lut, buildLut, slab
+
+AXES = {"mua": [0.5, 2.0], "mus": [50.0, 100.0], "g": [0.9],
+        "thickness": [0.2]}
+
+def doubledSlab(mua, mus, g, thickness):
+    # two layers of the thickness of the point
+    air = mcml.medium("air", 1.0, 1.0, None, 0, 0)
+    tissue = mcml.medium("tissue", 1.4, g, thickness, mua, mus)
+    return mcml.model([air, tissue, tissue, air], 2)
+
+def test_slab_is_one_layer_of_the_thickness():
+    model = slab(1.0, 100.0, 0.9, 0.3)
+    assert model.numberOfLayers == 1
+    assert model.layerDepth[-1] == [0, 0.3]
+
+def test_model_of_another_thickness_is_refused(tmp_path):
+    with pytest.raises(ValueError, match="thick"):
+        buildLut(str(tmp_path), doubledSlab, AXES, 10, processes=1)
+
+def test_build_continue_and_fit(tmp_path):
+    path = str(tmp_path)
+    buildLut(path, slab, AXES, 50, processes=2)
+    lut = Lut(path)
+    assert lut.Rd.shape == (2, 2, 1, 1)
+    assert lut.Rd_r.shape == (2, 2, 1, 1, len(lut.r))
+    assert np.all(lut.Rd > 0.0)
+    # a finished build is not run again, other settings are refused
+    buildLut(path, slab, AXES, 50, processes=1)
+    with pytest.raises(ValueError, match="photons differ"):
+        buildLut(path, slab, AXES, 60, processes=1)
+    # the grid points interpolate to themselves
+    value, gradient = lut.interpolate((0.5, 100.0, 0.9, 0.2))
+    np.testing.assert_allclose(value, lut.Rd_r[0, 1, 0, 0])
+    assert gradient.shape == (4, len(lut.r))
+    fit = lut.fit(value, {"g": 0.9, "thickness": 0.2}, iterations=0)
+    assert fit["iterations"] == 0
+    fit = lut.fit(value, {"g": 0.9, "thickness": 0.2},
+                  initial={"mua": 1.0, "mus": 80.0})
+    np.testing.assert_allclose(fit["point"][:2], (0.5, 100.0), rtol=1e-3)
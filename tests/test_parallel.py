@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from models import energy, fixedPointSlab, thinSlab
+from scattering_distributed import seedStream
+from scattering_parallel import runParallel
+
+def test_slabs_sum_to_the_streams_run_one_by_one():
+    model = runParallel(thinSlab, 300, processes=2, seed=3)
+    assert model.numberOfPhotons == 300
+    expected = thinSlab()
+    for stream in range(2):
+        seedStream(3, stream)
+        part = thinSlab()
+        part.run(150)
+        expected.mergeTallies(part.rawTallies())
+    for name in model.tallies:
+        np.testing.assert_allclose(getattr(model, name),
+                                   getattr(expected, name), rtol=1e-12,
+                                   atol=1e-12, err_msg=name)
+    model.computeAndScaleArraySums()
+    assert energy(model) == pytest.approx(1.0, abs=1e-3)
+
+def test_fixed_point_slabs_sum_past_the_limit_of_the_dtype():
+    # every slab stays below the int32 limit, their sum doesn't
+    model = runParallel(fixedPointSlab, 1600, processes=2)
+    assert model.Tt_ra.dtype == np.float64
+    assert model.Tt_ra.max() > np.iinfo(np.int32).max*model.fixedPointUnit
+    model.computeAndScaleArraySums()
+    assert energy(model) == pytest.approx(1.0, abs=1e-3)
@@ -0,0 +1,126 @@
+import numpy as np
+import pytest
+
+from models import energy, mismatchedSlab, thinSlab
+
+OUTPUTS = ("Rd", "Tt", "A", "Rd_ra", "Rd_r", "Rd_a", "Tt_ra", "Tt_r",
+           "Tt_a", "A_rz", "A_z", "A_l", "Phi_rz", "Phi_z")
+
+def run(makeModel, photons=300, seed=1):
+    np.random.seed(seed)
+    model = makeModel()
+    model.run(photons)
+    return model
+
+@pytest.mark.parametrize("policy", [
+    {},
+    {"partialReflection": 2},
+    {"overflow": True, "domain": (0.02, None)},
+    {"fluenceEstimator": "track length"},
+])
+def test_scaled_matches_computeAndScaleArraySums(policy):
+    model = run(lambda: mismatchedSlab(**policy))
+    scaled = {name: model.scaled(name) for name in OUTPUTS + ("E",)}
+    model.computeAndScaleArraySums()
+    for name, value in scaled.items():
+        if value is None: # option not used
+            assert getattr(model, name) is None, name
+            continue
+        np.testing.assert_allclose(value, getattr(model, name), rtol=1e-9,
+                                   atol=1e-12, err_msg=name)
+
+@pytest.mark.parametrize("policy", [
+    {},
+    {"partialReflection": 1},
+    {"partialReflection": 2},
+    {"overflow": True, "domain": (0.02, 0.015)},
+])
+def test_energy_is_conserved(policy):
+    # roulette conserves the weight on average only
+    model = run(lambda: mismatchedSlab(**policy))
+    model.computeAndScaleArraySums()
+    assert energy(model) == pytest.approx(1.0, abs=1e-3)
+
+def test_scaled_leaves_the_tallies_raw():
+    model = run(thinSlab)
+    raw = model.rawTallies()
+    model.scaled("A_rz")
+    for name in model.tallies:
+        np.testing.assert_array_equal(getattr(model, name), raw[name])
+
+def test_fixed_point_tally_is_promoted_before_it_overflows():
+    # int16 with a small unit overflows after a few photons
+    fixed = run(lambda: thinSlab(tallyDtype=np.int16,
+                                 fixedPointUnit=1e-4))
+    plain = run(thinSlab)
+    for name in ("Rd_ra", "Tt_ra", "A_rz"):
+        assert getattr(fixed, name).dtype == np.float64
+        assert fixed.tallyDtype[name] == np.float64
+        np.testing.assert_allclose(getattr(fixed, name),
+                                   getattr(plain, name), rtol=0.0,
+                                   atol=1e-4*plain.numberOfPhotons)
+    fixed.computeAndScaleArraySums()
+    assert energy(fixed) == pytest.approx(1.0, abs=1e-3)
+
+def test_fixed_point_tally_stays_integer_without_overflow():
+    model = run(lambda: thinSlab(tallyDtype=np.int64, fixedPointUnit=1e-9))
+    assert model.A_rz.dtype == np.int64
+    model.computeAndScaleArraySums()
+    assert energy(model) == pytest.approx(1.0, abs=1e-6)
+
+def test_tallies_that_are_not_kept_have_no_outputs():
+    model = run(lambda: thinSlab(keep=("Rd_ra",)))
+    model.computeAndScaleArraySums()
+    assert model.Rd > 0.0
+    for name in ("Tt", "A", "Tt_ra", "A_rz", "A_l", "Phi_z"):
+        assert getattr(model, name) is None, name
+
+def test_merged_runs_equal_one_run():
+    a = run(thinSlab, 200, seed=3)
+    b = run(thinSlab, 200, seed=4)
+    a.mergeTallies(b.rawTallies())
+    assert a.numberOfPhotons == 400
+    a.computeAndScaleArraySums()
+    assert energy(a) == pytest.approx(1.0, abs=1e-3)
+
+def test_description_is_stable_and_complete():
+    assert thinSlab().describe() == thinSlab().describe()
+    assert thinSlab().describe() != mismatchedSlab().describe()
+    assert thinSlab().describe() != thinSlab(W_th=1e-3).describe()
+
+def test_depth_thresholds_are_told_apart():
+    low = thinSlab(W_th=lambda z: 1e-4).describe()
+    high = thinSlab(W_th=lambda z: 0.5).describe()
+    assert low != high
+    assert low == thinSlab(W_th=lambda z: 1e-4).describe()
+
+def test_instrumentation_does_not_change_the_description():
+    from scattering_sensitivity import Detector, enableSensitivity
+    plain = enableSensitivity(thinSlab(), Detector(0.0, 0.1))
+    inner = thinSlab()
+    inner.enableInstrumentation()
+    enableSensitivity(inner, Detector(0.0, 0.1))
+    outer = enableSensitivity(thinSlab(), Detector(0.0, 0.1))
+    outer.enableInstrumentation()
+    assert plain.describe() == inner.describe() == outer.describe()
+
+def test_partial_escapes_are_not_reflections():
+    model = mismatchedSlab(partialReflection=1)
+    instrumentation = model.enableInstrumentation()
+    np.random.seed(0)
+    model.run(100)
+    counts = instrumentation.summary()["perPhoton"]
+    assert counts["partial escapes"] > 0.0
+    # every boundary hit is one of the outcomes
+    outcomes = sum(counts[name] for name in (
+        "reflections", "transmissions", "escapes", "partial escapes"))
+    assert outcomes == pytest.approx(counts["newLayerCheck"])
+
+def test_iterRun_snapshots_match_the_final_result():
+    model = thinSlab()
+    np.random.seed(0)
+    snapshots = list(model.iterRun(300, 100))
+    assert [s.numberOfPhotons for s in snapshots] == [100, 200, 300]
+    Rd = snapshots[-1].Rd
+    model.computeAndScaleArraySums()
+    assert Rd == pytest.approx(model.Rd)
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from models import thinSlab
+from scattering_sensitivity import Detector, enableSensitivity, \
+    sensitivityMaps
+
+def test_detected_weight_is_the_reflectance_of_the_ring():
+    # a detector on the radial bins 0..k-1 sees what Rd_ra has there
+    model = thinSlab()
+    k = 10
+    enableSensitivity(model, Detector(0.0, k*model.dr))
+    np.random.seed(0)
+    model.run(300)
+    maps = sensitivityMaps(model)
+    Rd_ra = model.tallyWeights("Rd_ra")
+    assert maps["M"] == pytest.approx(Rd_ra[:k].sum()/model.numberOfPhotons)
+    assert maps["detected"] > 0
+    # every detected packet passed through the tissue
+    assert maps["meanPathLength"] > 0.0
+    assert np.all(maps["J_rz"] <= 0.0)
+
+def test_detector_is_checked():
+    with pytest.raises(ValueError):
+        Detector(0.2, 0.1)
+    with pytest.raises(ValueError):
+        Detector(0.0, 0.1, side="side")